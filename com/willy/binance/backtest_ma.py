@@ -5,4 +5,4 @@ from com.willy.binance.util import type_util
 if __name__ == '__main__':
     MovingAverageStrategy("ma_with_ma25_2504_061", type_util.str_to_datetime("2025-04-01T00:00:00Z"),
                           type_util.str_to_datetime("2025-11-30T00:00:00Z"), 50000
-                          , BinanceProduct.BTCUSDT, 20, {"level_amt_change": 1, "dca_levels": 5}).run_backtest()
+                          , BinanceProduct.BTCUSDT, 20, {"level_amt_change": 1, "dca_levels": 5}).run_event_backtest()
@@ -18,3 +18,10 @@ class config_util:
 
     def get(self, option):
         return get(self.section, option)
+
+
+def get_section(section: str) -> dict:
+    """
+    回傳 section 下所有設定 (key 為小寫)，沒有該 section 時回傳空 dict
+    """
+    return dict(parser.items(section)) if parser.has_section(section) else {}
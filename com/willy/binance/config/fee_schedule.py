@@ -0,0 +1,106 @@
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, Tuple
+
+from com.willy.binance.config import config_util
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.enums.handle_fee_type import HandleFeeType
+from com.willy.binance.enums.trade_type import TradeType
+
+FEE_SECTION = "binance.trade.handle.fee"
+# 設定檔沒有手續費設定時使用 USDⓈ-M 合約 VIP0 費率
+DEFAULT_FEE_RATE_MAP = {HandleFeeType.MAKER: Decimal("0.0002"), HandleFeeType.TAKER: Decimal("0.0005")}
+
+
+class FeeRate:
+    """
+    單一費率，預先算好平倉用的係數: 賣出 1 - fee，買入 1 + fee (Decimal 及 float)
+    """
+
+    def __init__(self, rate: Decimal):
+        self.rate = rate
+        self.sell_factor = 1 - rate
+        self.buy_factor = 1 + rate
+        self.rate_float = float(rate)
+        self.sell_factor_float = float(self.sell_factor)
+        self.buy_factor_float = float(self.buy_factor)
+
+
+class FeeSchedule:
+    """
+    手續費表，依 (手續費類別, 交易方向) 取費率，商品/VIP 等級/BNB 折抵在建立時已套用，計算時不再讀設定檔
+    """
+
+    def __init__(self, rate_map: Dict[HandleFeeType, Decimal],
+                 side_rate_map: Dict[Tuple[HandleFeeType, TradeType], Decimal] = None,
+                 bnb_discount: Decimal = Decimal(0)):
+        side_rate_map = side_rate_map or {}
+        discount_factor = 1 - bnb_discount
+        self._fee_rate_map: Dict[Tuple[HandleFeeType, TradeType | None], FeeRate] = {}
+        for handle_fee_type in HandleFeeType:
+            self._fee_rate_map[(handle_fee_type, None)] = FeeRate(rate_map[handle_fee_type] * discount_factor)
+            for trade_type in TradeType:
+                rate = side_rate_map.get((handle_fee_type, trade_type), rate_map[handle_fee_type])
+                self._fee_rate_map[(handle_fee_type, trade_type)] = FeeRate(rate * discount_factor)
+
+    def get_fee_rate(self, handle_fee_type: HandleFeeType, trade_type: TradeType | None = None) -> FeeRate:
+        """
+        trade_type 為 None 時回傳不分方向的費率
+        """
+        return self._fee_rate_map[(handle_fee_type, trade_type)]
+
+    def get_close_fee_rate(self, handle_fee_type: HandleFeeType, units) -> FeeRate:
+        """
+        平倉的費率: 多倉以賣出、空倉以買入平倉
+        """
+        return self._fee_rate_map[(handle_fee_type, TradeType.SELL if units > 0 else TradeType.BUY)]
+
+
+@lru_cache(maxsize=None)
+def load_fee_schedule(binance_product: BinanceProduct | None = None, vip_tier: int | None = None,
+                      bnb_discount: Decimal | None = None) -> FeeSchedule:
+    """
+    由設定檔 [binance.trade.handle.fee] 建立手續費表，同樣參數只讀一次
+    費率依序取第一個有設定的 key (不分大小寫):
+    {product}.{side}.{type} > {product}.{type} > vip{n}.{side}.{type} > vip{n}.{type} > {side}.{type} > {type}
+    例: BTCUSDT.MAKER=0.0001、VIP1.TAKER=0.0004、SELL.TAKER=0.0005
+
+    Args:
+        vip_tier: None 時取設定檔 VIP_TIER (預設 0)
+        bnb_discount: BNB 折抵比例 (例 0.1 為 9 折)，None 時取設定檔 BNB_DISCOUNT (預設 0)
+    """
+    option_map = config_util.get_section(FEE_SECTION)
+    if vip_tier is None:
+        vip_tier = int(option_map.get("vip_tier", 0))
+    if bnb_discount is None:
+        bnb_discount = Decimal(option_map.get("bnb_discount", "0"))
+
+    prefix_list = []
+    if binance_product:
+        prefix_list.append(binance_product.name.lower())
+    prefix_list.append(f"vip{vip_tier}")
+
+    def find_rate(handle_fee_type: HandleFeeType, trade_type: TradeType | None) -> Decimal | None:
+        key_list = []
+        for prefix in prefix_list:
+            if trade_type:
+                key_list.append(f"{prefix}.{trade_type.name}.{handle_fee_type.name}".lower())
+            key_list.append(f"{prefix}.{handle_fee_type.name}".lower())
+        if trade_type:
+            key_list.append(f"{trade_type.name}.{handle_fee_type.name}".lower())
+        key_list.append(handle_fee_type.name.lower())
+        for key in key_list:
+            if key in option_map:
+                return Decimal(option_map[key])
+        return None
+
+    rate_map = {}
+    side_rate_map = {}
+    for handle_fee_type in HandleFeeType:
+        rate = find_rate(handle_fee_type, None)
+        rate_map[handle_fee_type] = DEFAULT_FEE_RATE_MAP[handle_fee_type] if rate is None else rate
+        for trade_type in TradeType:
+            rate = find_rate(handle_fee_type, trade_type)
+            if rate is not None:
+                side_rate_map[(handle_fee_type, trade_type)] = rate
+    return FeeSchedule(rate_map, side_rate_map, bnb_discount)
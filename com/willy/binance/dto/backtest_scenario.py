@@ -0,0 +1,10 @@
+from dataclasses import dataclass
+
+from com.willy.binance.enums.handle_fee_type import HandleFeeType
+
+
+@dataclass
+class BacktestScenario:
+    initial_capital: int  # 本金
+    leverage: int  # 槓桿倍數
+    handle_fee_type: HandleFeeType | None = None  # 策略交易的手續費類別，None 時沿用交易紀錄的設定
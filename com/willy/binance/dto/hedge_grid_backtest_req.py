@@ -23,3 +23,4 @@ class HedgeGridBacktestReq:
     guarantee_amt: Decimal
     level_amt_change: str  # 每網格，投資金額調整多少'150%'表示每一網格投資金額*150%
     leverage_ratio: Decimal
+    is_cross_margin: bool = False  # 全倉: 多空兩邊共用 invest_amt + guarantee_amt，合併損益爆倉時同時平倉
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from typing import List
 
+from com.willy.binance.dto.hedge_risk_snapshot import HedgeRiskSnapshot
 from com.willy.binance.dto.trade_detail import TradeDetail
 from com.willy.binance.dto.txn_detail import TxnDetail
 
@@ -10,3 +11,4 @@ class HedgeGridBacktestRes:
     name: str
     trade_detail_long: TradeDetail
     trade_detail_short: TradeDetail
+    risk_snapshot_list: List[HedgeRiskSnapshot] = None  # 每次交易後的價位損益分析，HedgeStrategy.enable_risk_snapshot 時才有
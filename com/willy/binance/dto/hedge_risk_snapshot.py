@@ -0,0 +1,20 @@
+from dataclasses import dataclass
+from typing import List, Tuple
+
+
+@dataclass
+class HedgeRiskSnapshot:
+    start_time: int  # 交易K棒開始時間 (epoch ms)
+    current_price: float  # 交易價
+    long_units: float
+    short_units: float
+    realized_profit: float  # 多空已實現損益合計
+    profit: float  # 以交易價平倉的總損益 (已實現 + 未實現)
+    break_even_range_list: List[Tuple[float, float]]  # 總損益 >= 0 的價格區間 (價格網格上的最低價, 最高價)
+    worst_loss_in_grid: float  # 網格區間內最差的總損益
+    worst_loss_in_grid_price: float
+    worst_loss_out_grid: float  # 網格區間外 (價格網格範圍內) 最差的總損益
+    worst_loss_out_grid_price: float
+    long_force_close_price: float  # 多倉強平價，空倉為 NaN
+    short_force_close_price: float  # 空倉強平價，空倉為 NaN
+    liquidation_distance: float  # 交易價到最近強平價的距離比例，都沒有持倉為 NaN
@@ -16,3 +16,4 @@ class MaDcaBacktestReq:
     dca_levels: Decimal
     level_amt_change: Decimal  # 每網格，投資金額調整多少1.5表示每一網格投資金額*150%
     leverage_ratio: Decimal
+    use_idx_store: bool = False  # 指標改由 kline_idx_store_svc 預先算好的欄位讀取
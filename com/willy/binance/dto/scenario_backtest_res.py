@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+
+import pandas as pd
+
+from com.willy.binance.dto.backtest_scenario import BacktestScenario
+
+
+@dataclass
+class ScenarioBacktestRes:
+    scenario: BacktestScenario
+    ledger_df: pd.DataFrame  # 交易紀錄 (含爆倉)
+    equity_df: pd.DataFrame  # 每根K棒 start_time, units, total_profit (已實現 + 未實現)
+    trade_count: int
+    force_close_count: int
+    total_handling_fee: float
+    total_profit: float
+    max_drawdown: float
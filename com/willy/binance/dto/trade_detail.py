@@ -9,3 +9,4 @@ class TradeDetail:
     is_circuit_breaker: bool
     is_grid_break: bool
     txn_detail_list: List[TxnDetail]
+    is_sparse: bool = False  # True 時只記錄有交易的 txn_detail，每根K棒的損益由 trade_svc.derive_bar_profit_df 推算
@@ -0,0 +1,262 @@
+from collections.abc import Sequence
+from dataclasses import FrozenInstanceError, fields
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from com.willy.binance.dto.txn_detail import TxnDetail
+from com.willy.binance.enums.handle_fee_type import HandleFeeType
+from com.willy.binance.enums.trade_type import TradeType
+
+TXN_DETAIL_VALUE_FIELDS = ['units', 'handle_amt', 'handling_fee', 'guarantee_fee', 'current_price', 'profit',
+                           'profit_ratio', 'total_profit', 'force_close_offset_price', 'break_even_point_price',
+                           'max_loss', 'acct_balance']
+TRADE_RECORD_VALUE_FIELDS = ['trade_price', 'trade_unit']
+# 沒有交易的K棒沿用前一筆的欄位 (其餘為 current_price 及損益欄位)
+HOLD_VALUE_FIELDS = ['units', 'handle_amt', 'handling_fee', 'guarantee_fee', 'force_close_offset_price',
+                     'break_even_point_price', 'max_loss', 'acct_balance']
+TRADE_TYPE_LIST = list(TradeType)
+HANDLE_FEE_TYPE_LIST = list(HandleFeeType)
+# 沒有 trade_record 時的 code
+NO_CODE = -1
+
+
+def datetime_to_ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+
+def ms_to_datetime(timestamp_ms: int) -> datetime:
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
+
+
+def to_float(value) -> float:
+    return np.nan if value is None else float(value)
+
+
+class TxnDetailView(TxnDetail):
+    """
+    TxnLedger 取出的 TxnDetail，欄位唯讀 (ledger 以欄位存放，修改取出的物件不會寫回 ledger)
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        object.__setattr__(self, '_is_frozen', True)
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_is_frozen', False):
+            raise FrozenInstanceError(f"cannot assign to field '{name}'")
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+    def __eq__(self, other):
+        # 與欄位相同的 TxnDetail 視為相等
+        if not isinstance(other, TxnDetail):
+            return NotImplemented
+        return all(getattr(self, field.name) == getattr(other, field.name) for field in fields(TxnDetail))
+
+
+class TxnLedger(Sequence):
+    """
+    以欄位為單位存放 txn_detail 的 ledger: 日期為 epoch ms，trade type/fee type/reason 為 code
+    數值欄位同時存放原始 Decimal (object 陣列，沒有交易的K棒多半沿用前一筆的同一個物件) 及向量化計算用的 float64
+    可取代 TradeDetail.txn_detail_list (append/len/index/iterate)，取出的是原始值組成的唯讀 TxnDetailView
+    append_hold_bars 批次寫入的K棒，profit/total_profit 以 0.01 USDT 的 int64 存放，取出時才轉成 Decimal
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._size = 0
+        self._date_ms = np.zeros(capacity, dtype='int64')
+        self._value_map: Dict[str, np.ndarray] = {field: np.zeros(capacity, dtype='float64')
+                                                  for field in TXN_DETAIL_VALUE_FIELDS + TRADE_RECORD_VALUE_FIELDS}
+        self._decimal_map: Dict[str, np.ndarray] = {field: np.empty(capacity, dtype=object)
+                                                    for field in TXN_DETAIL_VALUE_FIELDS}
+        self._trade_record_array = np.empty(capacity, dtype=object)
+        self._trade_date_ms = np.zeros(capacity, dtype='int64')
+        self._trade_type_code = np.zeros(capacity, dtype='int8')
+        self._handle_fee_type_code = np.zeros(capacity, dtype='int8')
+        self._reason_code = np.zeros(capacity, dtype='int16')
+        self._is_hold_bar = np.zeros(capacity, dtype=bool)
+        self._profit_cents = np.zeros(capacity, dtype='int64')
+        self._total_profit_cents = np.zeros(capacity, dtype='int64')
+        # reason 不可 hash，以 list 保存出現過的 reason，code 為 index
+        self.reason_list: List = []
+        self._last_txn_detail: Optional[TxnDetailView] = None
+
+    def _grow(self, min_capacity: int = 0):
+        capacity = max(len(self._date_ms) * 2, min_capacity)
+        self._date_ms = np.resize(self._date_ms, capacity)
+        self._value_map = {field: np.resize(values, capacity) for field, values in self._value_map.items()}
+        self._decimal_map = {field: np.resize(values, capacity) for field, values in self._decimal_map.items()}
+        self._trade_record_array = np.resize(self._trade_record_array, capacity)
+        self._trade_date_ms = np.resize(self._trade_date_ms, capacity)
+        self._trade_type_code = np.resize(self._trade_type_code, capacity)
+        self._handle_fee_type_code = np.resize(self._handle_fee_type_code, capacity)
+        self._reason_code = np.resize(self._reason_code, capacity)
+        self._is_hold_bar = np.resize(self._is_hold_bar, capacity)
+        self._profit_cents = np.resize(self._profit_cents, capacity)
+        self._total_profit_cents = np.resize(self._total_profit_cents, capacity)
+
+    def _get_reason_code(self, reason) -> int:
+        for reason_code, existing_reason in enumerate(self.reason_list):
+            if existing_reason is reason or existing_reason == reason:
+                return reason_code
+        self.reason_list.append(reason)
+        return len(self.reason_list) - 1
+
+    def append(self, txn_detail: TxnDetail):
+        if self._size == len(self._date_ms):
+            self._grow()
+        idx = self._size
+        self._date_ms[idx] = datetime_to_ms(txn_detail.date)
+        for field in TXN_DETAIL_VALUE_FIELDS:
+            value = getattr(txn_detail, field)
+            self._decimal_map[field][idx] = value
+            self._value_map[field][idx] = to_float(value)
+        trade_record = txn_detail.trade_record
+        self._trade_record_array[idx] = trade_record
+        if trade_record is None:
+            self._trade_type_code[idx] = NO_CODE
+            self._handle_fee_type_code[idx] = NO_CODE
+            self._reason_code[idx] = NO_CODE
+            self._trade_date_ms[idx] = 0
+            self._value_map['trade_price'][idx] = np.nan
+            self._value_map['trade_unit'][idx] = np.nan
+        else:
+            self._trade_type_code[idx] = TRADE_TYPE_LIST.index(trade_record.type)
+            self._handle_fee_type_code[idx] = HANDLE_FEE_TYPE_LIST.index(trade_record.handle_fee_type)
+            self._reason_code[idx] = self._get_reason_code(trade_record.reason)
+            self._trade_date_ms[idx] = datetime_to_ms(trade_record.date)
+            self._value_map['trade_price'][idx] = to_float(trade_record.price)
+            self._value_map['trade_unit'][idx] = to_float(trade_record.unit)
+        self._is_hold_bar[idx] = False
+        self._size += 1
+        self._last_txn_detail = self._build_txn_detail(idx)
+
+    def append_hold_bars(self, date_ms: np.ndarray, current_price_list: List[Decimal], profit_cents: np.ndarray,
+                         total_profit_cents: np.ndarray, txn_detail: TxnDetail):
+        """
+        批次寫入連續沒有交易的K棒: 持倉欄位沿用 txn_detail (同一個物件)，損益為 0.01 USDT 的整數
+
+        Args:
+            date_ms: K棒開始時間 (epoch ms)
+            current_price_list: K棒收盤價
+            profit_cents: 未實現損益 * 100
+            total_profit_cents: 累計損益 * 100
+        """
+        count = len(date_ms)
+        if count == 0:
+            return
+        if self._size + count > len(self._date_ms):
+            self._grow(self._size + count)
+        bar_slice = slice(self._size, self._size + count)
+        self._date_ms[bar_slice] = date_ms
+        for field in HOLD_VALUE_FIELDS:
+            value = getattr(txn_detail, field)
+            self._decimal_map[field][bar_slice] = value
+            self._value_map[field][bar_slice] = to_float(value)
+        self._decimal_map['current_price'][bar_slice] = current_price_list
+        self._value_map['current_price'][bar_slice] = np.array(current_price_list, dtype='float64')
+        # Decimal 取出時才換算 (_build_txn_detail)
+        for field in ('profit', 'profit_ratio', 'total_profit'):
+            self._decimal_map[field][bar_slice] = None
+        self._profit_cents[bar_slice] = profit_cents
+        self._total_profit_cents[bar_slice] = total_profit_cents
+        self._value_map['profit'][bar_slice] = profit_cents / 100
+        self._value_map['total_profit'][bar_slice] = total_profit_cents / 100
+        # 同 Decimal 版本: 損益或保證金為 0 時 profit_ratio 為 None
+        guarantee_fee = txn_detail.guarantee_fee
+        if guarantee_fee:
+            # 以 0.01 USDT 的整數相除，結果同 Decimal 相除後轉 float
+            self._value_map['profit_ratio'][bar_slice] = np.where(
+                profit_cents != 0, profit_cents / float(guarantee_fee.scaleb(2)), np.nan)
+        else:
+            self._value_map['profit_ratio'][bar_slice] = np.nan
+        self._trade_record_array[bar_slice] = None
+        self._trade_type_code[bar_slice] = NO_CODE
+        self._handle_fee_type_code[bar_slice] = NO_CODE
+        self._reason_code[bar_slice] = NO_CODE
+        self._trade_date_ms[bar_slice] = 0
+        self._value_map['trade_price'][bar_slice] = np.nan
+        self._value_map['trade_unit'][bar_slice] = np.nan
+        self._is_hold_bar[bar_slice] = True
+        self._size += count
+        self._last_txn_detail = self._build_txn_detail(self._size - 1)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _build_txn_detail(self, idx: int) -> TxnDetailView:
+        value_map = {field: self._decimal_map[field][idx] for field in TXN_DETAIL_VALUE_FIELDS}
+        if self._is_hold_bar[idx]:
+            # append_hold_bars 寫入的K棒，損益由 0.01 USDT 的整數換算，profit_ratio 同 Decimal 版本
+            profit = Decimal(int(self._profit_cents[idx])).scaleb(-2)
+            guarantee = value_map['guarantee_fee']
+            value_map['profit'] = profit
+            value_map['profit_ratio'] = profit / guarantee if profit and guarantee else None
+            value_map['total_profit'] = Decimal(int(self._total_profit_cents[idx])).scaleb(-2)
+        return TxnDetailView(ms_to_datetime(int(self._date_ms[idx])), *value_map.values(),
+                             self._trade_record_array[idx])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self._size))]
+        if idx < 0:
+            idx += self._size
+        if idx < 0 or idx >= self._size:
+            raise IndexError("TxnLedger index out of range")
+        if idx == self._size - 1:
+            return self._last_txn_detail
+        return self._build_txn_detail(idx)
+
+    @property
+    def date_ms(self) -> np.ndarray:
+        return self._date_ms[:self._size]
+
+    @property
+    def trade_type_code(self) -> np.ndarray:
+        """
+        TRADE_TYPE_LIST 的 index，沒有交易為 -1
+        """
+        return self._trade_type_code[:self._size]
+
+    @property
+    def reason_code(self) -> np.ndarray:
+        """
+        reason_list 的 index，沒有交易為 -1
+        """
+        return self._reason_code[:self._size]
+
+    def get_values(self, field: str) -> np.ndarray:
+        """
+        回傳欄位的 float64 view (None 為 NaN)
+        """
+        return self._value_map[field][:self._size]
+
+    def get_trade_idx(self) -> np.ndarray:
+        """
+        有交易的 txn_detail 位置
+        """
+        return np.flatnonzero(self.trade_type_code != NO_CODE)
+
+    def to_frame(self) -> pd.DataFrame:
+        df = pd.DataFrame({'date': pd.to_datetime(self.date_ms, unit='ms', utc=True)})
+        for field in TXN_DETAIL_VALUE_FIELDS + TRADE_RECORD_VALUE_FIELDS:
+            df[field] = self.get_values(field)
+        # 沒有交易為 NaT
+        df['trade_date'] = pd.to_datetime(self._trade_date_ms[:self._size], unit='ms', utc=True).where(
+            self.trade_type_code != NO_CODE)
+        df['trade_type'] = pd.Categorical.from_codes(self.trade_type_code,
+                                                     categories=[trade_type.name for trade_type in TRADE_TYPE_LIST])
+        df['handle_fee_type'] = pd.Categorical.from_codes(
+            self._handle_fee_type_code[:self._size],
+            categories=[handle_fee_type.name for handle_fee_type in HANDLE_FEE_TYPE_LIST])
+        # 不同 reason 可能有相同 desc，先轉成 desc 再建 category，最後一個元素給沒有交易的 code -1
+        reason_desc_array = np.array([getattr(reason, 'desc', str(reason)) for reason in self.reason_list] + [None],
+                                     dtype=object)
+        df['reason'] = pd.Categorical(reason_desc_array[self.reason_code])
+        return df
@@ -8,13 +8,22 @@ if __name__ == '__main__':
     binance_svc = BinanceSvc()
     kline_interval = Client.KLINE_INTERVAL_15MINUTE
     product = BinanceProduct.BTCUSDT
+    # 下載後依月份寫入 kline store: data/kline/{product}/{interval}/{yyyy-mm}.parquet
     klines_df = binance_svc.get_historical_klines_df(product, kline_interval,
                                                      type_util.str_to_datetime("2020-01-01T00:00:00Z"),
                                                      type_util.str_to_datetime("2025-11-30T00:00:00Z"))
     # # print("====BEFORE====")
     # # print(klines_df)
-    klines_df.to_csv(f'E:/code/binance/data/{product.name}_{kline_interval}.csv', index=False)
 
-    # df_loaded = pd.read_csv('/data/BTCUSDT_4h.csv')
+    # 舊版單一 csv 快取可直接匯入 kline store
+    # binance_svc.kline_store_svc.import_csv(product, kline_interval, f'E:/code/binance/data/{product.name}_{kline_interval}.csv')
+
+    # Binance 公開的 monthly/daily kline zip 可離線匯入，不受 API 流量限制
+    # KlineArchiveImportSvc(binance_svc.kline_store_svc).import_dir(
+    #     f'E:/code/binance/archive/{product.name}/{kline_interval}', product, kline_interval)
+
+    # df_loaded = binance_svc.kline_store_svc.read_df(product, kline_interval,
+    #                                                 type_util.str_to_datetime("2025-01-01T00:00:00Z"),
+    #                                                 type_util.str_to_datetime("2025-02-01T00:00:00Z"))
     # print("====AFTER====")
     # print(df_loaded)
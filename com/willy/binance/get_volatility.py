@@ -10,8 +10,9 @@ from com.willy.binance.service.binance_svc import BinanceSvc
 
 if __name__ == '__main__':
     binance_svc = BinanceSvc()
-    kline_list = binance_svc.get_historical_klines(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_1DAY,
-                                                   datetime.now() - relativedelta(**{"weeks": 2}), datetime.now())
+    kline_list = binance_svc.get_resampled_klines(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_1DAY,
+                                                  datetime.now() - relativedelta(**{"weeks": 2}), datetime.now(),
+                                                  source_interval=Client.KLINE_INTERVAL_5MINUTE)
     volatility_list = []
     for kline in kline_list:
         volatility_list.append(kline.high - kline.low)
@@ -7,27 +7,33 @@ from dateutil.relativedelta import relativedelta
 from com.willy.binance.dto.hedge_grid_backtest_req import HedgeGridBacktestReq
 from com.willy.binance.enums.binance_product import BinanceProduct
 from com.willy.binance.service.binance_svc import BinanceSvc
+from com.willy.binance.service.kline_loader_svc import KlineLoaderSvc
 from com.willy.binance.strategy.hedge_strategy import HedgeStrategy
 from com.willy.binance.util import type_util
     # TODO 中間價直接上漲突破區間會造成損失
     # TODO 解法: 在區間上沿加一個區間，如果突破區間，可以對沖掉損失，缺點是虧損區間會加大，尤其是區間1上沿跟區間2下沿之間
-    # TODO => 用每次交易後庫存計算各價位損益，找出損益區間及最大損失風險
+    # => 用每次交易後庫存計算各價位損益，找出損益區間及最大損失風險 (HedgeStrategy.enable_risk_snapshot)
     # TODO => 雙重區間觸發後，找出獲利區間
     # TODO  check > 如果跌回區間1，在觸發區間3前能恢復獲利?
 if __name__ == '__main__':
     start_datetime = type_util.str_to_datetime("2025-10-01T00:00:00Z")
 
-    hedge_grid_backtest_res_list_list = []
-    for i in range(15):
-        # 撈出前一筆收盤價
-        binance_svc = BinanceSvc()
-        binance_svc.enable_trade_detail_log = False
-        binance_svc.enable_hedge_trade_plan_log = False
-        binance_svc.enable_trade_summary_log = False
+    backtest_days = 15
+    binance_svc = BinanceSvc()
+    # 每天的回測區間互相重疊，共用 loader 一次撈出全部 5m K棒，之後都由記憶體切片
+    kline_loader_svc = KlineLoaderSvc(binance_svc)
+    kline_loader_svc.prefetch([(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_5MINUTE,
+                                start_datetime - relativedelta(**{"minutes": 5}),
+                                start_datetime + relativedelta(**{"days": backtest_days + 1}))])
+    hedge_strategy = HedgeStrategy(kline_loader_svc)
+    hedge_strategy.enable_risk_snapshot = True
 
+    hedge_grid_backtest_res_list_list = []
+    for i in range(backtest_days):
         # 取出開盤價作為區間中點
-        klines = binance_svc.get_historical_klines(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_5MINUTE,
-                                                   start_datetime - relativedelta(**{"minutes": 5}), start_datetime)
+        klines = kline_loader_svc.load_kline_list(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_5MINUTE,
+                                                  start_datetime - relativedelta(**{"minutes": 5}),
+                                                  start_datetime)
 
         last_close = None
         for kline in klines:
@@ -37,8 +43,9 @@ if __name__ == '__main__':
             raise ValueError("can't get last_close")
 
         # 計算網格區間: 取出過去2周價格波動，計算網格區間應在包含一個標準差內
-        kline_list = binance_svc.get_historical_klines(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_1DAY,
-                                                       start_datetime - relativedelta(**{"weeks": 2}), start_datetime)
+        kline_list = binance_svc.get_resampled_klines(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_1DAY,
+                                                      start_datetime - relativedelta(**{"weeks": 2}), start_datetime,
+                                                      source_interval=Client.KLINE_INTERVAL_5MINUTE)
         volatility_list = []
         for kline in kline_list:
             volatility_list.append(kline.high - kline.low)
@@ -48,7 +55,6 @@ if __name__ == '__main__':
         guarantee_amt = Decimal(3000)
         leverage_ratio_str = Decimal(100)
         level_amt_change = "150%"
-        hedge_strategy = HedgeStrategy()
         hedge_grid_backtest_res_list_list.append(
             hedge_strategy.backtest_hedge_grid_list(
                 [HedgeGridBacktestReq("std_calc_grid_strategy", BinanceProduct.BTCUSDT,
@@ -77,6 +83,16 @@ if __name__ == '__main__':
 
     prifit_map_list = []
     for hedge_grid_backtest_res_list in hedge_grid_backtest_res_list_list:
+        # 各策略交易後最差的價位損益
+        for hedge_grid_backtest_res in hedge_grid_backtest_res_list:
+            if hedge_grid_backtest_res.risk_snapshot_list:
+                worst_in_grid = min(hedge_grid_backtest_res.risk_snapshot_list, key=lambda s: s.worst_loss_in_grid)
+                worst_out_grid = min(hedge_grid_backtest_res.risk_snapshot_list, key=lambda s: s.worst_loss_out_grid)
+                print(f"{hedge_grid_backtest_res.name}"
+                      f"worst_loss_in_grid[{worst_in_grid.worst_loss_in_grid}@{worst_in_grid.worst_loss_in_grid_price}]"
+                      f"worst_loss_out_grid[{worst_out_grid.worst_loss_out_grid}@{worst_out_grid.worst_loss_out_grid_price}]"
+                      f"break_even_range{worst_in_grid.break_even_range_list}"
+                      f"min_liquidation_distance[{min(s.liquidation_distance for s in hedge_grid_backtest_res.risk_snapshot_list)}]")
         prifit_map = {"trade_detail_long": hedge_grid_backtest_res_list[0].trade_detail_long,
                       "trade_detail_short": hedge_grid_backtest_res_list[0].trade_detail_short, "day": {}}
         for hedge_grid_backtest_res in hedge_grid_backtest_res_list:
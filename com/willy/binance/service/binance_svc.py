@@ -1,11 +1,10 @@
 import datetime
 import functools
 import logging
-from datetime import timezone
 from decimal import Decimal
-from pathlib import Path
 from typing import List, Optional
 
+import numpy as np
 import pandas as pd
 from binance import Client, ORDER_TYPE_MARKET, ORDER_TYPE_LIMIT, TIME_IN_FORCE_GTC, ORDER_TYPE_STOP_LOSS
 from pandas import DataFrame
@@ -23,20 +22,27 @@ from com.willy.binance.enums.currency import Currency
 from com.willy.binance.enums.order_type import OrderType
 from com.willy.binance.enums.trade_type import TradeType
 from com.willy.binance.enums.transfer_type import TransferType
+from com.willy.binance.service import tech_idx_svc
+from com.willy.binance.service.kline_download_svc import KlineDownloadSvc
+from com.willy.binance.service.kline_idx_store_svc import KlineIdxStoreSvc
+from com.willy.binance.service.kline_memmap_svc import KlineMemmapSvc, KLINE_RECORD_DTYPE, records_to_kline_list
+from com.willy.binance.service.kline_resample_svc import KlineResampleSvc
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc, raw_klines_to_kline_frame
+from com.willy.binance.service.kline_sync_svc import KlineSyncSvc
 from com.willy.binance.util import type_util
 
 
-def parse_datetime_row(row):
-    row['start_time'] = type_util.timestamp_to_datetime(row['start_time'] // 1000, tz=timezone.utc)
-    row['end_time'] = type_util.timestamp_to_datetime(row['end_time'] // 1000, tz=timezone.utc)
-    return row
-
-
 class BinanceSvc:
 
     def __init__(self, api_user: ApiUser = ApiUser.HEDGE_BUY, is_demo: bool = True, is_testnet: bool = True):
         self.config = config_util("binance.acct." + api_user.acct_name)
         self.client = Client(self.config.get("apikey"), self.config.get("privatekey"), demo=is_demo, testnet=is_testnet)
+        self.kline_store_svc = KlineStoreSvc()
+        self.kline_sync_svc = KlineSyncSvc(self.client, self.kline_store_svc,
+                                           KlineDownloadSvc(base_url=self.client.API_URL))
+        self.kline_memmap_svc = KlineMemmapSvc(self.kline_store_svc)
+        self.kline_idx_store_svc = KlineIdxStoreSvc(self.kline_memmap_svc)
+        self.kline_resample_svc = KlineResampleSvc(self.kline_store_svc, self.kline_sync_svc)
 
     def get_historical_klines(self, binance_product: BinanceProduct, kline_interval=Client.KLINE_INTERVAL_1DAY,
                               start_date: datetime = type_util.str_to_date("20250101"),
@@ -45,16 +51,14 @@ class BinanceSvc:
                                                    int(start_date.timestamp() * 1000),
                                                    int(end_date.timestamp() * 1000))
 
-        kline_list = []
-        for kline in klines:
-            kline_list.append(
-                BinanceKline(start_time=type_util.timestamp_to_datetime(kline[0] // 1000, tz=timezone.utc),
-                             open=Decimal(kline[1]),
-                             high=Decimal(kline[2]), low=Decimal(kline[3]), close=Decimal(kline[4]),
-                             vol=Decimal(kline[5]),
-                             end_time=type_util.timestamp_to_datetime(kline[6] // 1000, tz=timezone.utc),
-                             number_of_trade=kline[8]))
-        return kline_list
+        df = raw_klines_to_kline_frame(klines)
+        start_time_list = df['start_time'].dt.to_pydatetime()
+        end_time_list = df['end_time'].dt.to_pydatetime()
+        # BinanceKline 用 Decimal 計算，直接由原始字串建立；只需要數值欄位時請用 get_historical_klines_df
+        return [BinanceKline(start_time=start_time_list[i], open=Decimal(kline[1]), high=Decimal(kline[2]),
+                             low=Decimal(kline[3]), close=Decimal(kline[4]), vol=Decimal(kline[5]),
+                             end_time=end_time_list[i], number_of_trade=kline[8])
+                for i, kline in enumerate(klines)]
 
     def acct(self):
         acct_dto = AcctDto()
@@ -69,53 +73,87 @@ class BinanceSvc:
                                  start_time: datetime = type_util.str_to_date("20250101"),
                                  end_time: datetime = type_util.str_to_date("20250105")) -> DataFrame:
 
-        df = self.get_price_from_cached_file(binance_product, kline_interval)
-        if df is not None and df.iloc[0]['start_time'] <= start_time and df.iloc[-1]['start_time'] >= end_time:
-            # df = df.apply(parse_datetime_row, axis=1)
-            mask = (df["start_time"] >= start_time) & (df["start_time"] <= end_time)
-            return df.loc[mask].copy()
-        else:
+        if not type_util.is_fixed_kline_interval(kline_interval):
+            # 月K 不存入 store，直接由 REST API 取得
             klines = self.client.get_historical_klines(binance_product.name, kline_interval,
-                                                       int(start_time.timestamp() * 1000),
-                                                       int(end_time.timestamp() * 1000))
-            selected_fields = [[row[i] for i in (0, 1, 2, 3, 4, 5, 6, 8)] for row in klines]
-            df = pd.DataFrame(selected_fields,
-                              columns=['start_time', 'open', 'high', 'low', 'close', 'vol', 'end_time',
-                                       'number_of_trade'])
-            df = df.apply(parse_datetime_row, axis=1)
-            df = df.astype(
-                {'open': float, 'high': float, 'low': float, 'close': float, 'vol': float, 'number_of_trade': float})
-        return df
+                                                       type_util.datetime_to_timestamp_ms(start_time),
+                                                       type_util.datetime_to_timestamp_ms(end_time))
+            return raw_klines_to_kline_frame(klines)
+        # 只下載 store 尚未涵蓋的區間
+        self.kline_sync_svc.sync(binance_product, kline_interval, start_time, end_time)
+        return self.kline_store_svc.read_df(binance_product, kline_interval, start_time, end_time)
+
+    def get_historical_kline_records(self, binance_product: BinanceProduct,
+                                     kline_interval=Client.KLINE_INTERVAL_1DAY,
+                                     start_time: datetime = type_util.str_to_date("20250101"),
+                                     end_time: datetime = type_util.str_to_date("20250105")) -> np.ndarray:
+        """
+        回傳 memmap 上的 structured array view (start_time, open, high, low, close, vol, number_of_trade)
+        """
+        self.kline_sync_svc.sync(binance_product, kline_interval, start_time, end_time)
+        return self.kline_memmap_svc.slice(binance_product, kline_interval, start_time, end_time)
 
-    @functools.lru_cache(maxsize=10)
-    def get_price_from_cached_file(self, binance_product: BinanceProduct, kline_interval):
-        project_dir = str(Path.cwd().parent.parent.parent).replace("\\", "/")
+    def get_historical_kline_idx(self, binance_product: BinanceProduct,
+                                 kline_interval=Client.KLINE_INTERVAL_1DAY,
+                                 start_time: datetime = type_util.str_to_date("20250101"),
+                                 end_time: datetime = type_util.str_to_date("20250105")) -> np.ndarray:
+        """
+        回傳與 get_historical_kline_records 同範圍、逐列對齊的預先計算指標 (kline_idx_store_svc.IDX_COLUMN_DEF_LIST)
+        """
+        self.kline_sync_svc.sync(binance_product, kline_interval, start_time, end_time)
+        return self.kline_idx_store_svc.slice(binance_product, kline_interval, start_time, end_time)
 
-        csv_path = f"{project_dir}/data/{binance_product.name}_{kline_interval}.csv"
-        df = None
-        if Path(csv_path).exists():
-            df = pd.read_csv(csv_path, parse_dates=["start_time", "end_time"])
-        return df
+    def get_kline_data_version(self, binance_product: BinanceProduct, kline_interval=Client.KLINE_INTERVAL_1DAY,
+                               start_time: datetime = type_util.str_to_date("20250101"),
+                               end_time: datetime = type_util.str_to_date("20250105")) -> Optional[str]:
+        """
+        store 中該區間K棒的版本 (partition sha256)，作為 tech_idx_svc 指標快取的 data version
+        """
+        return self.kline_store_svc.get_data_version(binance_product, kline_interval,
+                                                     type_util.datetime_to_timestamp_ms(start_time),
+                                                     type_util.datetime_to_timestamp_ms(end_time))
+
+    def get_resampled_klines_df(self, binance_product: BinanceProduct, kline_interval=Client.KLINE_INTERVAL_1DAY,
+                                start_time: datetime = type_util.str_to_date("20250101"),
+                                end_time: datetime = type_util.str_to_date("20250105"),
+                                source_interval=Client.KLINE_INTERVAL_1MINUTE) -> DataFrame:
+        """
+        由本地 source_interval K棒彙總出 kline_interval，不另外呼叫 REST API 下載 kline_interval
+        """
+        return self.kline_resample_svc.read_df(binance_product, kline_interval, start_time, end_time,
+                                               source_interval)
+
+    def get_resampled_klines(self, binance_product: BinanceProduct, kline_interval=Client.KLINE_INTERVAL_1DAY,
+                             start_date: datetime = type_util.str_to_date("20250101"),
+                             end_date: datetime = type_util.str_to_date("20250105"),
+                             source_interval=Client.KLINE_INTERVAL_1MINUTE) -> List[BinanceKline]:
+        store_df = self.kline_resample_svc.read(binance_product, kline_interval, start_date, end_date,
+                                                source_interval)
+        return records_to_kline_list(store_df[list(KLINE_RECORD_DTYPE.names)].to_records(index=False),
+                                     kline_interval)
 
     def get_close_ma(self, binance_product: BinanceProduct, kline_interval=Client.KLINE_INTERVAL_1DAY,
                      start_date: datetime = type_util.str_to_datetime("2025-11-10T00:00:00Z"),
                      end_date: datetime = type_util.str_to_datetime("2025-11-10T01:00:00Z"), interval: int = 7):
         klines = self.get_historical_klines(binance_product, kline_interval, start_date, end_date)
-        return self.calc_close_ma(klines, interval)
+        return self.calc_close_ma(klines, interval, binance_product, kline_interval)
 
-    def calc_close_ma(self, klines: List[BinanceKline], interval: int = 7) -> List[TimeSeriesDto]:
-        df = pd.DataFrame({
-            'time': [kline.start_time for kline in klines],
-            'close': [kline.close for kline in klines]
+    def calc_close_ma(self, klines: List[BinanceKline], interval: int = 7, binance_product: BinanceProduct = None,
+                      kline_interval: str = None) -> List[TimeSeriesDto]:
+        """
+        有給商品及K棒週期時，同一段K棒的均線經由 tech_idx_svc 快取只算一次
+        """
+        kline_df = pd.DataFrame({
+            'start_time': pd.to_datetime([kline.start_time for kline in klines]),
+            'close': np.array([float(kline.close) for kline in klines], dtype='float64')
         })
-        df['time'] = pd.to_datetime(df['time'])
-        df = df.sort_values('time').reset_index(drop=True)
-        df['avg_price'] = df['close'].astype(float).rolling(window=interval, min_periods=interval).mean()
+        kline_df = kline_df.sort_values('start_time').reset_index(drop=True)
+        avg_price_array = tech_idx_svc.get_idx(kline_df, 'sma', binance_product, kline_interval, window=interval)
 
         # 將結果轉換為 List[TimeSeriesDto]
         dtos: List[TimeSeriesDto] = [
             TimeSeriesDto(date=t, value=ap)
-            for t, ap in zip(df['time'], df['avg_price'])
+            for t, ap in zip(kline_df['start_time'], avg_price_array)
         ]
         return dtos
 
@@ -197,14 +235,7 @@ class BinanceSvc:
         klines = self.client.get_klines(symbol=binance_product.name, interval=kline_interval,
                                         startTime=int(start_time.timestamp() * 1000),
                                         endTime=int(end_time.timestamp() * 1000))
-        selected_fields = [[row[i] for i in (0, 1, 2, 3, 4, 5, 6, 8)] for row in klines]
-        df = pd.DataFrame(selected_fields,
-                          columns=['start_time', 'open', 'high', 'low', 'close', 'vol', 'end_time',
-                                   'number_of_trade'])
-        df = df.apply(parse_datetime_row, axis=1)
-        df = df.astype(
-            {'open': float, 'high': float, 'low': float, 'close': float, 'vol': float, 'number_of_trade': float})
-        return df
+        return raw_klines_to_kline_frame(klines)
 
     def create_test_spot_order(self, binance_product: BinanceProduct, trade_type: TradeType, order_type: OrderType,
                                unit: Decimal, price: str = None):
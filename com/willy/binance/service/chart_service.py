@@ -1,15 +1,22 @@
-from decimal import Decimal
-
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from pyecharts import options as opts
 from pyecharts.charts import Line
 
+from com.willy.binance.dto.txn_ledger import TxnLedger
 from com.willy.binance.enums.trade_type import TradeType
 from com.willy.binance.service import trade_svc
 
 
-def export_trade_point_chart(chart_name, df, ma_dca_backtest_req):
+def build_point_list(date_array: np.ndarray, close_array: np.ndarray, mask: np.ndarray, name: str):
+    return [(date, close, name) for date, close in zip(date_array[mask], close_array[mask].tolist())]
+
+
+def export_trade_point_chart(chart_name, df, ma_dca_backtest_req, txn_ledger: TxnLedger):
+    """
+    df 需有 trade_svc.set_txn_idx_column 的 txn_idx 欄位，交易點及紀錄表由 txn_ledger.to_frame 取得
+    """
     # df = pd.read_csv('E:/code/binance/data/BTCUSDT_15m.csv')
 
     # 提取数据中的日期和收盘价
@@ -19,25 +26,26 @@ def export_trade_point_chart(chart_name, df, ma_dca_backtest_req):
     ma7_list = df["ma7"].values.tolist()
     ma25_list = df["ma25"].values.tolist()
 
-    buy_point_list = []
-    sell_point_list = []
-    stop_loss_point_list = []
-    total_profit_list = []
-    for row in df.itertuples(index=False):
-        if not pd.isna(row.txn_detail):
-            if row.txn_detail.trade_record.reason.desc == "停損":
-                stop_loss_point_list.append((row.start_time.strftime('%Y-%m-%d %H:%M:%S'), row.close, "STOP_LOSS"))
-            else:
-                if row.txn_detail.trade_record.type == TradeType.BUY:
-                    buy_point_list.append((row.start_time.strftime('%Y-%m-%d %H:%M:%S'), row.close, "BUY"))
-                else:
-                    sell_point_list.append((row.start_time.strftime('%Y-%m-%d %H:%M:%S'), row.close, "SEll"))
-            total_profit_list.append(row.txn_detail.total_profit)
-        else:
-            if len(total_profit_list) > 0:
-                total_profit_list.append(total_profit_list[len(total_profit_list) - 1])
-            else:
-                total_profit_list.append(Decimal(0))
+    # 每根有交易的K棒取該K棒最後一筆 txn_detail
+    txn_df = txn_ledger.to_frame()
+    txn_idx_array = df['txn_idx'].to_numpy()
+    is_txn_bar = txn_idx_array >= 0
+    bar_txn_df = txn_df.iloc[txn_idx_array[is_txn_bar]].reset_index(drop=True)
+    point_date_array = np.array(date_list, dtype=object)[is_txn_bar]
+    point_close_array = df['close'].to_numpy()[is_txn_bar]
+    is_stop_loss = (bar_txn_df['reason'] == "停損").to_numpy()
+    is_buy = (bar_txn_df['trade_type'] == TradeType.BUY.name).to_numpy()
+    buy_point_list = build_point_list(point_date_array, point_close_array, ~is_stop_loss & is_buy, "BUY")
+    sell_point_list = build_point_list(point_date_array, point_close_array, ~is_stop_loss & ~is_buy, "SEll")
+    stop_loss_point_list = build_point_list(point_date_array, point_close_array, is_stop_loss, "STOP_LOSS")
+    if 'total_profit' in df.columns:
+        # 事件驅動回測已向量化算出每根K棒的累計損益
+        total_profit_list = df['total_profit'].values.tolist()
+    else:
+        # 沒有交易的K棒沿用前一筆交易的累計損益
+        total_profit = np.full(len(df), np.nan)
+        total_profit[is_txn_bar] = bar_txn_df['total_profit'].to_numpy()
+        total_profit_list = pd.Series(total_profit).ffill().fillna(0.0).tolist()
 
     line_chart = Line()
     line_chart.add_xaxis(xaxis_data=date_list)
@@ -97,14 +105,13 @@ def export_trade_point_chart(chart_name, df, ma_dca_backtest_req):
     chart_html = line_chart.render_embed()
 
     # Convert DataFrame to HTML table
-    txn_detail_df = df[df['txn_detail'].notna()][["start_time", "txn_detail"]]
     df2 = DataFrame()
-    df2['date'] = txn_detail_df['txn_detail'].apply(lambda d: d.trade_record.date.strftime('%Y%m%d %H:%M:%S'))
-    df2['units'] = txn_detail_df['txn_detail'].apply(lambda d: d.units)
-    df2['price'] = txn_detail_df['txn_detail'].apply(lambda d: round(d.trade_record.price, 2))
-    df2['profit'] = txn_detail_df['txn_detail'].apply(lambda d: d.profit)
-    df2['total_profit'] = txn_detail_df['txn_detail'].apply(lambda d: d.total_profit)
-    df2['reason'] = txn_detail_df['txn_detail'].apply(lambda d: d.trade_record.reason.desc)
+    df2['date'] = bar_txn_df['trade_date'].dt.strftime('%Y%m%d %H:%M:%S')
+    df2['units'] = bar_txn_df['units']
+    df2['price'] = bar_txn_df['trade_price'].round(2)
+    df2['profit'] = bar_txn_df['profit']
+    df2['total_profit'] = bar_txn_df['total_profit']
+    df2['reason'] = bar_txn_df['reason']
     table_html = df2.to_html(index=False, border=1)
 
     strategy_summary_df = trade_svc.analyze_trading_strategy(df2, 10000)
@@ -0,0 +1,318 @@
+from decimal import Decimal
+from typing import List, Optional
+
+import numpy as np
+
+from com.willy.binance.config.fee_schedule import FeeSchedule
+from com.willy.binance.dto.binance_kline import BinanceKline
+from com.willy.binance.dto.trade_detail import TradeDetail
+from com.willy.binance.dto.trade_record import TradeRecord
+from com.willy.binance.dto.txn_detail import TxnDetail
+from com.willy.binance.dto.txn_ledger import TxnLedger, datetime_to_ms
+from com.willy.binance.enums.handle_fee_type import HandleFeeType
+from com.willy.binance.enums.trade_type import TradeType
+from com.willy.binance.service import trade_svc
+
+# 價格及金額以 0.01 USDT 為單位，單位數以 1e-8 為單位，持倉金額 (價格 * 單位數) 為 1e-10 USDT
+CENT_SCALE_EXP = 2
+UNIT_SCALE_EXP = 8
+AMT_SCALE_EXP = CENT_SCALE_EXP + UNIT_SCALE_EXP
+CENT_TO_AMT = 10 ** UNIT_SCALE_EXP
+# 超過時 Decimal 版本的乘積可能超過 28 位有效數字，改由 Decimal 計算
+MAX_UNITS = 10 ** 18
+MAX_AMT = 10 ** 18
+# int64 向量化計算損益時中間值的上限
+MAX_INT64_VALUE = 2 ** 61
+
+
+def to_fixed_point(value: Decimal | None, scale_exp: int) -> int | None:
+    """
+    Decimal 放大 10^scale_exp 倍後為整數時回傳 int，小數位數超過 scale_exp 或 None 時回傳 None
+    """
+    if value is None:
+        return None
+    scaled = value.scaleb(scale_exp)
+    int_value = int(scaled)
+    return int_value if int_value == scaled else None
+
+
+def ceil_div(a: int, b: int) -> int:
+    """
+    b > 0
+    """
+    return -((-a) // b)
+
+
+def cents_to_decimal(cents: int) -> Decimal:
+    # 與 quantize(DECIMAL_PLACE_2) 的結果相同 (exponent = -2)
+    return Decimal(cents).scaleb(-CENT_SCALE_EXP)
+
+
+def units_to_decimal(units: int) -> Decimal:
+    return Decimal(units).scaleb(-UNIT_SCALE_EXP)
+
+
+def amt_to_decimal(amt: int) -> Decimal:
+    return Decimal(amt).scaleb(-AMT_SCALE_EXP)
+
+
+class FixedPointTradeSvc:
+    """
+    以整數定點數計算 trade_svc.build_txn_detail_list，每個欄位與 Decimal 版本相同
+    捨入規則同 Decimal 版本 (手續費/保證金 ROUND_CEILING 到 0.01，損益 ROUND_FLOOR 到 0.01，強平/損益兩平價 ROUND_CEILING 到 1)
+
+    以下情況由 trade_svc 以 Decimal 計算，之後最後一筆 txn_detail 可以用定點數表示時再回到整數計算:
+    - 部分平倉 (反向交易單位數 <= 持倉單位數): 持倉金額/手續費按比例分攤為 28 位有效數字的除法再乘法
+    - 最後一筆 txn_detail (例如部分平倉後的持倉金額)、成交價/單位數或K棒價格不在上述單位
+    沒有交易的K棒可由 build_hold_txn_detail_list 批次以 int64 計算，TxnLedger 取出時才轉成 Decimal
+    一個 TradeDetail 使用一個 instance
+    """
+
+    def __init__(self, invest_amt: Decimal, guarantee_amt: Decimal, leverage_ratio: Decimal,
+                 fee_schedule: FeeSchedule = None):
+        self.invest_amt = Decimal(invest_amt)
+        self.guarantee_amt = Decimal(guarantee_amt)
+        self.leverage_ratio = Decimal(leverage_ratio)
+        # 投資金額或保證金不是 0.01 USDT 的倍數時全部由 Decimal 計算
+        self.invest_amt_cents = to_fixed_point(self.invest_amt, CENT_SCALE_EXP)
+        self.guarantee_amt_cents = to_fixed_point(self.guarantee_amt, CENT_SCALE_EXP)
+        self.leverage_num, self.leverage_den = self.leverage_ratio.as_integer_ratio()
+        self.fee_schedule = trade_svc.get_fee_schedule(fee_schedule)
+        # (手續費類別, 交易方向) -> (費率分子, 分母)
+        self.fee_ratio_map = {(handle_fee_type, trade_type):
+                                  self.fee_schedule.get_fee_rate(handle_fee_type, trade_type).rate.as_integer_ratio()
+                              for handle_fee_type in HandleFeeType for trade_type in TradeType}
+        self._last_txn_detail = None
+        # (units, handle_amt, handling_fee_cents, total_profit_cents)，None 時由 Decimal 計算
+        self._state = (0, 0, 0, 0)
+
+    def _load_state(self, trade_detail: TradeDetail) -> tuple | None:
+        """
+        最後一筆 txn_detail 不是本 instance 產生時 (例如 Decimal 計算的部分平倉、爆倉紀錄) 重新換算
+        """
+        if len(trade_detail.txn_detail_list) == 0:
+            self._last_txn_detail = None
+            self._state = (0, 0, 0, 0)
+            return self._state
+        last_txn_detail = trade_detail.txn_detail_list[-1]
+        if last_txn_detail is not self._last_txn_detail:
+            self._last_txn_detail = last_txn_detail
+            self._set_state((to_fixed_point(last_txn_detail.units, UNIT_SCALE_EXP),
+                             to_fixed_point(last_txn_detail.handle_amt, AMT_SCALE_EXP),
+                             to_fixed_point(last_txn_detail.handling_fee, CENT_SCALE_EXP),
+                             to_fixed_point(last_txn_detail.total_profit, CENT_SCALE_EXP)))
+        return self._state
+
+    def _set_state(self, state: tuple):
+        units, handle_amt = state[0], state[1]
+        if None in state or abs(units) > MAX_UNITS or abs(handle_amt) > MAX_AMT:
+            self._state = None
+        else:
+            self._state = state
+
+    def _append(self, trade_detail: TradeDetail, txn_detail: TxnDetail, state: tuple):
+        trade_detail.txn_detail_list.append(txn_detail)
+        # TxnLedger 存放的是唯讀副本，記住 list 中實際的物件，下一根K棒才不需重新換算
+        self._last_txn_detail = trade_detail.txn_detail_list[-1]
+        self._set_state(state)
+
+    def _build_decimal_txn_detail(self, binanceKline: BinanceKline, trade_record: TradeRecord | None,
+                                  trade_detail: TradeDetail):
+        trade_svc.build_txn_detail_list(binanceKline, self.invest_amt, self.guarantee_amt, self.leverage_ratio,
+                                        trade_record, trade_detail, self.fee_schedule)
+
+    def get_close_fee_ratio(self, units: int, handle_fee_type: HandleFeeType = HandleFeeType.TAKER):
+        # 多倉以賣出、空倉以買入平倉
+        return self.fee_ratio_map[(handle_fee_type, TradeType.SELL if units > 0 else TradeType.BUY)]
+
+    def calc_handle_fee_cents(self, price: int, units: int, handle_fee_type: HandleFeeType,
+                              trade_type: TradeType) -> int:
+        fee_num, fee_den = self.fee_ratio_map[(handle_fee_type, trade_type)]
+        return ceil_div(price * units * fee_num, fee_den * CENT_TO_AMT)
+
+    def calc_profit_cents(self, price: int, handle_amt: int, handle_fee: int, units: int,
+                          handle_fee_type: HandleFeeType = HandleFeeType.TAKER) -> Optional[int]:
+        fee_num, fee_den = self.get_close_fee_ratio(units, handle_fee_type)
+        if units > 0:
+            profit_num = price * units * (fee_den - fee_num) - (handle_amt + handle_fee * CENT_TO_AMT) * fee_den
+        elif units < 0:
+            profit_num = (handle_amt - handle_fee * CENT_TO_AMT) * fee_den - price * -units * (fee_den + fee_num)
+        else:
+            return None
+        return profit_num // (fee_den * CENT_TO_AMT)
+
+    def is_int64_safe(self, max_price: int, units: int) -> bool:
+        """
+        calc_profit_cents_batch 的中間值是否都在 int64 範圍內
+        """
+        fee_num, fee_den = self.get_close_fee_ratio(units)
+        return (max_price * abs(units) < MAX_INT64_VALUE
+                and (fee_den + fee_num) * fee_den * CENT_TO_AMT < MAX_INT64_VALUE)
+
+    def calc_profit_cents_batch(self, price_array: np.ndarray, handle_amt: int, handle_fee: int,
+                                units: int) -> np.ndarray:
+        """
+        同 calc_profit_cents (TAKER)，price_array 為 int64，需先以 is_int64_safe 確認不會溢位
+        """
+        fee_num, fee_den = self.get_close_fee_ratio(units)
+        # 損益 = floor((diff * fee_den - position_amt * fee_num) / (fee_den * CENT_TO_AMT))
+        position_amt = price_array * abs(units)
+        if units > 0:
+            diff = position_amt - (handle_amt + handle_fee * CENT_TO_AMT)
+        else:
+            diff = (handle_amt - handle_fee * CENT_TO_AMT) - position_amt
+        # 拆成商及餘數分別計算，避免乘上 fee_den 後超過 int64
+        divisor = fee_den * CENT_TO_AMT
+        diff_quotient, diff_remainder = np.divmod(diff, CENT_TO_AMT)
+        amt_quotient, amt_remainder = np.divmod(position_amt, divisor)
+        return (diff_quotient - amt_quotient * fee_num
+                + (diff_remainder * fee_den - amt_remainder * fee_num) // divisor)
+
+    def calc_force_close_offset_price(self, profit: int, handle_amt: int, handle_fee: int,
+                                      units: int) -> Optional[Decimal]:
+        fee_num, fee_den = self.get_close_fee_ratio(units)
+        if units > 0:
+            price_num = (profit * CENT_TO_AMT + handle_amt + handle_fee * CENT_TO_AMT) * fee_den
+            price_den = units * (fee_den - fee_num) * 10 ** CENT_SCALE_EXP
+        elif units < 0:
+            price_num = (handle_amt - handle_fee * CENT_TO_AMT - profit * CENT_TO_AMT) * fee_den
+            price_den = -units * (fee_den + fee_num) * 10 ** CENT_SCALE_EXP
+        else:
+            return None
+        price, remainder = divmod(price_num, price_den)
+        if remainder == 0:
+            # 剛好為整數時 Decimal 版本兩次除法的捨入可能略大於整數而進位，改由 Decimal 計算
+            return trade_svc.calc_force_close_offset_price(cents_to_decimal(profit), amt_to_decimal(handle_amt),
+                                                           cents_to_decimal(handle_fee), units_to_decimal(units),
+                                                           HandleFeeType.TAKER, self.fee_schedule)
+        return Decimal(price + 1)
+
+    def calc_guarantee_cents(self, handle_amt: int) -> int:
+        return ceil_div(handle_amt * self.leverage_den, self.leverage_num * CENT_TO_AMT)
+
+    def build_txn_detail_list(self, binanceKline: BinanceKline, trade_record: TradeRecord | None,
+                              trade_detail: TradeDetail):
+        """
+        同 trade_svc.build_txn_detail_list(binanceKline, invest_amt, guarantee_amt, leverage_ratio, trade_record,
+        trade_detail, fee_schedule)
+        """
+        state = self._load_state(trade_detail)
+        if trade_record is None:
+            if trade_detail.is_sparse:
+                return
+            close = to_fixed_point(binanceKline.close, CENT_SCALE_EXP)
+            # 沒有持倉時 Decimal 版本損益為 None 無法累計，一併交給 Decimal 版本
+            if state is None or state[0] == 0 or close is None:
+                self._build_decimal_txn_detail(binanceKline, trade_record, trade_detail)
+                return
+            last_units, last_amt, last_fee, last_total_profit = state
+            profit_cents = self.calc_profit_cents(close, last_amt, last_fee, last_units)
+            last_txn_detail = self._last_txn_detail
+            profit = cents_to_decimal(profit_cents)
+            profit_ratio = None
+            if profit and last_txn_detail.guarantee_fee:
+                profit_ratio = profit / last_txn_detail.guarantee_fee
+            self._append(trade_detail,
+                         TxnDetail(binanceKline.start_time, last_txn_detail.units, last_txn_detail.handle_amt,
+                                   last_txn_detail.handling_fee, last_txn_detail.guarantee_fee,
+                                   binanceKline.close, profit, profit_ratio,
+                                   cents_to_decimal(last_total_profit + profit_cents),
+                                   last_txn_detail.force_close_offset_price,
+                                   last_txn_detail.break_even_point_price, last_txn_detail.max_loss,
+                                   last_txn_detail.acct_balance, trade_record),
+                         (last_units, last_amt, last_fee, last_total_profit + profit_cents))
+            return
+        if trade_record.type not in (TradeType.BUY, TradeType.SELL):
+            return
+
+        price = to_fixed_point(trade_record.price, CENT_SCALE_EXP)
+        trade_units = to_fixed_point(trade_record.unit, UNIT_SCALE_EXP)
+        high = to_fixed_point(binanceKline.high, CENT_SCALE_EXP)
+        low = to_fixed_point(binanceKline.low, CENT_SCALE_EXP)
+        if state is None or None in (self.invest_amt_cents, self.guarantee_amt_cents, price, trade_units, high, low):
+            self._build_decimal_txn_detail(binanceKline, trade_record, trade_detail)
+            return
+        last_units, last_amt, last_fee, last_total_profit = state
+        # 買入為正、賣出為負
+        signed_trade_units = trade_units if trade_record.type == TradeType.BUY else -trade_units
+        if last_units * signed_trade_units < 0 and trade_units <= abs(last_units):
+            # 部分平倉，按比例分攤的捨入同 Decimal 版本
+            self._build_decimal_txn_detail(binanceKline, trade_record, trade_detail)
+            return
+
+        last_txn_detail = self._last_txn_detail
+        handle_fee_type = trade_record.handle_fee_type
+        total_units = last_units + signed_trade_units
+        profit_cents = 0
+        profit = Decimal(0)
+        profit_ratio = Decimal(0)
+        if last_units * signed_trade_units >= 0:
+            # 加倉
+            total_amt = last_amt + price * trade_units
+            total_fee = last_fee + self.calc_handle_fee_cents(price, trade_units, handle_fee_type, trade_record.type)
+        else:
+            # 反手: 反向交易單位 > 持倉單位，平倉後以剩餘單位開倉
+            total_amt = price * abs(total_units)
+            total_fee = abs(self.calc_handle_fee_cents(price, total_units, handle_fee_type, trade_record.type))
+            profit_cents = self.calc_profit_cents(price, last_amt, last_fee, last_units, handle_fee_type)
+            profit = cents_to_decimal(profit_cents)
+            profit_ratio = profit / last_txn_detail.guarantee_fee
+
+        guarantee = self.calc_guarantee_cents(total_amt)
+        acct_balance = self.invest_amt_cents + self.guarantee_amt_cents - guarantee - total_fee
+        if total_units > 0:
+            max_loss = cents_to_decimal(min(self.calc_profit_cents(high, total_amt, total_fee, total_units),
+                                            self.calc_profit_cents(low, total_amt, total_fee, total_units)))
+        else:
+            max_loss = Decimal(0)
+        force_close_offset_price = self.calc_force_close_offset_price(
+            -(self.invest_amt_cents + self.guarantee_amt_cents), total_amt, total_fee, total_units)
+        break_even_point_price = self.calc_force_close_offset_price(0, total_amt, total_fee, total_units)
+
+        self._append(trade_detail,
+                     TxnDetail(binanceKline.start_time, units_to_decimal(total_units), amt_to_decimal(total_amt),
+                               cents_to_decimal(total_fee), cents_to_decimal(guarantee), trade_record.price, profit,
+                               profit_ratio, cents_to_decimal(last_total_profit + profit_cents),
+                               force_close_offset_price, break_even_point_price, max_loss,
+                               cents_to_decimal(acct_balance), trade_record),
+                     (total_units, total_amt, total_fee, last_total_profit + profit_cents))
+
+    def build_hold_txn_detail_list(self, kline_list: List[BinanceKline], trade_detail: TradeDetail):
+        """
+        連續沒有交易的K棒，同逐根呼叫 build_txn_detail_list(kline, None, trade_detail)
+        持倉不變，損益以 int64 向量化計算，txn_detail_list 為 TxnLedger 時取出才轉成 Decimal
+        """
+        if trade_detail.is_sparse or len(kline_list) == 0:
+            return
+        state = self._load_state(trade_detail)
+        close_list = [to_fixed_point(kline.close, CENT_SCALE_EXP) for kline in kline_list]
+        if (state is None or state[0] == 0 or None in close_list
+                or not self.is_int64_safe(max(abs(close) for close in close_list), state[0])):
+            for kline in kline_list:
+                self.build_txn_detail_list(kline, None, trade_detail)
+            return
+
+        last_units, last_amt, last_fee, last_total_profit = state
+        profit_cents = self.calc_profit_cents_batch(np.array(close_list, dtype='int64'), last_amt, last_fee,
+                                                    last_units)
+        total_profit_cents = last_total_profit + np.cumsum(profit_cents)
+        last_txn_detail = self._last_txn_detail
+        txn_detail_list = trade_detail.txn_detail_list
+        if isinstance(txn_detail_list, TxnLedger):
+            txn_detail_list.append_hold_bars(np.array([datetime_to_ms(kline.start_time) for kline in kline_list]),
+                                             [kline.close for kline in kline_list], profit_cents,
+                                             total_profit_cents, last_txn_detail)
+        else:
+            guarantee_fee = last_txn_detail.guarantee_fee
+            for kline, bar_profit_cents, bar_total_profit_cents in zip(kline_list, profit_cents.tolist(),
+                                                                       total_profit_cents.tolist()):
+                profit = cents_to_decimal(bar_profit_cents)
+                txn_detail_list.append(
+                    TxnDetail(kline.start_time, last_txn_detail.units, last_txn_detail.handle_amt,
+                              last_txn_detail.handling_fee, guarantee_fee, kline.close, profit,
+                              profit / guarantee_fee if profit and guarantee_fee else None,
+                              cents_to_decimal(bar_total_profit_cents), last_txn_detail.force_close_offset_price,
+                              last_txn_detail.break_even_point_price, last_txn_detail.max_loss,
+                              last_txn_detail.acct_balance, None))
+        self._last_txn_detail = txn_detail_list[-1]
+        self._set_state((last_units, last_amt, last_fee, int(total_profit_cents[-1])))
@@ -0,0 +1,170 @@
+from typing import Dict, List
+
+import numpy as np
+
+from com.willy.binance.config.fee_schedule import FeeSchedule
+from com.willy.binance.dto.hedge_risk_snapshot import HedgeRiskSnapshot
+from com.willy.binance.dto.trade_detail import TradeDetail
+from com.willy.binance.dto.txn_ledger import TxnLedger, to_float
+from com.willy.binance.enums.handle_fee_type import HandleFeeType
+from com.willy.binance.service import trade_svc
+from com.willy.binance.util import type_util
+
+EVENT_FIELDS = ['units', 'handle_amt', 'handling_fee', 'current_price', 'profit', 'force_close_offset_price']
+# 網格區間內預設切成的價格點數
+DEFAULT_GRID_POINTS = 500
+# 一次計算的交易事件數 (事件數 x 價格點數 的矩陣)
+EVENT_CHUNK_SIZE = 256
+
+
+def get_trade_event_map(trade_detail: TradeDetail) -> Dict[str, np.ndarray]:
+    """
+    取出有交易的 txn_detail (交易後的持倉狀態)，欄位為 float64 陣列 (None 為 NaN)，start_time 為 epoch ms
+    """
+    txn_detail_list = trade_detail.txn_detail_list
+    if isinstance(txn_detail_list, TxnLedger):
+        trade_idx = txn_detail_list.get_trade_idx()
+        event_map = {'start_time': txn_detail_list.date_ms[trade_idx]}
+        for field in EVENT_FIELDS:
+            event_map[field] = txn_detail_list.get_values(field)[trade_idx]
+        return event_map
+    trade_txn_detail_list = [txn_detail for txn_detail in txn_detail_list if txn_detail.trade_record]
+    event_map = {'start_time': np.array([type_util.datetime_to_timestamp_ms(txn_detail.date)
+                                         for txn_detail in trade_txn_detail_list], dtype='int64')}
+    for field in EVENT_FIELDS:
+        event_map[field] = np.array([to_float(getattr(txn_detail, field)) for txn_detail in trade_txn_detail_list],
+                                    dtype='float64')
+    return event_map
+
+
+class HedgeRiskSvc:
+    """
+    多空對沖網格的價位損益分析: 每次交易後以多空庫存在價格網格上計算總損益 (已實現 + 以該價平倉的未實現)
+    找出損益兩平區間、網格區間內外的最大損失及到強平價的距離
+    單邊爆倉時該邊損失固定為 -(invest_amt + guarantee_amt)
+    """
+
+    def __init__(self, lower_bound, upper_bound, leg_capital, price_step=None, outer_ratio: float = 1.0,
+                 fee_schedule: FeeSchedule = None):
+        """
+        Args:
+            lower_bound: 網格下沿
+            upper_bound: 網格上沿
+            leg_capital: 單邊 invest_amt + guarantee_amt (爆倉損失)
+            price_step: 價格網格間距，None 時為網格區間的 1 / DEFAULT_GRID_POINTS
+            outer_ratio: 網格區間外上下各延伸 網格寬度 * outer_ratio
+            fee_schedule: 手續費表，None 時使用預設
+        """
+        lower_bound = float(lower_bound)
+        upper_bound = float(upper_bound)
+        width = upper_bound - lower_bound
+        price_step = float(price_step) if price_step else max(width / DEFAULT_GRID_POINTS, 0.01)
+        price_array = np.arange(lower_bound - width * outer_ratio, upper_bound + width * outer_ratio + price_step / 2,
+                                price_step)
+        self.price_array = price_array[price_array > 0]
+        self.is_in_grid = (self.price_array >= lower_bound) & (self.price_array <= upper_bound)
+        self.leg_capital = float(leg_capital)
+        self.fee_schedule = trade_svc.get_fee_schedule(fee_schedule)
+
+    def calc_leg_profit(self, price, units, handle_amt, handle_fee) -> np.ndarray:
+        """
+        單邊以 price 平倉的損益，空倉為 0，損失不超過爆倉損失
+        """
+        profit = trade_svc.calc_profit_batch(price, handle_amt, handle_fee, units, HandleFeeType.TAKER,
+                                             fee_schedule=self.fee_schedule)
+        return np.maximum(np.nan_to_num(profit), -self.leg_capital)
+
+    def calc_worst_loss(self, profit_matrix: np.ndarray, price_mask: np.ndarray):
+        """
+        回傳每列在 price_mask 價位中的最差損益及價格，沒有價位時為 NaN
+        """
+        event_count = len(profit_matrix)
+        if not np.any(price_mask):
+            return np.full(event_count, np.nan), np.full(event_count, np.nan)
+        masked_profit = np.where(price_mask, profit_matrix, np.inf)
+        worst_idx = np.argmin(masked_profit, axis=1)
+        return masked_profit[np.arange(event_count), worst_idx], self.price_array[worst_idx]
+
+    def calc_break_even_range_list(self, profit_matrix: np.ndarray) -> List[List[tuple]]:
+        """
+        每列總損益 >= 0 的連續價格區間
+        """
+        event_count = len(profit_matrix)
+        is_profit = np.pad((profit_matrix >= 0).astype('int8'), ((0, 0), (1, 1)))
+        change = np.diff(is_profit, axis=1)
+        # 由左到右逐列掃描，同一列的起點與終點依序配對 (終點為不含)
+        start_row, start_col = np.nonzero(change == 1)
+        _, end_col = np.nonzero(change == -1)
+        split_idx = np.cumsum(np.bincount(start_row, minlength=event_count))[:-1]
+        return [list(zip(self.price_array[start].tolist(), self.price_array[end - 1].tolist()))
+                for start, end in zip(np.split(start_col, split_idx), np.split(end_col, split_idx))]
+
+    def build_snapshot_list(self, long_trade_detail: TradeDetail,
+                            short_trade_detail: TradeDetail) -> List[HedgeRiskSnapshot]:
+        """
+        依時間合併多空兩邊的交易，每根有交易的K棒 (任一邊) 產生一筆 HedgeRiskSnapshot
+        """
+        long_event_map = get_trade_event_map(long_trade_detail)
+        short_event_map = get_trade_event_map(short_trade_detail)
+        start_time_array = np.union1d(long_event_map['start_time'], short_event_map['start_time'])
+        if len(start_time_array) == 0:
+            return []
+
+        leg_state_list = []
+        for event_map in (long_event_map, short_event_map):
+            # 每個時間點對應到該邊最後一筆交易，-1 (尚未交易) 對應到最後補上的空持倉
+            event_idx = np.searchsorted(event_map['start_time'], start_time_array, side='right') - 1
+            is_event = event_idx >= 0
+            is_event[is_event] = event_map['start_time'][event_idx[is_event]] == start_time_array[is_event]
+            realized_profit = np.r_[np.cumsum(np.nan_to_num(event_map['profit'])), 0.0]
+            units = np.r_[event_map['units'], 0.0][event_idx]
+            # 爆倉紀錄的強平價為 0，空倉一律視為沒有強平價
+            force_close_offset_price = np.r_[event_map['force_close_offset_price'], np.nan][event_idx]
+            leg_state_list.append({
+                'units': units,
+                'handle_amt': np.r_[event_map['handle_amt'], 0.0][event_idx],
+                'handling_fee': np.r_[event_map['handling_fee'], 0.0][event_idx],
+                'force_close_offset_price': np.where(units != 0, force_close_offset_price, np.nan),
+                'current_price': np.r_[event_map['current_price'], np.nan][event_idx],
+                'realized_profit': realized_profit[event_idx],
+                'is_event': is_event})
+        long_state, short_state = leg_state_list
+        # 優先取多倉在該K棒的交易價
+        current_price = np.where(long_state['is_event'], long_state['current_price'], short_state['current_price'])
+        realized_profit = long_state['realized_profit'] + short_state['realized_profit']
+        profit = np.round(realized_profit
+                          + self.calc_leg_profit(current_price, long_state['units'], long_state['handle_amt'],
+                                                 long_state['handling_fee'])
+                          + self.calc_leg_profit(current_price, short_state['units'], short_state['handle_amt'],
+                                                 short_state['handling_fee']), 2)
+        with np.errstate(invalid='ignore'):
+            liquidation_distance = np.fmin(np.abs(current_price - long_state['force_close_offset_price']),
+                                           np.abs(current_price - short_state['force_close_offset_price'])
+                                           ) / current_price
+
+        snapshot_list = []
+        for chunk_start in range(0, len(start_time_array), EVENT_CHUNK_SIZE):
+            chunk = slice(chunk_start, chunk_start + EVENT_CHUNK_SIZE)
+            # (事件, 價格) 矩陣
+            profit_matrix = np.round(realized_profit[chunk, None]
+                                     + self.calc_leg_profit(self.price_array, long_state['units'][chunk, None],
+                                                            long_state['handle_amt'][chunk, None],
+                                                            long_state['handling_fee'][chunk, None])
+                                     + self.calc_leg_profit(self.price_array, short_state['units'][chunk, None],
+                                                            short_state['handle_amt'][chunk, None],
+                                                            short_state['handling_fee'][chunk, None]), 2)
+            worst_in_grid, worst_in_grid_price = self.calc_worst_loss(profit_matrix, self.is_in_grid)
+            worst_out_grid, worst_out_grid_price = self.calc_worst_loss(profit_matrix, ~self.is_in_grid)
+            break_even_range_list = self.calc_break_even_range_list(profit_matrix)
+            for chunk_idx, event_idx in enumerate(range(chunk.start, min(chunk.stop, len(start_time_array)))):
+                snapshot_list.append(HedgeRiskSnapshot(
+                    int(start_time_array[event_idx]), float(current_price[event_idx]),
+                    float(long_state['units'][event_idx]), float(short_state['units'][event_idx]),
+                    float(realized_profit[event_idx]), float(profit[event_idx]),
+                    break_even_range_list[chunk_idx],
+                    float(worst_in_grid[chunk_idx]), float(worst_in_grid_price[chunk_idx]),
+                    float(worst_out_grid[chunk_idx]), float(worst_out_grid_price[chunk_idx]),
+                    float(long_state['force_close_offset_price'][event_idx]),
+                    float(short_state['force_close_offset_price'][event_idx]),
+                    float(liquidation_distance[event_idx])))
+        return snapshot_list
@@ -0,0 +1,149 @@
+import hashlib
+import logging
+import re
+import sys
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from pandas import DataFrame
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc, KLINE_COLUMNS, KLINE_DTYPES
+from com.willy.binance.util import type_util
+
+# Binance 公開資料 monthly/daily kline 檔名: BTCUSDT-1m-2024-01.zip / BTCUSDT-1m-2024-01-15.zip
+ARCHIVE_FILE_PATTERN = re.compile(r"^(?P<symbol>[A-Z0-9]+)-(?P<interval>\w+)-(?P<period>\d{4}-\d{2}(-\d{2})?)\.zip$")
+# 2025 年起 spot 檔案的時間為 microsecond
+MICROSECOND_THRESHOLD = 10 ** 14
+
+
+def get_archive_period(zip_path: Path) -> Tuple[int, int]:
+    """
+    由檔名取得檔案涵蓋的期間 [start_ms, end_ms)
+    """
+    period = ARCHIVE_FILE_PATTERN.match(zip_path.name).group("period")
+    if len(period) == 7:
+        start_time = datetime.strptime(period, "%Y-%m").replace(tzinfo=timezone.utc)
+        end_time = start_time + relativedelta(months=1)
+    else:
+        start_time = datetime.strptime(period, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        end_time = start_time + relativedelta(days=1)
+    return type_util.datetime_to_timestamp_ms(start_time), type_util.datetime_to_timestamp_ms(end_time)
+
+
+def verify_checksum(zip_path: Path) -> bool:
+    """
+    有 .CHECKSUM 檔時以 sha256 驗證 zip，沒有時略過
+    """
+    checksum_path = zip_path.with_name(zip_path.name + ".CHECKSUM")
+    if not checksum_path.exists():
+        return True
+    expected_checksum = checksum_path.read_text().split()[0].lower()
+    sha256 = hashlib.sha256()
+    with open(zip_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest() == expected_checksum
+
+
+def validate_store_frame(store_df: DataFrame, kline_interval: str, period_start_ms: int, period_end_ms: int,
+                         source_name: str):
+    interval_ms = type_util.kline_interval_to_ms(kline_interval)
+    start_time_array = store_df['start_time'].to_numpy()
+    error_list = []
+    if store_df.isna().to_numpy().any():
+        error_list.append("contains NaN")
+    if np.any(np.diff(start_time_array) <= 0):
+        error_list.append("start_time is not strictly increasing")
+    if np.any(start_time_array != type_util.floor_to_kline_interval(start_time_array, kline_interval)):
+        error_list.append("start_time is not aligned to interval")
+    if np.any(store_df['end_time'].to_numpy() != start_time_array + interval_ms - 1):
+        error_list.append("end_time != start_time + interval - 1")
+    if np.any((start_time_array < period_start_ms) | (start_time_array >= period_end_ms)):
+        error_list.append("start_time is out of file period")
+    if np.any((store_df['high'] < store_df[['open', 'close', 'low']].max(axis=1)) |
+              (store_df['low'] > store_df[['open', 'close', 'high']].min(axis=1))):
+        error_list.append("high/low is not consistent with open/close")
+    if len(error_list) > 0:
+        raise ValueError(f"[validate_store_frame] file[{source_name}] {', '.join(error_list)}")
+
+
+class KlineArchiveImportSvc:
+    """
+    將本地資料夾中 Binance 公開的 monthly/daily kline zip 逐段解壓匯入 kline store
+    """
+
+    def __init__(self, kline_store_svc: KlineStoreSvc, chunk_rows: int = 100000):
+        self.kline_store_svc = kline_store_svc
+        self.chunk_rows = chunk_rows
+
+    def list_archive_files(self, archive_dir: str, binance_product: BinanceProduct,
+                           kline_interval: str) -> List[Path]:
+        archive_file_list = []
+        for path in Path(archive_dir).rglob("*.zip"):
+            match = ARCHIVE_FILE_PATTERN.match(path.name)
+            if match and match.group("symbol") == binance_product.name and match.group("interval") == kline_interval:
+                archive_file_list.append(path)
+        return sorted(archive_file_list, key=lambda p: get_archive_period(p))
+
+    def read_archive_chunks(self, zip_path: Path) -> Iterator[DataFrame]:
+        """
+        不解壓到硬碟，直接從 zip 串流讀取 csv，每次最多 chunk_rows 筆
+        """
+        with zipfile.ZipFile(zip_path) as zip_file:
+            csv_name = next(name for name in zip_file.namelist() if name.endswith(".csv"))
+            with zip_file.open(csv_name) as f:
+                # 2022 年後的檔案第一列為欄位名稱
+                has_header = not f.readline()[:1].isdigit()
+                f.seek(0)
+                for chunk_df in pd.read_csv(f, header=0 if has_header else None, usecols=[0, 1, 2, 3, 4, 5, 6, 8],
+                                            chunksize=self.chunk_rows):
+                    chunk_df.columns = KLINE_COLUMNS
+                    store_df = chunk_df.astype(KLINE_DTYPES)
+                    for column in ('start_time', 'end_time'):
+                        is_microsecond = store_df[column] >= MICROSECOND_THRESHOLD
+                        store_df.loc[is_microsecond, column] = store_df.loc[is_microsecond, column] // 1000
+                    yield store_df
+
+    def import_file(self, zip_path: Path, binance_product: BinanceProduct, kline_interval: str) -> int:
+        if not verify_checksum(zip_path):
+            raise ValueError(f"[import_file] checksum mismatch, file[{zip_path.name}]")
+        period_start_ms, period_end_ms = get_archive_period(zip_path)
+        row_count = 0
+        last_start_ms = None
+        for store_df in self.read_archive_chunks(zip_path):
+            validate_store_frame(store_df, kline_interval, period_start_ms, period_end_ms, zip_path.name)
+            if last_start_ms is not None and len(store_df) > 0 and store_df['start_time'].iloc[0] <= last_start_ms:
+                raise ValueError(f"[import_file] start_time is not increasing between chunks, file[{zip_path.name}]")
+            if len(store_df) > 0:
+                last_start_ms = store_df['start_time'].iloc[-1]
+            row_count += self.kline_store_svc.write(binance_product, kline_interval, store_df)
+        # 整個檔案驗證通過後才記錄期間為已下載
+        self.kline_store_svc.add_coverage(binance_product, kline_interval, period_start_ms,
+                                          period_end_ms - type_util.kline_interval_to_ms(kline_interval))
+        return row_count
+
+    def import_dir(self, archive_dir: str, binance_product: BinanceProduct, kline_interval: str) -> int:
+        """
+        Returns: 匯入的K棒數
+        """
+        row_count = 0
+        for zip_path in self.list_archive_files(archive_dir, binance_product, kline_interval):
+            file_row_count = self.import_file(zip_path, binance_product, kline_interval)
+            row_count += file_row_count
+            logging.info(f"[KlineArchiveImportSvc.import_dir] file[{zip_path.name}]rows[{file_row_count}]")
+        return row_count
+
+
+if __name__ == '__main__':
+    # 例: python kline_archive_import_svc.py {archive_dir} BTCUSDT 1m
+    # archive_dir 為 data.binance.vision 下載的 data/futures/um/monthly/klines/BTCUSDT/1m/*.zip 所在目錄
+    if len(sys.argv) != 4:
+        sys.exit("usage: kline_archive_import_svc.py {archive_dir} {product} {kline_interval}")
+    kline_archive_import_svc = KlineArchiveImportSvc(KlineStoreSvc())
+    print(kline_archive_import_svc.import_dir(sys.argv[1], BinanceProduct[sys.argv[2]], sys.argv[3]))
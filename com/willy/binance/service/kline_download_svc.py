@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import pandas as pd
+import requests
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc, raw_klines_to_store_frame
+from com.willy.binance.util import type_util
+
+USED_WEIGHT_HEADER = "X-MBX-USED-WEIGHT-1M"
+
+
+class KlineDownloadError(Exception):
+    """
+    shard 下載失敗 (連線錯誤、HTTP 錯誤)，原始錯誤在 __cause__
+    """
+
+    def __init__(self, message: str, start_ms: int, end_ms: int):
+        super().__init__(message)
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+
+
+class KlineThrottledError(KlineDownloadError):
+    """
+    重試 max_retries 次後仍被限流 (429/418)
+    """
+
+    def __init__(self, message: str, start_ms: int, end_ms: int, retry_after_sec: float):
+        super().__init__(message, start_ms, end_ms)
+        self.retry_after_sec = retry_after_sec
+
+
+class RequestWeightBudget:
+    """
+    Binance 每分鐘 request weight 額度，依回應 header 的已使用量校正
+    """
+
+    def __init__(self, weight_limit: int = 6000, safety_ratio: float = 0.8):
+        self.weight_limit = weight_limit
+        self.safety_ratio = safety_ratio
+        self.lock = threading.Lock()
+        self.minute = 0
+        self.used_weight = 0
+        self.blocked_until = 0.0
+
+    def acquire(self, weight: int):
+        while True:
+            with self.lock:
+                now = time.time()
+                minute = int(now // 60)
+                if minute != self.minute:
+                    self.minute = minute
+                    self.used_weight = 0
+                if now >= self.blocked_until and self.used_weight + weight <= self.weight_limit * self.safety_ratio:
+                    self.used_weight += weight
+                    return
+                wait_sec = max(self.blocked_until - now, (minute + 1) * 60 - now)
+            logging.info(f"[RequestWeightBudget.acquire] used_weight[{self.used_weight}]wait[{wait_sec:.1f}s]")
+            time.sleep(wait_sec)
+
+    def update(self, used_weight: int):
+        with self.lock:
+            if int(time.time() // 60) == self.minute:
+                self.used_weight = max(self.used_weight, used_weight)
+
+    def block(self, retry_after_sec: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + retry_after_sec)
+
+
+class KlineDownloadSvc:
+    """
+    將時間區間切成每段 bars_per_request 根K棒的 shard，以 thread pool 並行下載，依時間順序回傳
+    """
+
+    def __init__(self, base_url: str = "https://api.binance.com/api", kline_path: str = "/v3/klines",
+                 max_workers: int = 8, request_weight: int = 2, bars_per_request: int = 1000,
+                 weight_budget: Optional[RequestWeightBudget] = None, max_retries: int = 5, timeout: int = 10):
+        self.kline_url = base_url + kline_path
+        self.max_workers = max_workers
+        self.request_weight = request_weight
+        self.bars_per_request = bars_per_request
+        self.weight_budget = weight_budget if weight_budget else RequestWeightBudget()
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.thread_local = threading.local()
+        # 各 thread 建立的 session，download 結束 (thread pool 關閉) 時關閉
+        self.session_list: List[requests.Session] = []
+        self.session_lock = threading.Lock()
+
+    def split_shards(self, start_ms: int, end_ms: int, kline_interval: str) -> List[Tuple[int, int]]:
+        interval_ms = type_util.kline_interval_to_ms(kline_interval)
+        shard_ms = interval_ms * self.bars_per_request
+        shard_start_ms = type_util.floor_to_kline_interval(start_ms, kline_interval)
+        shard_list = []
+        while shard_start_ms <= end_ms:
+            shard_list.append((shard_start_ms, min(shard_start_ms + shard_ms - interval_ms, end_ms)))
+            shard_start_ms += shard_ms
+        return shard_list
+
+    def _get_session(self) -> requests.Session:
+        if not hasattr(self.thread_local, "session"):
+            self.thread_local.session = requests.Session()
+            with self.session_lock:
+                self.session_list.append(self.thread_local.session)
+        return self.thread_local.session
+
+    def close_sessions(self):
+        with self.session_lock:
+            for session in self.session_list:
+                session.close()
+            self.session_list = []
+        self.thread_local = threading.local()
+
+    def fetch_shard(self, symbol: str, kline_interval: str, start_ms: int, end_ms: int) -> list:
+        params = {"symbol": symbol, "interval": kline_interval, "startTime": start_ms, "endTime": end_ms,
+                  "limit": self.bars_per_request}
+        retry_after_sec = 0.0
+        for retry in range(self.max_retries + 1):
+            self.weight_budget.acquire(self.request_weight)
+            try:
+                response = self._get_session().get(self.kline_url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                raise KlineDownloadError(f"[KlineDownloadSvc.fetch_shard] request fail, symbol[{symbol}]"
+                                         f"range[{start_ms} - {end_ms}]", start_ms, end_ms) from e
+            if USED_WEIGHT_HEADER in response.headers:
+                self.weight_budget.update(int(response.headers[USED_WEIGHT_HEADER]))
+            # 429: 超過額度, 418: IP 被暫時封鎖
+            if response.status_code in (429, 418):
+                retry_after_sec = float(response.headers.get("Retry-After", 60))
+                logging.warning(f"[KlineDownloadSvc.fetch_shard] status[{response.status_code}]"
+                                f"retry[{retry}]retry_after[{retry_after_sec}]")
+                self.weight_budget.block(retry_after_sec)
+                continue
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                raise KlineDownloadError(f"[KlineDownloadSvc.fetch_shard] status[{response.status_code}]"
+                                         f"symbol[{symbol}]range[{start_ms} - {end_ms}]", start_ms, end_ms) from e
+            return response.json()
+        raise KlineThrottledError(f"[KlineDownloadSvc.fetch_shard] still throttled after {self.max_retries} retries,"
+                                  f" symbol[{symbol}]range[{start_ms} - {end_ms}]", start_ms, end_ms, retry_after_sec)
+
+    def download(self, binance_product: BinanceProduct, kline_interval: str, start_ms: int,
+                 end_ms: int) -> Iterator[Tuple[int, int, list]]:
+        """
+        並行下載，依 shard 時間順序 yield (shard_start_ms, shard_end_ms, klines)
+        """
+        shard_iter = iter(self.split_shards(start_ms, end_ms, kline_interval))
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                future_queue = deque()
+                try:
+                    for shard_start_ms, shard_end_ms in shard_iter:
+                        future_queue.append((shard_start_ms, shard_end_ms,
+                                             executor.submit(self.fetch_shard, binance_product.name, kline_interval,
+                                                             shard_start_ms, shard_end_ms)))
+                        # 最多預先送出 2 倍 worker 數的 shard，避免結果堆在記憶體
+                        if len(future_queue) >= self.max_workers * 2:
+                            break
+                    while len(future_queue) > 0:
+                        shard_start_ms, shard_end_ms, future = future_queue.popleft()
+                        next_shard = next(shard_iter, None)
+                        if next_shard:
+                            future_queue.append((next_shard[0], next_shard[1],
+                                                 executor.submit(self.fetch_shard, binance_product.name,
+                                                                 kline_interval, next_shard[0], next_shard[1])))
+                        yield shard_start_ms, shard_end_ms, future.result()
+                finally:
+                    # 下載失敗或呼叫端中途停止時，尚未開始的 shard 不再送出
+                    for _, _, future in future_queue:
+                        future.cancel()
+        finally:
+            self.close_sessions()
+
+    def download_to_store(self, kline_store_svc: KlineStoreSvc, binance_product: BinanceProduct,
+                          kline_interval: str, start_ms: int, end_ms: int, flush_rows: int = 100000) -> int:
+        """
+        依時間順序將下載結果分批寫入 kline store，每批寫入後更新 manifest
+
+        Returns: 下載的K棒數
+        """
+        buffer_df_list = []
+        buffer_rows = 0
+        buffer_start_ms = None
+        buffer_end_ms = None
+        download_count = 0
+        try:
+            for shard_start_ms, shard_end_ms, klines in self.download(binance_product, kline_interval, start_ms,
+                                                                      end_ms):
+                if buffer_start_ms is None:
+                    buffer_start_ms = shard_start_ms
+                buffer_end_ms = shard_end_ms
+                store_df = raw_klines_to_store_frame(klines)
+                buffer_df_list.append(store_df[store_df['start_time'] <= shard_end_ms])
+                buffer_rows += len(store_df)
+                if buffer_rows >= flush_rows or shard_end_ms >= end_ms:
+                    download_count += self._flush(kline_store_svc, binance_product, kline_interval, buffer_df_list,
+                                                  buffer_start_ms, buffer_end_ms)
+                    buffer_df_list = []
+                    buffer_rows = 0
+                    buffer_start_ms = None
+        except KlineThrottledError as e:
+            # 限流: 已依序下載完成的 shard 先寫入，之後 sync 只需下載剩下的區間
+            logging.warning(f"[KlineDownloadSvc.download_to_store] throttled at[{e.start_ms}]"
+                            f"retry_after[{e.retry_after_sec}], flush downloaded shards")
+            if buffer_start_ms is not None:
+                download_count += self._flush(kline_store_svc, binance_product, kline_interval, buffer_df_list,
+                                              buffer_start_ms, buffer_end_ms)
+            raise
+        return download_count
+
+    def _flush(self, kline_store_svc: KlineStoreSvc, binance_product: BinanceProduct, kline_interval: str,
+               buffer_df_list: List[pd.DataFrame], buffer_start_ms: int, buffer_end_ms: int) -> int:
+        write_count = kline_store_svc.write(binance_product, kline_interval,
+                                           pd.concat(buffer_df_list, ignore_index=True))
+        kline_store_svc.add_coverage(binance_product, kline_interval, buffer_start_ms, buffer_end_ms)
+        return write_count
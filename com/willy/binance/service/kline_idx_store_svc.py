@@ -0,0 +1,215 @@
+import hashlib
+import io
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_memmap_svc import KlineMemmapSvc
+from com.willy.binance.util import type_util
+
+# 指標欄位定義，依序計算 (source 需在前面定義)，修改定義後 definition hash 改變會重建檔案
+# sma: close 的移動平均; diff: source 與前一根的差; past_all: source * sign > 0 連續 window 根 (不足 window 根為 True)
+IDX_COLUMN_DEF_LIST = [
+    {"column": "ma7", "idx": "sma", "window": 7, "decimals": 2},
+    {"column": "ma6", "idx": "sma", "window": 6, "decimals": 2},
+    {"column": "ma25", "idx": "sma", "window": 25, "decimals": 2},
+    {"column": "ma99", "idx": "sma", "window": 99, "decimals": 2},
+    {"column": "ma25_diff", "idx": "diff", "source": "ma25"},
+    {"column": "past20_ma25_growth", "idx": "past_all", "source": "ma25_diff", "window": 20, "sign": 1},
+    {"column": "past20_ma25_fall", "idx": "past_all", "source": "ma25_diff", "window": 20, "sign": -1},
+]
+# 計算方式 (非定義) 改變時調整
+IDX_STORE_VERSION = 1
+
+
+def get_definition_hash() -> str:
+    definition = json.dumps({"version": IDX_STORE_VERSION, "columns": IDX_COLUMN_DEF_LIST}, sort_keys=True)
+    return hashlib.sha256(definition.encode("utf-8")).hexdigest()[:16]
+
+
+def get_idx_dtype() -> np.dtype:
+    """
+    start_time、close 用來判斷K棒是否被改寫 (補下載、未收盤K棒更新)，其餘為指標欄位
+    """
+    return np.dtype([('start_time', '<i8'), ('close', '<f8')]
+                    + [(column_def["column"], '?' if column_def["idx"] == "past_all" else '<f8')
+                       for column_def in IDX_COLUMN_DEF_LIST])
+
+
+def get_lookback_map() -> Dict[str, int]:
+    """
+    每個欄位需要往前幾根K棒才算得出正確的值
+    """
+    lookback_map = {}
+    for column_def in IDX_COLUMN_DEF_LIST:
+        if column_def["idx"] == "sma":
+            lookback_map[column_def["column"]] = column_def["window"] - 1
+        elif column_def["idx"] == "diff":
+            lookback_map[column_def["column"]] = lookback_map[column_def["source"]] + 1
+        else:
+            lookback_map[column_def["column"]] = lookback_map[column_def["source"]] + column_def["window"] - 1
+    return lookback_map
+
+
+def calc_window_sma(close: np.ndarray, window: int, decimals: int) -> np.ndarray:
+    """
+    每個視窗各自加總，結果與起算位置無關，增量重算與整段重算一致
+    (pandas rolling 為累加，剛好落在四捨五入邊界時可能與此差 1 個最小位數)
+    """
+    sma = np.full(len(close), np.nan)
+    if len(close) >= window:
+        sma[window - 1:] = np.round(sliding_window_view(close, window).sum(axis=1) / window, decimals)
+    return sma
+
+
+def calc_idx_columns(close: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    同 MovingAverageStrategy.prepare_data / backtest_ma_dca 的算法
+    """
+    column_map = {}
+    for column_def in IDX_COLUMN_DEF_LIST:
+        if column_def["idx"] == "sma":
+            values = calc_window_sma(close, column_def["window"], column_def["decimals"])
+        elif column_def["idx"] == "diff":
+            values = pd.Series(column_map[column_def["source"]]).diff().to_numpy()
+        else:
+            is_match = (pd.Series(column_map[column_def["source"]]) * column_def["sign"]) > 0
+            values = (is_match.astype(int).rolling(window=column_def["window"], min_periods=column_def["window"])
+                      .min().astype(bool).to_numpy())
+        column_map[column_def["column"]] = values
+    return column_map
+
+
+def resize_npy(path: Path, row_count: int) -> bool:
+    """
+    就地改寫一維 .npy 的 header shape 並調整檔案長度 (加長的部分補 0)，不需複製既有資料
+    新 header 長度與原本不同時 (padding 不足) 回傳 False
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            _, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            _, _, dtype = np.lib.format.read_array_header_2_0(f)
+        header_len = f.tell()
+        header = io.BytesIO()
+        header_map = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (row_count,)}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, header_map)
+        else:
+            np.lib.format.write_array_header_2_0(header, header_map)
+        if len(header.getvalue()) != header_len:
+            return False
+        f.seek(0)
+        f.write(header.getvalue())
+        f.truncate(header_len + row_count * dtype.itemsize)
+    return True
+
+
+class KlineIdxStoreSvc:
+    """
+    將 IDX_COLUMN_DEF_LIST 的指標存成 {kline_dir}/idx_{definition hash}.npy，與 ohlcv.npy 逐列對齊
+    ohlcv.npy 更新後 (同步新K棒) 只從第一根改變的K棒往前 lookback 根開始重算，並只寫入改變的部分
+    """
+
+    def __init__(self, kline_memmap_svc: KlineMemmapSvc):
+        self.kline_memmap_svc = kline_memmap_svc
+
+    def get_idx_path(self, binance_product: BinanceProduct, kline_interval: str) -> Path:
+        return (self.kline_memmap_svc.get_records_path(binance_product, kline_interval).parent
+                / f"idx_{get_definition_hash()}.npy")
+
+    def is_stale(self, binance_product: BinanceProduct, kline_interval: str, records: np.ndarray) -> bool:
+        """
+        筆數、最後一根K棒的 start_time/close 與 records 不同，或 ohlcv.npy 較新 (可能改寫中間的K棒) 時需更新
+        """
+        idx_path = self.get_idx_path(binance_product, kline_interval)
+        if not idx_path.exists():
+            return True
+        idx_records = np.load(idx_path, mmap_mode='r')
+        if len(idx_records) != len(records):
+            return True
+        if len(records) > 0 and (idx_records['start_time'][-1] != records['start_time'][-1]
+                                 or idx_records['close'][-1] != records['close'][-1]):
+            return True
+        records_path = self.kline_memmap_svc.get_records_path(binance_product, kline_interval)
+        return records_path.exists() and records_path.stat().st_mtime > idx_path.stat().st_mtime
+
+    def update(self, binance_product: BinanceProduct, kline_interval: str, records: np.ndarray) -> int:
+        """
+        在 kline store 的 manifest_lock 內，以 memmap 開啟既有指標檔，與 records 比對 start_time/close，
+        調整筆數後只從第一根不同的K棒開始重算及寫入
+
+        Returns: 重算的K棒數
+        """
+        idx_path = self.get_idx_path(binance_product, kline_interval)
+        with self.kline_memmap_svc.kline_store_svc.manifest_lock(binance_product, kline_interval):
+            if idx_path.exists():
+                old_idx_records = np.load(idx_path, mmap_mode='r')
+                same_count = min(len(old_idx_records), len(records))
+                changed_idx = np.flatnonzero(
+                    (old_idx_records['start_time'][:same_count] != records['start_time'][:same_count])
+                    | (old_idx_records['close'][:same_count] != records['close'][:same_count]))
+                first_changed_idx = int(changed_idx[0]) if len(changed_idx) > 0 else same_count
+                old_count = len(old_idx_records)
+                del old_idx_records
+            else:
+                first_changed_idx = 0
+                old_count = None
+
+            is_in_place = old_count is not None and len(records) >= old_count and (
+                len(records) == old_count or resize_npy(idx_path, len(records)))
+            if is_in_place:
+                # 只有加長時就地調整，已開啟的 memmap 仍看到原本的筆數
+                idx_records = np.lib.format.open_memmap(idx_path, mode='r+')
+            else:
+                # 新建或筆數變少 (縮短檔案會讓已開啟的 memmap 讀到檔尾外)，複製未改變的部分到新檔後 os.replace
+                idx_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = idx_path.with_name(f"{idx_path.stem}.{os.getpid()}.tmp.npy")
+                idx_records = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=get_idx_dtype(),
+                                                        shape=(len(records),))
+                if first_changed_idx > 0:
+                    idx_records[:first_changed_idx] = np.load(idx_path, mmap_mode='r')[:first_changed_idx]
+
+            idx_records['start_time'][first_changed_idx:] = records['start_time'][first_changed_idx:]
+            idx_records['close'][first_changed_idx:] = records['close'][first_changed_idx:]
+            calc_start_idx = max(first_changed_idx - max(get_lookback_map().values()), 0)
+            column_map = calc_idx_columns(np.asarray(records['close'][calc_start_idx:]))
+            for column, values in column_map.items():
+                idx_records[column][first_changed_idx:] = values[first_changed_idx - calc_start_idx:]
+            idx_records.flush()
+            del idx_records
+            if not is_in_place:
+                os.replace(tmp_path, idx_path)
+            else:
+                # 沒有K棒改變時也更新 mtime，下次 is_stale 不需再比對
+                os.utime(idx_path)
+        logging.info(f"[KlineIdxStoreSvc.update] product[{binance_product.name}]interval[{kline_interval}]"
+                     f"rows[{len(records)}]recalc[{len(records) - first_changed_idx}]")
+        return len(records) - first_changed_idx
+
+    def open(self, binance_product: BinanceProduct, kline_interval: str) -> np.ndarray:
+        records = self.kline_memmap_svc.open(binance_product, kline_interval)
+        if self.is_stale(binance_product, kline_interval, records):
+            self.update(binance_product, kline_interval, records)
+        return np.load(self.get_idx_path(binance_product, kline_interval), mmap_mode='r')
+
+    def slice(self, binance_product: BinanceProduct, kline_interval: str, start_time: datetime,
+              end_time: datetime) -> np.ndarray:
+        """
+        取出 start_time 介於 [start_time, end_time] 的指標，與 KlineMemmapSvc.slice 同範圍，回傳 memmap view
+        """
+        idx_records = self.open(binance_product, kline_interval)
+        start_idx = self.kline_memmap_svc.locate(binance_product, kline_interval, idx_records,
+                                                 type_util.datetime_to_timestamp_ms(start_time))
+        end_idx = self.kline_memmap_svc.locate(binance_product, kline_interval, idx_records,
+                                               type_util.datetime_to_timestamp_ms(end_time) + 1)
+        return idx_records[start_idx:end_idx]
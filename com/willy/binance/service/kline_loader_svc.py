@@ -0,0 +1,112 @@
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from com.willy.binance.dto.binance_kline import BinanceKline
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.binance_svc import BinanceSvc
+from com.willy.binance.service.kline_memmap_svc import records_to_kline_list, KLINE_RECORD_DTYPE
+from com.willy.binance.util import type_util
+
+
+class KlineLoaderSvc:
+    """
+    回測共用的K棒載入器，每個 (product, interval) 在記憶體保留一段連續區間
+    重疊的請求合併成聯集只撈一次，同一 key 同時只有一個撈取，其餘請求等待後直接由記憶體切片
+    """
+
+    def __init__(self, binance_svc: BinanceSvc):
+        self.binance_svc = binance_svc
+        self._lock = threading.Lock()
+        self._key_lock_map: Dict[Tuple[BinanceProduct, str], threading.Lock] = {}
+        # key -> (start_ms, end_ms, records)，整個 tuple 一起替換，讀取端不需加鎖
+        self._cache_map: Dict[Tuple[BinanceProduct, str], Tuple[int, int, np.ndarray]] = {}
+
+    def _get_key_lock(self, key: Tuple[BinanceProduct, str]) -> threading.Lock:
+        with self._lock:
+            if key not in self._key_lock_map:
+                self._key_lock_map[key] = threading.Lock()
+            return self._key_lock_map[key]
+
+    def _fetch(self, binance_product: BinanceProduct, kline_interval: str, start_ms: int, end_ms: int) -> np.ndarray:
+        records = self.binance_svc.get_historical_kline_records(
+            binance_product, kline_interval,
+            type_util.timestamp_to_datetime(start_ms / 1000, tz=timezone.utc),
+            type_util.timestamp_to_datetime(end_ms / 1000, tz=timezone.utc))
+        # 由 memmap 複製進記憶體，之後的請求不再讀檔
+        return np.array(records)
+
+    def _ensure_loaded(self, binance_product: BinanceProduct, kline_interval: str, start_ms: int,
+                       end_ms: int) -> Tuple[int, int, np.ndarray]:
+        key = (binance_product, kline_interval)
+        # 對齊K棒起始時間，避免分段撈取時漏掉邊界的K棒
+        start_ms = type_util.floor_to_kline_interval(start_ms, kline_interval)
+        # sync 只寫入已收盤的K棒，快取的結束時間以實際撈得到的最後一根為準，之後收盤的K棒才會再撈
+        end_ms = min(type_util.floor_to_kline_interval(end_ms, kline_interval),
+                     type_util.last_closed_kline_start_ms(kline_interval))
+        if start_ms > end_ms:
+            return start_ms, end_ms, np.zeros(0, dtype=KLINE_RECORD_DTYPE)
+        cache = self._cache_map.get(key)
+        if cache and cache[0] <= start_ms and end_ms <= cache[1]:
+            return cache
+        with self._get_key_lock(key):
+            # 等待期間其他請求可能已撈好
+            cache = self._cache_map.get(key)
+            if cache and cache[0] <= start_ms and end_ms <= cache[1]:
+                return cache
+            if cache is None:
+                cache = (start_ms, end_ms, self._fetch(binance_product, kline_interval, start_ms, end_ms))
+            else:
+                # 只撈聯集中尚未載入的前後兩段
+                interval_ms = type_util.kline_interval_to_ms(kline_interval)
+                cache_start_ms, cache_end_ms, records = cache
+                record_list = [records]
+                if start_ms < cache_start_ms:
+                    record_list.insert(0, self._fetch(binance_product, kline_interval, start_ms,
+                                                      cache_start_ms - interval_ms))
+                if end_ms > cache_end_ms:
+                    record_list.append(self._fetch(binance_product, kline_interval, cache_end_ms + interval_ms,
+                                                   end_ms))
+                cache = (min(start_ms, cache_start_ms), max(end_ms, cache_end_ms), np.concatenate(record_list))
+            cache[2].flags.writeable = False
+            self._cache_map[key] = cache
+            logging.info(f"[KlineLoaderSvc._ensure_loaded] product[{binance_product.name}]interval[{kline_interval}]"
+                         f"range[{cache[0]} - {cache[1]}]rows[{len(cache[2])}]")
+            return cache
+
+    def prefetch(self, range_list: List[Tuple[BinanceProduct, str, datetime, datetime]]):
+        """
+        將同 product/interval 的區間合併成聯集後一次撈取
+        """
+        union_map: Dict[Tuple[BinanceProduct, str], Tuple[int, int]] = {}
+        for binance_product, kline_interval, start_time, end_time in range_list:
+            key = (binance_product, kline_interval)
+            start_ms = type_util.datetime_to_timestamp_ms(start_time)
+            end_ms = type_util.datetime_to_timestamp_ms(end_time)
+            if key in union_map:
+                start_ms = min(start_ms, union_map[key][0])
+                end_ms = max(end_ms, union_map[key][1])
+            union_map[key] = (start_ms, end_ms)
+        for (binance_product, kline_interval), (start_ms, end_ms) in union_map.items():
+            self._ensure_loaded(binance_product, kline_interval, start_ms, end_ms)
+
+    def load(self, binance_product: BinanceProduct, kline_interval: str, start_time: datetime,
+             end_time: datetime) -> np.ndarray:
+        """
+        回傳 start_time 介於 [start_time, end_time] 的K棒 structured array (記憶體 view，不可修改)
+        """
+        start_ms = type_util.datetime_to_timestamp_ms(start_time)
+        end_ms = type_util.datetime_to_timestamp_ms(end_time)
+        _, _, records = self._ensure_loaded(binance_product, kline_interval, start_ms, end_ms)
+        start_time_array = records['start_time']
+        start_idx = np.searchsorted(start_time_array, start_ms, side='left')
+        end_idx = np.searchsorted(start_time_array, end_ms, side='right')
+        return records[start_idx:end_idx]
+
+    def load_kline_list(self, binance_product: BinanceProduct, kline_interval: str, start_time: datetime,
+                        end_time: datetime) -> List[BinanceKline]:
+        return records_to_kline_list(self.load(binance_product, kline_interval, start_time, end_time),
+                                     kline_interval)
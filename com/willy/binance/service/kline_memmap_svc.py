@@ -0,0 +1,139 @@
+import logging
+import os
+from datetime import datetime
+from decimal import Decimal
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+from com.willy.binance.dto.binance_kline import BinanceKline
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc, to_kline_frame
+from com.willy.binance.util import type_util
+
+KLINE_RECORD_DTYPE = np.dtype([('start_time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+                               ('close', '<f8'), ('vol', '<f8'), ('number_of_trade', '<i8')])
+
+
+def records_to_kline_frame(records: np.ndarray, kline_interval: str) -> DataFrame:
+    """
+    將 structured array 轉成 backtest 使用的 DataFrame (會複製資料)
+    """
+    store_df = DataFrame({name: records[name] for name in KLINE_RECORD_DTYPE.names})
+    store_df['end_time'] = store_df['start_time'] + type_util.kline_interval_to_ms(kline_interval) - 1
+    return to_kline_frame(store_df)
+
+
+def records_to_kline_list(records: np.ndarray, kline_interval: str) -> List[BinanceKline]:
+    interval_ms = type_util.kline_interval_to_ms(kline_interval)
+    start_time_list = pd.to_datetime(records['start_time'], unit='ms', utc=True).to_pydatetime()
+    end_time_list = pd.to_datetime(records['start_time'] + interval_ms - 1, unit='ms', utc=True).to_pydatetime()
+    # float 轉 Decimal 用 repr 取最短表示，避免帶入二進位誤差
+    return [BinanceKline(start_time=start_time_list[i], open=Decimal(repr(open_price)), high=Decimal(repr(high)),
+                         low=Decimal(repr(low)), close=Decimal(repr(close)), vol=Decimal(repr(vol)),
+                         end_time=end_time_list[i], number_of_trade=number_of_trade)
+            for i, (_, open_price, high, low, close, vol, number_of_trade) in enumerate(records.tolist())]
+
+
+class KlineMemmapSvc:
+    """
+    由 kline store 產生 {kline_dir}/ohlcv.npy，以 np.memmap 開啟，多個回測 process 可共用 page cache
+    """
+
+    def __init__(self, kline_store_svc: KlineStoreSvc):
+        self.kline_store_svc = kline_store_svc
+
+    def get_records_path(self, binance_product: BinanceProduct, kline_interval: str) -> Path:
+        return self.kline_store_svc.get_kline_dir(binance_product, kline_interval) / "ohlcv.npy"
+
+    def get_version_path(self, binance_product: BinanceProduct, kline_interval: str) -> Path:
+        """
+        記錄 ohlcv.npy 由哪個 store 版本 (KlineStoreSvc.get_store_version) 產生
+        """
+        return self.kline_store_svc.get_kline_dir(binance_product, kline_interval) / "ohlcv.version"
+
+    def is_stale(self, binance_product: BinanceProduct, kline_interval: str) -> bool:
+        records_path = self.get_records_path(binance_product, kline_interval)
+        version_path = self.get_version_path(binance_product, kline_interval)
+        if not records_path.exists() or not version_path.exists():
+            return True
+        return (version_path.read_text(encoding="utf-8")
+                != self.kline_store_svc.get_store_version(binance_product, kline_interval))
+
+    def build(self, binance_product: BinanceProduct, kline_interval: str) -> int:
+        """
+        在 manifest_lock 內依月份讀取 store 寫入 .npy，寫完後 os.replace，已開啟的 memmap 不受影響
+        讀取期間 partition 不會被改寫，寫入的版本與 .npy 內容一致
+
+        Returns: 資料筆數
+        """
+        records_path = self.get_records_path(binance_product, kline_interval)
+        records_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.kline_store_svc.manifest_lock(binance_product, kline_interval):
+            partition_path_list = [
+                self.kline_store_svc.get_partition_path(binance_product, kline_interval, month_key)
+                for month_key in self.kline_store_svc.list_month_keys(binance_product, kline_interval)]
+            # 先由 manifest (舊版 manifest 沒有時讀 parquet metadata) 取得總筆數，再逐月寫入，不需一次載入全部資料
+            partition_map = self.kline_store_svc.read_manifest(binance_product, kline_interval,
+                                                               use_cache=False)["partitions"]
+            row_count = sum(partition_map[path.stem]["rows"] if path.stem in partition_map
+                            else pq.ParquetFile(path).metadata.num_rows for path in partition_path_list)
+            store_version = self.kline_store_svc.get_store_version(binance_product, kline_interval)
+
+            tmp_path = records_path.with_name(f"{records_path.stem}.{os.getpid()}.tmp.npy")
+            records = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=KLINE_RECORD_DTYPE, shape=(row_count,))
+            offset = 0
+            for path in partition_path_list:
+                month_df = pd.read_parquet(path, columns=list(KLINE_RECORD_DTYPE.names))
+                for name in KLINE_RECORD_DTYPE.names:
+                    records[name][offset:offset + len(month_df)] = month_df[name].to_numpy()
+                offset += len(month_df)
+            records.flush()
+            del records
+            if offset != row_count:
+                tmp_path.unlink(missing_ok=True)
+                raise ValueError(f"[KlineMemmapSvc.build] manifest rows[{row_count}] != partition rows[{offset}], "
+                                 f"product[{binance_product.name}]interval[{kline_interval}]")
+            os.replace(tmp_path, records_path)
+            version_path = self.get_version_path(binance_product, kline_interval)
+            tmp_version_path = version_path.with_name(f"{version_path.name}.{os.getpid()}.tmp")
+            tmp_version_path.write_text(store_version, encoding="utf-8")
+            os.replace(tmp_version_path, version_path)
+        logging.info(
+            f"[KlineMemmapSvc.build] product[{binance_product.name}]interval[{kline_interval}]rows[{row_count}]")
+        return row_count
+
+    def open(self, binance_product: BinanceProduct, kline_interval: str) -> np.ndarray:
+        if self.is_stale(binance_product, kline_interval):
+            self.build(binance_product, kline_interval)
+        return np.load(self.get_records_path(binance_product, kline_interval), mmap_mode='r')
+
+    def locate(self, binance_product: BinanceProduct, kline_interval: str, records: np.ndarray,
+               timestamp_ms: int) -> int:
+        """
+        回傳第一筆 start_time >= timestamp_ms 的位置，先以 manifest 的 row_offset 直接換算，
+        換算結果與資料不符時(例如 manifest 缺少 partition 資訊)改用 searchsorted
+        """
+        start_time_array = records['start_time']
+        row_idx = self.kline_store_svc.locate_row(binance_product, kline_interval, timestamp_ms)
+        if (row_idx is not None and 0 <= row_idx <= len(records)
+                and (row_idx == len(records) or start_time_array[row_idx] >= timestamp_ms)
+                and (row_idx == 0 or start_time_array[row_idx - 1] < timestamp_ms)):
+            return row_idx
+        return int(np.searchsorted(start_time_array, timestamp_ms, side='left'))
+
+    def slice(self, binance_product: BinanceProduct, kline_interval: str, start_time: datetime,
+              end_time: datetime) -> np.ndarray:
+        """
+        取出 start_time 介於 [start_time, end_time] 的K棒，回傳 memmap view (不複製)
+        """
+        records = self.open(binance_product, kline_interval)
+        start_idx = self.locate(binance_product, kline_interval, records,
+                                type_util.datetime_to_timestamp_ms(start_time))
+        end_idx = self.locate(binance_product, kline_interval, records,
+                              type_util.datetime_to_timestamp_ms(end_time) + 1)
+        return records[start_idx:end_idx]
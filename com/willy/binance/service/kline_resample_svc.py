@@ -0,0 +1,99 @@
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from pandas import DataFrame
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc, KLINE_COLUMNS, KLINE_DTYPES, to_kline_frame
+from com.willy.binance.service.kline_sync_svc import KlineSyncSvc
+from com.willy.binance.util import type_util
+from com.willy.binance.util.bar_clock import BarClock
+
+
+def resample_store_frame(store_df: DataFrame, target_interval: str) -> DataFrame:
+    """
+    將已排序的 store 格式K棒彙總成 target_interval (open=first, high=max, low=min, close=last, vol/筆數=sum)
+    """
+    if len(store_df) == 0:
+        return store_df.iloc[0:0]
+    bar_clock = BarClock(target_interval)
+    bar_idx_array = bar_clock.to_bar_idx(store_df['start_time'].to_numpy())
+    group_start_array = np.flatnonzero(np.r_[True, bar_idx_array[1:] != bar_idx_array[:-1]])
+    group_end_array = np.r_[group_start_array[1:], len(store_df)] - 1
+    start_time_array = bar_clock.to_timestamp_ms(bar_idx_array[group_start_array])
+    return DataFrame({
+        'start_time': start_time_array,
+        'open': store_df['open'].to_numpy()[group_start_array],
+        'high': np.maximum.reduceat(store_df['high'].to_numpy(), group_start_array),
+        'low': np.minimum.reduceat(store_df['low'].to_numpy(), group_start_array),
+        'close': store_df['close'].to_numpy()[group_end_array],
+        'vol': np.add.reduceat(store_df['vol'].to_numpy(), group_start_array),
+        'end_time': start_time_array + bar_clock.interval_ms - 1,
+        'number_of_trade': np.add.reduceat(store_df['number_of_trade'].to_numpy(), group_start_array),
+    }).astype(KLINE_DTYPES)[KLINE_COLUMNS]
+
+
+class KlineResampleSvc:
+    """
+    由 kline store 中較細的K棒 (1m/5m) 彙總出較粗的K棒，結果另存於 {root_dir}/{product}/{interval}
+    """
+
+    def __init__(self, kline_store_svc: KlineStoreSvc, kline_sync_svc: Optional[KlineSyncSvc] = None,
+                 root_dir: Optional[str] = None):
+        self.kline_store_svc = kline_store_svc
+        self.kline_sync_svc = kline_sync_svc
+        self.resampled_store_svc = KlineStoreSvc(
+            root_dir if root_dir else str(Path(kline_store_svc.root_dir).parent / "kline_resampled"))
+
+    def materialize(self, binance_product: BinanceProduct, target_interval: str, start_ms: int, end_ms: int,
+                    source_interval: str) -> int:
+        """
+        彙總 [start_ms, end_ms] 中尚未產生的K棒並寫入 resampled store
+
+        Returns: 產生的K棒數
+        """
+        target_interval_ms = type_util.kline_interval_to_ms(target_interval)
+        source_interval_ms = type_util.kline_interval_to_ms(source_interval)
+        if target_interval_ms % source_interval_ms != 0:
+            raise ValueError(f"target_interval[{target_interval}] is not a multiple of "
+                             f"source_interval[{source_interval}]")
+
+        resample_count = 0
+        for missing_start_ms, missing_end_ms in self.resampled_store_svc.get_missing_ranges(binance_product,
+                                                                                           target_interval,
+                                                                                           start_ms, end_ms):
+            source_start_ms = missing_start_ms
+            source_end_ms = missing_end_ms + target_interval_ms - source_interval_ms
+            source_start_time = type_util.timestamp_to_datetime(source_start_ms / 1000, tz=timezone.utc)
+            source_end_time = type_util.timestamp_to_datetime(source_end_ms / 1000, tz=timezone.utc)
+            if self.kline_sync_svc:
+                self.kline_sync_svc.sync(binance_product, source_interval, source_start_time, source_end_time)
+            resampled_df = resample_store_frame(
+                self.kline_store_svc.read(binance_product, source_interval, source_start_ms, source_end_ms),
+                target_interval)
+            self.resampled_store_svc.write(binance_product, target_interval, resampled_df)
+            # 來源區間完整下載後才記錄為已產生，尚未收盤的K棒下次再補
+            if self.kline_store_svc.is_covered(binance_product, source_interval, source_start_time, source_end_time):
+                self.resampled_store_svc.add_coverage(binance_product, target_interval, missing_start_ms,
+                                                      missing_end_ms)
+            resample_count += len(resampled_df)
+            logging.info(f"[KlineResampleSvc.materialize] product[{binance_product.name}]"
+                         f"interval[{source_interval} -> {target_interval}]rows[{len(resampled_df)}]")
+        return resample_count
+
+    def read(self, binance_product: BinanceProduct, target_interval: str, start_time: datetime,
+             end_time: datetime, source_interval: str = "1m") -> DataFrame:
+        """
+        回傳 store 格式的 target_interval K棒
+        """
+        start_ms = type_util.datetime_to_timestamp_ms(start_time)
+        end_ms = type_util.datetime_to_timestamp_ms(end_time)
+        self.materialize(binance_product, target_interval, start_ms, end_ms, source_interval)
+        return self.resampled_store_svc.read(binance_product, target_interval, start_ms, end_ms)
+
+    def read_df(self, binance_product: BinanceProduct, target_interval: str, start_time: datetime,
+                end_time: datetime, source_interval: str = "1m") -> DataFrame:
+        return to_kline_frame(self.read(binance_product, target_interval, start_time, end_time, source_interval))
@@ -0,0 +1,466 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.util import type_util
+
+KLINE_COLUMNS = ['start_time', 'open', 'high', 'low', 'close', 'vol', 'end_time', 'number_of_trade']
+KLINE_DTYPES = {'start_time': 'int64', 'open': 'float64', 'high': 'float64', 'low': 'float64', 'close': 'float64',
+                'vol': 'float64', 'end_time': 'int64', 'number_of_trade': 'int64'}
+
+
+def get_data_dir() -> Path:
+    project_dir = str(Path.cwd().parent.parent.parent).replace("\\", "/")
+    return Path(f"{project_dir}/data")
+
+
+def to_timestamp_ms_array(values) -> np.ndarray:
+    """
+    datetime 欄位轉成 int64 epoch ms ndarray
+    """
+    if pd.api.types.is_integer_dtype(values):
+        return np.asarray(values, dtype='int64')
+    return pd.to_datetime(values, utc=True).dt.as_unit('ms').astype('int64').to_numpy()
+
+
+def to_store_frame(df: DataFrame) -> DataFrame:
+    """
+    將 kline DataFrame 轉成 store 格式: start_time/end_time 為 int64 epoch ms, OHLCV 為 float64
+    """
+    store_df = DataFrame(index=range(len(df)))
+    for column in KLINE_COLUMNS:
+        values = df[column]
+        if column in ('start_time', 'end_time'):
+            values = to_timestamp_ms_array(values)
+        store_df[column] = np.asarray(values, dtype=KLINE_DTYPES[column])
+    return store_df
+
+
+def to_kline_frame(store_df: DataFrame) -> DataFrame:
+    """
+    將 store 格式轉回 backtest 使用的格式: start_time/end_time 為 UTC datetime, number_of_trade 為 float
+    """
+    df = store_df.copy()
+    for column in ('start_time', 'end_time'):
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], unit='ms', utc=True)
+    if 'number_of_trade' in df.columns:
+        df['number_of_trade'] = df['number_of_trade'].astype(float)
+    return df
+
+
+def raw_klines_to_store_frame(klines: list) -> DataFrame:
+    """
+    將 REST API 回傳的 kline list-of-lists 轉成 store 格式
+    """
+    if len(klines) == 0:
+        return DataFrame({column: pd.Series(dtype=KLINE_DTYPES[column]) for column in KLINE_COLUMNS})
+    # 轉置後整欄轉型，不逐列解析: open time, OHLCV, close time, number of trades
+    raw_column_list = list(zip(*klines))
+    return DataFrame({column: np.array(raw_column_list[raw_idx], dtype=KLINE_DTYPES[column])
+                      for column, raw_idx in zip(KLINE_COLUMNS, (0, 1, 2, 3, 4, 5, 6, 8))})
+
+
+def raw_klines_to_kline_frame(klines: list) -> DataFrame:
+    """
+    將 REST API 回傳的 kline list-of-lists 轉成 backtest 使用的格式
+    """
+    return to_kline_frame(raw_klines_to_store_frame(klines))
+
+
+def merge_ranges(range_list: List[List[int]], interval_ms: int) -> List[List[int]]:
+    """
+    合併重疊或相鄰(相差一根K棒)的 [start_ms, end_ms] 區間
+    """
+    merged = []
+    for start_ms, end_ms in sorted(range_list):
+        if len(merged) > 0 and start_ms <= merged[-1][1] + interval_ms:
+            merged[-1][1] = max(merged[-1][1], end_ms)
+        else:
+            merged.append([start_ms, end_ms])
+    return merged
+
+
+def month_key_list(start_ms: int, end_ms: int) -> List[str]:
+    start_month = np.datetime64(start_ms, 'ms').astype('datetime64[M]')
+    end_month = np.datetime64(end_ms, 'ms').astype('datetime64[M]')
+    return [str(month) for month in np.arange(start_month, end_month + 1)]
+
+
+def file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def build_partition_info(path: Path, start_time_array: np.ndarray) -> dict:
+    return {"rows": int(len(start_time_array)), "bytes": path.stat().st_size, "sha256": file_sha256(path),
+            "start_time": int(start_time_array[0]), "end_time": int(start_time_array[-1])}
+
+
+def set_row_offsets(manifest: dict):
+    row_offset = 0
+    for month_key in sorted(manifest["partitions"]):
+        manifest["partitions"][month_key]["row_offset"] = row_offset
+        row_offset += manifest["partitions"][month_key]["rows"]
+
+
+def read_lock_info(lock_path: Path) -> Optional[dict]:
+    """
+    Returns: lock 檔內容 (host/pid/token)，lock 檔不存在時為 None，尚未寫入內容時為 {}
+    """
+    try:
+        with open(lock_path, encoding="utf-8") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        return json.loads(content) if content else {}
+    except json.JSONDecodeError:
+        return {}
+
+
+def is_pid_alive(pid: int) -> bool:
+    if os.name == "nt":
+        import ctypes
+        # PROCESS_QUERY_LIMITED_INFORMATION，STILL_ACTIVE = 259
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            # 沒有權限開啟代表 process 仍存在
+            return ctypes.windll.kernel32.GetLastError() == 5
+        exit_code = ctypes.c_ulong()
+        ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return exit_code.value == 259
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class KlineStoreSvc:
+    """
+    K 線本地儲存，依 product/interval/月份 切分成 parquet partition
+    {root_dir}/{product}/{interval}/{yyyy-mm}.parquet
+    """
+
+    def __init__(self, root_dir: Optional[str] = None, lock_timeout: int = 60):
+        self.root_dir = Path(root_dir) if root_dir else get_data_dir() / "kline"
+        self.lock_timeout = lock_timeout
+        # manifest path -> (mtime_ns, manifest)，檔案未變動時不重新解析
+        self._manifest_cache = {}
+        self._thread_lock = threading.RLock()
+
+    def get_kline_dir(self, binance_product: BinanceProduct, kline_interval: str) -> Path:
+        return self.root_dir / binance_product.name / kline_interval
+
+    def get_partition_path(self, binance_product: BinanceProduct, kline_interval: str, month_key: str) -> Path:
+        return self.get_kline_dir(binance_product, kline_interval) / f"{month_key}.parquet"
+
+    def get_manifest_path(self, binance_product: BinanceProduct, kline_interval: str) -> Path:
+        return self.get_kline_dir(binance_product, kline_interval) / "manifest.json"
+
+    def get_manifest_lock_path(self, binance_product: BinanceProduct, kline_interval: str) -> Path:
+        return self.get_kline_dir(binance_product, kline_interval) / "manifest.lock"
+
+    @contextmanager
+    def manifest_lock(self, binance_product: BinanceProduct, kline_interval: str):
+        """
+        以 O_EXCL 建立 lock 檔做跨 process 互斥，partition 與 manifest 的 read-modify-write 都在鎖內進行
+        lock 檔內容為持有者的 host/pid/token: 只有同一台主機且 pid 已結束時才視為殘留並破除，
+        釋放時 token 仍是自己的才刪除，不會刪到別人的 lock
+        """
+        lock_path = self.get_manifest_lock_path(binance_product, kline_interval)
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        token = uuid.uuid4().hex
+        with self._thread_lock:
+            deadline = time.time() + self.lock_timeout
+            while True:
+                try:
+                    fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except FileExistsError:
+                    if self._break_stale_lock(lock_path):
+                        continue
+                    if time.time() > deadline:
+                        raise TimeoutError(f"[manifest_lock] wait lock timeout, path[{lock_path}]"
+                                           f"holder[{read_lock_info(lock_path)}]")
+                    time.sleep(0.05)
+                    continue
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"host": socket.gethostname(), "pid": os.getpid(), "token": token}, f)
+                break
+            try:
+                yield
+            finally:
+                lock_info = read_lock_info(lock_path)
+                if lock_info is not None and lock_info.get("token") == token:
+                    lock_path.unlink(missing_ok=True)
+                else:
+                    logging.warning(f"[manifest_lock] lock was taken over, path[{lock_path}]holder[{lock_info}]")
+
+    def _break_stale_lock(self, lock_path: Path) -> bool:
+        """
+        持有者異常結束殘留的 lock 檔: 同一台主機且 pid 已不存在，或尚未寫入內容且超過 lock_timeout
+        先改名再確認 token，避免兩個 process 同時破除時刪到剛取得的新 lock
+
+        Returns: 是否已破除 (或 lock 檔已不存在)，True 時重新嘗試取得
+        """
+        try:
+            lock_mtime = lock_path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        lock_info = read_lock_info(lock_path)
+        if lock_info is None:
+            return True
+        if "pid" in lock_info:
+            is_stale = lock_info.get("host") == socket.gethostname() and not is_pid_alive(lock_info["pid"])
+        else:
+            # 持有者在建立後、寫入內容前結束
+            is_stale = time.time() - lock_mtime > self.lock_timeout
+        if not is_stale:
+            return False
+        broken_path = lock_path.with_name(f"{lock_path.name}.{uuid.uuid4().hex}.broken")
+        try:
+            os.rename(lock_path, broken_path)
+        except FileNotFoundError:
+            return True
+        if read_lock_info(broken_path) != lock_info:
+            # 改名前已被別人破除並重新取得，還原成原本的 lock
+            try:
+                os.link(broken_path, lock_path)
+            except FileExistsError:
+                pass
+        broken_path.unlink(missing_ok=True)
+        logging.warning(f"[manifest_lock] break stale lock, path[{lock_path}]holder[{lock_info}]")
+        return True
+
+    def read_manifest(self, binance_product: BinanceProduct, kline_interval: str, use_cache: bool = True) -> dict:
+        """
+        manifest 記錄已下載的K棒區間及各 partition 資訊
+        {
+            "ranges": [[start_ms, end_ms], ...],  start_ms/end_ms 皆為K棒開始時間(含)
+            "partitions": {yyyy-mm: {"rows", "bytes", "sha256", "start_time", "end_time", "row_offset"}}
+        }
+        row_offset 為該 partition 第一筆在所有 partition 依序串接後的位置 (即 ohlcv.npy 的 row index)
+        持有 manifest_lock 修改 manifest 時以 use_cache=False 讀取，避免 mtime 精度不足讀到舊資料
+        """
+        path = self.get_manifest_path(binance_product, kline_interval)
+        try:
+            mtime_ns = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return {"ranges": [], "partitions": {}}
+        cache = self._manifest_cache.get(path)
+        if not use_cache or cache is None or cache[0] != mtime_ns:
+            with open(path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            manifest.setdefault("partitions", {})
+            cache = (mtime_ns, manifest)
+            self._manifest_cache[path] = cache
+        return copy.deepcopy(cache[1])
+
+    def write_manifest(self, binance_product: BinanceProduct, kline_interval: str, manifest: dict):
+        path = self.get_manifest_path(binance_product, kline_interval)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+    def add_coverage(self, binance_product: BinanceProduct, kline_interval: str, start_ms: int, end_ms: int):
+        with self.manifest_lock(binance_product, kline_interval):
+            manifest = self.read_manifest(binance_product, kline_interval, use_cache=False)
+            manifest["ranges"] = merge_ranges(manifest["ranges"] + [[start_ms, end_ms]],
+                                              type_util.kline_interval_to_ms(kline_interval))
+            self.write_manifest(binance_product, kline_interval, manifest)
+
+    def refresh_partitions(self, binance_product: BinanceProduct, kline_interval: str):
+        """
+        依現有 parquet 重建 manifest 的 partition 資訊 (舊版 manifest 或手動搬移檔案後使用)
+        """
+        with self.manifest_lock(binance_product, kline_interval):
+            manifest = self.read_manifest(binance_product, kline_interval, use_cache=False)
+            manifest["partitions"] = {}
+            for month_key in self.list_month_keys(binance_product, kline_interval):
+                path = self.get_partition_path(binance_product, kline_interval, month_key)
+                month_df = pd.read_parquet(path, columns=['start_time'])
+                manifest["partitions"][month_key] = build_partition_info(path, month_df['start_time'].to_numpy())
+            set_row_offsets(manifest)
+            self.write_manifest(binance_product, kline_interval, manifest)
+
+    def verify_partitions(self, binance_product: BinanceProduct, kline_interval: str) -> List[str]:
+        """
+        Returns: sha256 與 manifest 不符的 month_key
+        """
+        partition_map = self.read_manifest(binance_product, kline_interval)["partitions"]
+        return [month_key for month_key, partition_info in partition_map.items()
+                if file_sha256(self.get_partition_path(binance_product, kline_interval, month_key))
+                != partition_info["sha256"]]
+
+    def get_data_version(self, binance_product: BinanceProduct, kline_interval: str, start_ms: int,
+                         end_ms: int) -> Optional[str]:
+        """
+        [start_ms, end_ms] 涵蓋的 partition sha256 合併後的版本，partition 內容改變時版本改變，不需讀取資料
+        有月份不在 manifest 時回傳 None
+        """
+        partition_map = self.read_manifest(binance_product, kline_interval)["partitions"]
+        sha256 = hashlib.sha256()
+        for month_key in month_key_list(start_ms, end_ms):
+            if month_key not in partition_map:
+                return None
+            sha256.update(f"{month_key}:{partition_map[month_key]['sha256']};".encode("utf-8"))
+        return sha256.hexdigest()
+
+    def get_store_version(self, binance_product: BinanceProduct, kline_interval: str) -> str:
+        """
+        所有 partition 的版本: manifest 中的 sha256 (舊版 manifest 沒有時以檔案大小/mtime 代替)
+        任一 partition 內容改變時版本改變
+        """
+        partition_map = self.read_manifest(binance_product, kline_interval)["partitions"]
+        sha256 = hashlib.sha256()
+        for month_key in self.list_month_keys(binance_product, kline_interval):
+            if month_key in partition_map:
+                partition_version = partition_map[month_key]["sha256"]
+            else:
+                stat = self.get_partition_path(binance_product, kline_interval, month_key).stat()
+                partition_version = f"{stat.st_size}:{stat.st_mtime_ns}"
+            sha256.update(f"{month_key}:{partition_version};".encode("utf-8"))
+        return sha256.hexdigest()
+
+    def locate_row(self, binance_product: BinanceProduct, kline_interval: str, timestamp_ms: int) -> Optional[int]:
+        """
+        由 manifest 計算第一筆 start_time >= timestamp_ms 的 row index (所有 partition 依序串接)
+        partition 內K棒連續時直接以K棒數換算，不需讀取資料；無法換算時回傳 None
+        """
+        partition_map = self.read_manifest(binance_product, kline_interval)["partitions"]
+        interval_ms = type_util.kline_interval_to_ms(kline_interval)
+        bar_start_ms = type_util.floor_to_kline_interval(timestamp_ms, kline_interval)
+        if bar_start_ms < timestamp_ms:
+            bar_start_ms += interval_ms
+        partition_info = partition_map.get(month_key_list(bar_start_ms, bar_start_ms)[0])
+        if partition_info is None or "row_offset" not in partition_info:
+            return None
+        if (partition_info["end_time"] - partition_info["start_time"]) // interval_ms + 1 != partition_info["rows"]:
+            return None
+        row_idx = (bar_start_ms - partition_info["start_time"]) // interval_ms
+        return partition_info["row_offset"] + min(max(row_idx, 0), partition_info["rows"])
+
+    def get_missing_ranges(self, binance_product: BinanceProduct, kline_interval: str, start_ms: int,
+                           end_ms: int) -> List[List[int]]:
+        """
+        計算 [start_ms, end_ms] 中尚未下載的K棒區間
+        """
+        interval_ms = type_util.kline_interval_to_ms(kline_interval)
+        start_ms = type_util.floor_to_kline_interval(start_ms, kline_interval)
+        end_ms = type_util.floor_to_kline_interval(end_ms, kline_interval)
+        missing_range_list = []
+        next_start_ms = start_ms
+        for covered_start_ms, covered_end_ms in self.read_manifest(binance_product, kline_interval)["ranges"]:
+            if covered_end_ms < next_start_ms:
+                continue
+            if covered_start_ms > end_ms:
+                break
+            if covered_start_ms > next_start_ms:
+                missing_range_list.append([next_start_ms, covered_start_ms - interval_ms])
+            next_start_ms = covered_end_ms + interval_ms
+        if next_start_ms <= end_ms:
+            missing_range_list.append([next_start_ms, end_ms])
+        return missing_range_list
+
+    def list_month_keys(self, binance_product: BinanceProduct, kline_interval: str) -> List[str]:
+        kline_dir = self.get_kline_dir(binance_product, kline_interval)
+        if not kline_dir.exists():
+            return []
+        return sorted(path.stem for path in kline_dir.glob("*.parquet"))
+
+    def write(self, binance_product: BinanceProduct, kline_interval: str, df: DataFrame) -> int:
+        """
+        寫入 K 線，與既有 partition 合併後以 start_time 去重(新資料優先)
+
+        Returns: 寫入的資料筆數
+        """
+        if df is None or len(df) == 0:
+            return 0
+        store_df = to_store_frame(df)
+        month_keys = store_df['start_time'].to_numpy().astype('datetime64[ms]').astype('datetime64[M]').astype(str)
+        with self.manifest_lock(binance_product, kline_interval):
+            manifest = self.read_manifest(binance_product, kline_interval, use_cache=False)
+            for month_key, month_df in store_df.groupby(month_keys, sort=True):
+                path = self.get_partition_path(binance_product, kline_interval, month_key)
+                if path.exists():
+                    month_df = pd.concat([pd.read_parquet(path), month_df], ignore_index=True)
+                month_df = (month_df.drop_duplicates(subset='start_time', keep='last')
+                            .sort_values('start_time')
+                            .reset_index(drop=True))
+                self._write_partition(path, month_df)
+                manifest["partitions"][month_key] = build_partition_info(path, month_df['start_time'].to_numpy())
+            set_row_offsets(manifest)
+            self.write_manifest(binance_product, kline_interval, manifest)
+        logging.info(f"[KlineStoreSvc.write] product[{binance_product.name}]interval[{kline_interval}]rows[{len(store_df)}]")
+        return len(store_df)
+
+    def _write_partition(self, path: Path, month_df: DataFrame):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        month_df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+    def read(self, binance_product: BinanceProduct, kline_interval: str, start_ms: int, end_ms: int,
+             columns: Optional[List[str]] = None) -> DataFrame:
+        """
+        只讀取涵蓋 [start_ms, end_ms] 的 partition 及欄位，回傳 store 格式
+        """
+        read_columns = None if columns is None else list(dict.fromkeys(['start_time'] + list(columns)))
+        filters = [('start_time', '>=', start_ms), ('start_time', '<=', end_ms)]
+        df_list = []
+        for month_key in month_key_list(start_ms, end_ms):
+            path = self.get_partition_path(binance_product, kline_interval, month_key)
+            if path.exists():
+                df_list.append(pd.read_parquet(path, columns=read_columns, filters=filters))
+        if len(df_list) == 0:
+            return DataFrame({column: pd.Series(dtype=KLINE_DTYPES[column])
+                              for column in (read_columns or KLINE_COLUMNS)})
+        return pd.concat(df_list, ignore_index=True)
+
+    def read_df(self, binance_product: BinanceProduct, kline_interval: str, start_time: datetime,
+                end_time: datetime, columns: Optional[List[str]] = None) -> DataFrame:
+        return to_kline_frame(self.read(binance_product, kline_interval,
+                                        type_util.datetime_to_timestamp_ms(start_time),
+                                        type_util.datetime_to_timestamp_ms(end_time), columns))
+
+    def is_covered(self, binance_product: BinanceProduct, kline_interval: str, start_time: datetime,
+                   end_time: datetime) -> bool:
+        return len(self.get_missing_ranges(binance_product, kline_interval,
+                                           type_util.datetime_to_timestamp_ms(start_time),
+                                           type_util.datetime_to_timestamp_ms(end_time))) == 0
+
+    def import_csv(self, binance_product: BinanceProduct, kline_interval: str, csv_path: str) -> int:
+        """
+        將舊版 {product}_{interval}.csv 快取匯入 store
+        """
+        df = pd.read_csv(csv_path, parse_dates=["start_time", "end_time"])
+        row_count = self.write(binance_product, kline_interval, df)
+        if row_count > 0:
+            store_df = to_store_frame(df)
+            self.add_coverage(binance_product, kline_interval, int(store_df['start_time'].min()),
+                              int(store_df['start_time'].max()))
+        return row_count
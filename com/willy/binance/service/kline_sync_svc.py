@@ -0,0 +1,55 @@
+import logging
+from datetime import datetime
+from typing import Optional
+
+from binance import Client
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_download_svc import KlineDownloadSvc
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc, raw_klines_to_store_frame
+from com.willy.binance.util import type_util
+
+
+class KlineSyncSvc:
+    """
+    依 manifest 計算 kline store 缺少的區間，只下載缺少的部分後合併進 store
+    """
+
+    def __init__(self, client: Client, kline_store_svc: KlineStoreSvc,
+                 kline_download_svc: Optional[KlineDownloadSvc] = None):
+        self.client = client
+        self.kline_store_svc = kline_store_svc
+        self.kline_download_svc = kline_download_svc
+
+    def sync(self, binance_product: BinanceProduct, kline_interval: str, start_time: datetime,
+             end_time: datetime) -> int:
+        """
+        Returns: 下載的K棒數
+        """
+        # 尚未收盤的K棒不寫入 store，避免之後被當成已下載
+        end_ms = min(type_util.datetime_to_timestamp_ms(end_time), type_util.last_closed_kline_start_ms(kline_interval))
+        start_ms = type_util.datetime_to_timestamp_ms(start_time)
+        if start_ms > end_ms:
+            return 0
+
+        download_count = 0
+        for missing_start_ms, missing_end_ms in self.kline_store_svc.get_missing_ranges(binance_product,
+                                                                                       kline_interval, start_ms,
+                                                                                       end_ms):
+            if self.kline_download_svc:
+                # 並行分段下載，依序寫入 store
+                download_count += self.kline_download_svc.download_to_store(self.kline_store_svc, binance_product,
+                                                                            kline_interval, missing_start_ms,
+                                                                            missing_end_ms)
+                continue
+            klines = self.client.get_historical_klines(binance_product.name, kline_interval, missing_start_ms,
+                                                       missing_end_ms)
+            store_df = raw_klines_to_store_frame(klines)
+            store_df = store_df[store_df['start_time'] <= missing_end_ms]
+            self.kline_store_svc.write(binance_product, kline_interval, store_df)
+            self.kline_store_svc.add_coverage(binance_product, kline_interval, missing_start_ms, missing_end_ms)
+            download_count += len(store_df)
+            logging.info(
+                f"[KlineSyncSvc.sync] product[{binance_product.name}]interval[{kline_interval}]"
+                f"range[{missing_start_ms} - {missing_end_ms}]rows[{len(store_df)}]")
+        return download_count
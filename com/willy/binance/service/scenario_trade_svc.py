@@ -0,0 +1,259 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from com.willy.binance.config.fee_schedule import FeeSchedule
+from com.willy.binance.dto.backtest_scenario import BacktestScenario
+from com.willy.binance.dto.scenario_backtest_res import ScenarioBacktestRes
+from com.willy.binance.dto.trade_detail import TradeDetail
+from com.willy.binance.enums.handle_fee_type import HandleFeeType
+from com.willy.binance.enums.trade_reason import TradeReasonType
+from com.willy.binance.enums.trade_type import TradeType
+from com.willy.binance.service import trade_svc
+from com.willy.binance.util import type_util
+
+FORCE_CLOSE_REASON_DESC = "爆倉"
+
+
+class ScenarioTradeSvc:
+    """
+    以同一組交易訊號一次回測多組設定 (本金/槓桿/手續費類別)，每組設定的持倉/成本/損益為 numpy 陣列的一欄
+    計算方式同 trade_svc.build_txn_detail_list (float 計算，捨入規則相同)
+
+    - 交易後的持倉依名目本金 (invest_amt * leverage) 等比例換算到各設定，單位捨去到 0.001
+    - 爆倉依各設定自己的強平價判斷；參考回測的爆倉不套用，被強平的設定等下一個訊號再建倉
+    """
+
+    def __init__(self, scenario_list: List[BacktestScenario], invest_and_guarantee_ratio: float,
+                 fee_schedule: FeeSchedule = None):
+        self.scenario_list = scenario_list
+        initial_capital = np.array([scenario.initial_capital for scenario in scenario_list], dtype='float64')
+        self.invest_amt = np.round(invest_and_guarantee_ratio * initial_capital, 2)
+        self.guarantee_amt = initial_capital - self.invest_amt
+        self.leverage = np.array([scenario.leverage for scenario in scenario_list], dtype='float64')
+        self.fee_schedule = trade_svc.get_fee_schedule(fee_schedule)
+        self.fee_ratio_map = {(handle_fee_type, trade_type):
+                                  self.fee_schedule.get_fee_rate(handle_fee_type, trade_type).rate_float
+                              for handle_fee_type in HandleFeeType for trade_type in TradeType}
+
+    def get_fee_rate(self, handle_fee_type: HandleFeeType, trade_units: np.ndarray) -> np.ndarray:
+        """
+        各設定的費率，trade_units > 0 為買入、否則為賣出
+        """
+        handle_fee_type_list = [scenario.handle_fee_type or handle_fee_type for scenario in self.scenario_list]
+        return np.where(trade_units > 0,
+                        [self.fee_ratio_map[(fee_type, TradeType.BUY)] for fee_type in handle_fee_type_list],
+                        [self.fee_ratio_map[(fee_type, TradeType.SELL)] for fee_type in handle_fee_type_list])
+
+    def calc_force_close_offset_price(self, handle_amt: np.ndarray, handle_fee: np.ndarray,
+                                      units: np.ndarray) -> np.ndarray:
+        """
+        同 trade_svc.calc_force_close_offset_price(-(invest_amt + guarantee_amt), ...)，空倉為 NaN
+        """
+        return trade_svc.calc_force_close_offset_price_batch(-(self.invest_amt + self.guarantee_amt), handle_amt,
+                                                             handle_fee, units, HandleFeeType.TAKER,
+                                                             fee_schedule=self.fee_schedule)
+
+    def trade(self, price: float, trade_units: np.ndarray, fee_rate: np.ndarray, buy_fee_rate: np.ndarray,
+              units: np.ndarray, handle_amt: np.ndarray, handle_fee: np.ndarray):
+        """
+        trade_units > 0 買入，< 0 賣出，回傳 (units, handle_amt, handle_fee, profit)
+
+        Args:
+            fee_rate: 本次交易方向的費率
+            buy_fee_rate: 買入費率，部分賣出平多倉時以此計算建倉手續費 (同 trade_svc.build_txn_detail_list)
+        """
+        unit = np.abs(trade_units)
+        is_buy = trade_units > 0
+        is_sell = trade_units < 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg_amt = handle_amt / units
+            avg_fee = handle_fee / units
+            new_units = units + trade_units
+            # 同向加碼
+            is_open = (is_buy & (units >= 0)) | (is_sell & (units <= 0))
+            open_amt = handle_amt + price * unit
+            open_fee = handle_fee + trade_svc.calc_handle_fee_batch(price, unit, fee_rate=fee_rate)
+            # 反向交易超過原持倉: 全部平倉後以剩餘單位建倉
+            is_reverse = ~is_open & (is_buy | is_sell) & (unit > np.abs(units))
+            reverse_profit = trade_svc.calc_profit_batch(price, handle_amt, handle_fee, units, fee_rate=fee_rate)
+            reverse_amt = np.abs(price * new_units)
+            reverse_fee = np.abs(trade_svc.calc_handle_fee_batch(price, new_units, fee_rate=fee_rate))
+            # 部分平倉: 成本按比例分攤
+            is_partial = ~is_open & ~is_reverse & (is_buy | is_sell)
+            partial_amt = avg_amt * new_units
+            partial_fee = avg_fee * new_units
+            partial_profit = np.where(
+                is_buy,
+                trade_svc.calc_profit_batch(price, -(avg_amt * unit), handle_fee - partial_fee, -unit,
+                                            fee_rate=fee_rate),
+                trade_svc.calc_profit_batch(price, avg_amt * unit,
+                                            trade_svc.calc_handle_fee_batch(avg_amt, unit, fee_rate=buy_fee_rate),
+                                            unit, fee_rate=fee_rate))
+
+        new_amt = np.select([is_open, is_reverse, is_partial], [open_amt, reverse_amt, partial_amt], handle_amt)
+        new_fee = np.select([is_open, is_reverse, is_partial], [open_fee, reverse_fee, partial_fee], handle_fee)
+        profit = np.select([is_reverse, is_partial], [reverse_profit, partial_profit], 0.0)
+        return new_units, new_amt, new_fee, profit
+
+    def backtest(self, start_time_array: np.ndarray, low_array: np.ndarray, high_array: np.ndarray,
+                 close_array: np.ndarray, trade_detail: TradeDetail,
+                 reference_notional: float) -> List[ScenarioBacktestRes]:
+        """
+        依參考回測的交易紀錄一次算出所有設定的 ledger 及績效
+
+        Args:
+            start_time_array: K棒開始時間 (epoch ms)
+            trade_detail: 參考回測的交易紀錄 (sparse/dense 皆可，只取有交易的紀錄)
+            reference_notional: 參考回測的名目本金 (invest_amt * leverage)
+        """
+        bar_count = len(start_time_array)
+        scenario_count = len(self.scenario_list)
+        scale = self.invest_amt * self.leverage / reference_notional
+
+        event_list = []
+        for txn_detail in trade_detail.txn_detail_list:
+            trade_record = txn_detail.trade_record
+            if trade_record is None or (trade_record.reason and
+                                        trade_record.reason.trade_reason_type == TradeReasonType.PASSIVE and
+                                        trade_record.reason.desc == FORCE_CLOSE_REASON_DESC):
+                continue
+            bar_idx = int(np.searchsorted(start_time_array, type_util.datetime_to_timestamp_ms(txn_detail.date),
+                                          side='right')) - 1
+            event_list.append((max(bar_idx, 0), txn_detail))
+
+        units = np.zeros(scenario_count)
+        handle_amt = np.zeros(scenario_count)
+        handle_fee = np.zeros(scenario_count)
+        total_profit = np.zeros(scenario_count)
+        total_handling_fee = np.zeros(scenario_count)
+        taker_buy_fee_rate = self.fee_ratio_map[(HandleFeeType.TAKER, TradeType.BUY)]
+        taker_sell_fee_rate = self.fee_ratio_map[(HandleFeeType.TAKER, TradeType.SELL)]
+        # 每個事件兩列: 交易後狀態、爆倉後狀態 (沒爆倉時同交易後)
+        row_bar_list, row_trade_units_list, row_price_list = [], [], []
+        row_state_list = []
+
+        def liquidate(segment_start_idx: int, segment_end_idx: int):
+            """
+            持倉在 [segment_start_idx, segment_end_idx) 不變，各設定以 running min/max 找第一根爆倉K棒
+            """
+            nonlocal units, handle_amt, handle_fee, total_profit, total_handling_fee
+            liquidate_bar = np.full(scenario_count, segment_start_idx)
+            trade_units = np.zeros(scenario_count)
+            force_close_price = self.calc_force_close_offset_price(handle_amt, handle_fee, units)
+            if segment_end_idx > segment_start_idx and np.any(units != 0):
+                running_min = np.minimum.accumulate(low_array[segment_start_idx:segment_end_idx])
+                running_max = np.maximum.accumulate(high_array[segment_start_idx:segment_end_idx])
+                long_idx = np.searchsorted(-running_min, -np.nan_to_num(force_close_price, nan=-np.inf),
+                                           side='right')
+                short_idx = np.searchsorted(running_max, np.nan_to_num(force_close_price, nan=np.inf), side='right')
+                hit_idx = np.where(units > 0, long_idx, np.where(units < 0, short_idx, len(running_min)))
+                is_hit = hit_idx < len(running_min)
+                if np.any(is_hit):
+                    liquidate_bar = np.where(is_hit, segment_start_idx + hit_idx, segment_start_idx)
+                    trade_units = np.where(is_hit, -units, 0.0)
+                    price = np.where(is_hit, force_close_price, 0.0)
+                    # 強平以 taker 平倉: 多倉賣出、空倉買入
+                    fee_rate = np.where(units > 0, taker_sell_fee_rate, taker_buy_fee_rate)
+                    _, _, _, profit = self.trade(price, trade_units, fee_rate, taker_buy_fee_rate, units,
+                                                 handle_amt, handle_fee)
+                    total_handling_fee = total_handling_fee + np.where(
+                        is_hit, trade_svc.calc_handle_fee_batch(price, np.abs(units), fee_rate=fee_rate), 0.0)
+                    total_profit = total_profit + np.where(is_hit, profit, 0.0)
+                    units = np.where(is_hit, 0.0, units)
+                    handle_amt = np.where(is_hit, 0.0, handle_amt)
+                    handle_fee = np.where(is_hit, 0.0, handle_fee)
+                    row_price_list.append(price)
+                else:
+                    row_price_list.append(np.zeros(scenario_count))
+            else:
+                row_price_list.append(np.zeros(scenario_count))
+            row_bar_list.append(liquidate_bar)
+            row_trade_units_list.append(trade_units)
+            row_state_list.append((units, handle_amt, handle_fee, total_profit))
+
+        for event_idx, (bar_idx, txn_detail) in enumerate(event_list):
+            trade_record = txn_detail.trade_record
+            price = float(trade_record.price)
+            # 交易後持倉等比例換算，單位捨去到 0.001
+            target_units = np.trunc(np.round(float(txn_detail.units) * scale * 1000, 6)) / 1000
+            trade_units = np.round(target_units - units, 3)
+            fee_rate = self.get_fee_rate(trade_record.handle_fee_type, trade_units)
+            total_handling_fee += trade_svc.calc_handle_fee_batch(price, np.abs(trade_units), fee_rate=fee_rate)
+            buy_fee_rate = self.get_fee_rate(trade_record.handle_fee_type, np.ones(scenario_count))
+            units, handle_amt, handle_fee, profit = self.trade(price, trade_units, fee_rate, buy_fee_rate, units,
+                                                               handle_amt, handle_fee)
+            units = np.round(units, 3)
+            total_profit = total_profit + profit
+            row_bar_list.append(np.full(scenario_count, bar_idx))
+            row_trade_units_list.append(trade_units)
+            row_price_list.append(np.full(scenario_count, price))
+            row_state_list.append((units, handle_amt, handle_fee, total_profit))
+
+            # 交易後到下一個事件前的爆倉 (含本K棒)
+            next_bar_idx = event_list[event_idx + 1][0] if event_idx + 1 < len(event_list) else bar_count
+            liquidate(bar_idx, next_bar_idx)
+
+        return self.build_res_list(start_time_array, close_array, event_list, row_bar_list, row_trade_units_list,
+                                   row_price_list, row_state_list, total_handling_fee)
+
+    def build_res_list(self, start_time_array, close_array, event_list, row_bar_list, row_trade_units_list,
+                       row_price_list, row_state_list, total_handling_fee) -> List[ScenarioBacktestRes]:
+        bar_count = len(start_time_array)
+        scenario_count = len(self.scenario_list)
+        row_count = len(row_bar_list)
+        # (row, scenario) 矩陣，最前面補一列尚未交易的空持倉
+        row_bar = np.vstack([np.full(scenario_count, -1)] + row_bar_list) if row_count else np.full(
+            (1, scenario_count), -1)
+        row_trade_units = np.vstack([np.zeros(scenario_count)] + row_trade_units_list) if row_count else np.zeros(
+            (1, scenario_count))
+        row_price = np.vstack([np.zeros(scenario_count)] + row_price_list) if row_count else np.zeros(
+            (1, scenario_count))
+        state_matrix_list = [np.vstack([np.zeros(scenario_count)] + [state[field_idx] for state in row_state_list])
+                             if row_count else np.zeros((1, scenario_count)) for field_idx in range(4)]
+        row_units, row_amt, row_fee, row_total_profit = state_matrix_list
+        # 每個事件兩列 (交易後、爆倉後)，補上第 0 列後偶數列 (> 0) 為爆倉列
+        is_force_close_row = (np.arange(len(row_bar)) % 2 == 0) & (np.arange(len(row_bar)) > 0)
+        row_reason = [None] + [FORCE_CLOSE_REASON_DESC if row_idx % 2 == 1 else
+                               getattr(event_list[row_idx // 2][1].trade_record.reason, 'desc',
+                                       event_list[row_idx // 2][1].trade_record.reason)
+                               for row_idx in range(row_count)]
+        row_reason = np.array(row_reason, dtype=object)
+        bar_idx_array = np.arange(bar_count)
+
+        res_list = []
+        for scenario_idx, scenario in enumerate(self.scenario_list):
+            # 每根K棒對應到最後一列狀態
+            state_idx = np.searchsorted(row_bar[:, scenario_idx], bar_idx_array, side='right') - 1
+            units = row_units[state_idx, scenario_idx]
+            unrealized_profit = np.nan_to_num(
+                trade_svc.calc_profit_batch(close_array, row_amt[state_idx, scenario_idx],
+                                            row_fee[state_idx, scenario_idx], units, HandleFeeType.TAKER,
+                                            fee_schedule=self.fee_schedule))
+            equity = row_total_profit[state_idx, scenario_idx] + unrealized_profit
+            equity_df = pd.DataFrame({'start_time': start_time_array, 'units': units, 'total_profit': equity})
+
+            is_trade_row = row_trade_units[:, scenario_idx] != 0
+            ledger_bar = row_bar[is_trade_row, scenario_idx]
+            ledger_trade_units = row_trade_units[is_trade_row, scenario_idx]
+            ledger_df = pd.DataFrame({
+                'start_time': start_time_array[ledger_bar] if len(ledger_bar) else np.array([], dtype='int64'),
+                'trade_type': np.where(ledger_trade_units > 0, TradeType.BUY.name, TradeType.SELL.name),
+                'price': row_price[is_trade_row, scenario_idx],
+                'unit': np.abs(ledger_trade_units),
+                'units': row_units[is_trade_row, scenario_idx],
+                'handle_amt': row_amt[is_trade_row, scenario_idx],
+                'handling_fee': row_fee[is_trade_row, scenario_idx],
+                'total_profit': row_total_profit[is_trade_row, scenario_idx],
+                'reason': row_reason[is_trade_row]})
+
+            capital_curve = scenario.initial_capital + equity
+            max_drawdown = float(np.max(np.maximum.accumulate(capital_curve) - capital_curve)) if bar_count else 0.0
+            res_list.append(ScenarioBacktestRes(scenario, ledger_df, equity_df,
+                                                int(np.count_nonzero(is_trade_row)),
+                                                int(np.count_nonzero(is_trade_row & is_force_close_row)),
+                                                float(total_handling_fee[scenario_idx]),
+                                                float(equity[-1]) if bar_count else 0.0,
+                                                max_drawdown))
+        return res_list
@@ -0,0 +1,171 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+
+class RollingMean:
+    """
+    以 ring buffer + running sum 逐根K棒計算移動平均，同 tech_idx_svc.append_ma (rolling mean 後 round)
+    peek 只試算下一個值不改變狀態，push 才放入 buffer
+    """
+
+    def __init__(self, window: int, decimals: int = 2):
+        self.window = window
+        self.decimals = decimals
+        self.buffer = np.zeros(window)
+        self.idx = 0
+        self.count = 0
+        self.total = 0.0
+
+    def peek(self, value: float) -> float:
+        if self.count + 1 < self.window:
+            return np.nan
+        total = self.total + value - (self.buffer[self.idx] if self.count >= self.window else 0.0)
+        return float(np.round(total / self.window, self.decimals))
+
+    def push(self, value: float):
+        if self.count >= self.window:
+            self.total -= self.buffer[self.idx]
+        self.buffer[self.idx] = value
+        self.total += value
+        self.idx = (self.idx + 1) % self.window
+        self.count += 1
+        if self.idx == 0:
+            # 每繞一圈重算一次總和，避免 running sum 累積誤差
+            self.total = math.fsum(self.buffer)
+
+
+class RollingAllTrue:
+    """
+    過去 window 根是否都為 True，同 pandas flag.astype(int).rolling(window, min_periods=window).min().astype(bool)
+    (不足 window 根時 rolling 結果為 NaN，astype(bool) 為 True)
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.buffer = np.zeros(window, dtype=bool)
+        self.idx = 0
+        self.count = 0
+        self.true_count = 0
+
+    def peek(self, flag: bool) -> bool:
+        if self.count + 1 < self.window:
+            return True
+        true_count = self.true_count + flag - (self.buffer[self.idx] if self.count >= self.window else 0)
+        return bool(true_count == self.window)
+
+    def push(self, flag: bool):
+        if self.count >= self.window:
+            self.true_count -= self.buffer[self.idx]
+        self.buffer[self.idx] = flag
+        self.true_count += flag
+        self.idx = (self.idx + 1) % self.window
+        self.count += 1
+
+
+class SignStreak:
+    """
+    同號連續期數 (正為連續 > 0，負為連續 < 0)，同 MovingAverageStrategy.prepare_data 的 ma7_and_ma25_rel:
+    sign 為 0 時重置，NaN 時輸出 0 但不重置
+    """
+
+    def __init__(self):
+        self.current_len = 0
+        self.current_sign = 0
+
+    def calc(self, sign: float):
+        """
+        Returns: (輸出值, current_len, current_sign)
+        """
+        if sign == 0:
+            return 0, 0, 0
+        if np.isnan(sign):
+            return 0, self.current_len, self.current_sign
+        if sign == self.current_sign:
+            current_len = self.current_len + 1
+        else:
+            current_len = 1
+        return current_len * int(sign), current_len, sign
+
+    def peek(self, sign: float) -> int:
+        return self.calc(sign)[0]
+
+    def push(self, sign: float):
+        _, self.current_len, self.current_sign = self.calc(sign)
+
+
+class MaCrossIdxStream:
+    """
+    MovingAverageStrategy 的指標 (ma7/ma6/ma25、ma25_diff、past20_ma25_growth/fall、ma7_and_ma25_rel) 逐根更新版
+    先以歷史K棒 seed，之後每根收盤K棒 update 一次 (O(1))，未收盤的K棒用 peek 試算
+    """
+
+    def __init__(self):
+        self.ma7 = RollingMean(7)
+        self.ma6 = RollingMean(6)
+        self.ma25 = RollingMean(25)
+        self.past20_ma25_growth = RollingAllTrue(20)
+        self.past20_ma25_fall = RollingAllTrue(20)
+        self.ma7_and_ma25_rel = SignStreak()
+        self.last_ma25 = np.nan
+        self.last_ma7_and_ma25_rel = np.nan
+        # 最後一根已 update 的K棒開始時間
+        self.last_start_time = None
+
+    def calc(self, close: float, is_commit: bool) -> dict:
+        close = float(close)
+        ma7 = self.ma7.peek(close)
+        ma6 = self.ma6.peek(close)
+        ma25 = self.ma25.peek(close)
+        ma25_diff = ma25 - self.last_ma25
+        # NaN 比較為 False，同 pandas
+        is_growth = bool(ma25_diff > 0)
+        is_fall = bool(ma25_diff < 0)
+        ma_sign = np.sign(ma7 - ma25)
+        idx_map = {'ma7': ma7, 'ma6': ma6, 'ma25': ma25, 'ma25_diff': ma25_diff,
+                   'past20_ma25_growth': self.past20_ma25_growth.peek(is_growth),
+                   'past20_ma25_fall': self.past20_ma25_fall.peek(is_fall),
+                   'ma7_and_ma25_rel': self.ma7_and_ma25_rel.peek(ma_sign),
+                   'last_ma7_and_ma25_rel': self.last_ma7_and_ma25_rel}
+        if is_commit:
+            self.ma7.push(close)
+            self.ma6.push(close)
+            self.ma25.push(close)
+            self.past20_ma25_growth.push(is_growth)
+            self.past20_ma25_fall.push(is_fall)
+            self.ma7_and_ma25_rel.push(ma_sign)
+            self.last_ma25 = ma25
+            self.last_ma7_and_ma25_rel = idx_map['ma7_and_ma25_rel']
+        return idx_map
+
+    def update(self, kline: pd.Series) -> pd.Series:
+        """
+        放入一根收盤K棒，回傳含指標的列
+        """
+        self.check_start_time(kline.start_time)
+        idx_map = self.calc(kline.close, True)
+        self.last_start_time = kline.start_time
+        return pd.concat([kline, pd.Series(idx_map)])
+
+    def check_start_time(self, start_time):
+        """
+        K棒需依 start_time 遞增放入，重複或較舊的K棒會被重複計入 ring buffer
+        """
+        if self.last_start_time is not None and start_time <= self.last_start_time:
+            raise ValueError(f"kline start_time[{start_time}] <= last_start_time[{self.last_start_time}]")
+
+    def peek(self, kline: pd.Series) -> pd.Series:
+        """
+        以尚未收盤的K棒試算指標，不改變狀態
+        """
+        return pd.concat([kline, pd.Series(self.calc(kline.close, False))])
+
+    def seed(self, df: pd.DataFrame):
+        """
+        以歷史K棒 (依 start_time 排序) 初始化，start_time 不可重複或早於已放入的K棒
+        """
+        for kline in df.itertuples(index=False):
+            self.check_start_time(kline.start_time)
+            self.calc(kline.close, True)
+            self.last_start_time = kline.start_time
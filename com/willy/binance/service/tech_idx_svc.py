@@ -1,6 +1,251 @@
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service import kline_store_svc
+
+# 指標名稱 -> 計算函式 (kline_df, **params)，以 register_idx 註冊
+IDX_FUNC_MAP: Dict[str, Callable] = {}
+# 指標名稱 -> 預設使用的欄位 (有 column 參數時改用該欄位)，data version 只計算用到的欄位
+IDX_SOURCE_COLUMN_MAP: Dict[str, List[str]] = {}
+# kline_df.attrs 中 store 的資料版本 (KlineStoreSvc.get_data_version)，有此版本時不需重新 hash 資料
+DATA_VERSION_ATTR = 'kline_data_version'
+# 筆數少於此值的K棒 (例如實盤 lookback 視窗) 直接計算不快取，避免每個視窗都新增一筆用不到的快取
+IDX_CACHE_MIN_ROWS = 1000
+# 快取上限 (bytes)，超過時淘汰最久未使用的指標
+IDX_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def register_idx(idx_name: str, source_column_list: List[str] = None):
+    def decorator(func: Callable):
+        IDX_FUNC_MAP[idx_name] = func
+        IDX_SOURCE_COLUMN_MAP[idx_name] = source_column_list or ['close']
+        return func
+
+    return decorator
+
+
+def get_data_version(kline_df: pd.DataFrame, column_list: List[str]) -> tuple:
+    """
+    K棒資料版本: (筆數, 第一根/最後一根 start_time, 資料版本)
+    資料版本優先取 kline_df.attrs 中 store 的版本，沒有時為 column_list 欄位的 crc32
+    """
+    if len(kline_df) == 0:
+        return 0, None, None, 0
+    start_time_array = kline_store_svc.to_timestamp_ms_array(kline_df['start_time'].iloc[[0, -1]])
+    store_version = kline_df.attrs.get(DATA_VERSION_ATTR)
+    if store_version:
+        return len(kline_df), int(start_time_array[0]), int(start_time_array[-1]), store_version
+    checksum = 0
+    for column in column_list:
+        checksum = zlib.crc32(np.ascontiguousarray(kline_df[column].to_numpy(dtype='float64')), checksum)
+    return len(kline_df), int(start_time_array[0]), int(start_time_array[-1]), checksum
+
+
+class IdxCache:
+    """
+    指標快取，key 為 (商品, K棒週期, data version, 指標名稱, 參數)
+    快取的陣列為唯讀，同一個 process 內參數最佳化或多個策略共用同一段K棒的指標時只算一次
+    """
+
+    def __init__(self, max_bytes: int = IDX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.idx_map = OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def get(self, key: tuple, calc: Callable):
+        if key in self.idx_map:
+            self.idx_map.move_to_end(key)
+            self.hit_count += 1
+            return self.idx_map[key]
+        self.miss_count += 1
+        value = calc()
+        array_list = value if isinstance(value, tuple) else (value,)
+        for array in array_list:
+            array.setflags(write=False)
+        self.idx_map[key] = value
+        self.total_bytes += sum(array.nbytes for array in array_list)
+        while self.total_bytes > self.max_bytes and len(self.idx_map) > 1:
+            _, evicted = self.idx_map.popitem(last=False)
+            self.total_bytes -= sum(array.nbytes for array in (evicted if isinstance(evicted, tuple) else (evicted,)))
+        return value
+
+    def clear(self):
+        self.idx_map.clear()
+        self.total_bytes = 0
+
+
+idx_cache = IdxCache()
+
+
+def get_idx(kline_df: pd.DataFrame, idx_name: str, binance_product: BinanceProduct | None = None,
+            kline_interval: str | None = None, data_version: tuple | None = None, **params):
+    """
+    計算 IDX_FUNC_MAP 中的指標，有給商品及K棒週期且筆數 >= IDX_CACHE_MIN_ROWS 時經由 idx_cache 快取
+    data_version 為 None 時以 get_data_version 計算，呼叫端已知版本時可直接傳入
+
+    Returns: 與 kline_df 等長的 float64 陣列 (多條線的指標為 tuple)，快取的陣列為唯讀
+    """
+    idx_func = IDX_FUNC_MAP[idx_name]
+    if binance_product is None or kline_interval is None or len(kline_df) < IDX_CACHE_MIN_ROWS:
+        return idx_func(kline_df, **params)
+    if data_version is None:
+        column_list = [params['column']] if 'column' in params else IDX_SOURCE_COLUMN_MAP[idx_name]
+        data_version = get_data_version(kline_df, column_list)
+    key = (binance_product, kline_interval, data_version, idx_name, tuple(sorted(params.items())))
+    return idx_cache.get(key, lambda: idx_func(kline_df, **params))
+
+
+def round_idx(values: pd.Series, decimals: int | None) -> np.ndarray:
+    if decimals is not None:
+        values = values.round(decimals)
+    return values.to_numpy(dtype='float64')
+
+
+@register_idx('sma')
+def calc_sma(kline_df: pd.DataFrame, window: int, decimals: int | None = None, column: str = 'close') -> np.ndarray:
+    return round_idx(kline_df[column].astype('float64').rolling(window=window, min_periods=window).mean(), decimals)
+
+
+@register_idx('ema')
+def calc_ema(kline_df: pd.DataFrame, window: int, decimals: int | None = None, column: str = 'close') -> np.ndarray:
+    """
+    alpha = 2 / (window + 1)，前 window - 1 根為 NaN
+    """
+    return round_idx(kline_df[column].astype('float64').ewm(span=window, adjust=False, min_periods=window).mean(),
+                     decimals)
+
+
+@register_idx('wma')
+def calc_wma(kline_df: pd.DataFrame, window: int, decimals: int | None = None, column: str = 'close') -> np.ndarray:
+    """
+    線性加權，最新一根權重為 window
+    """
+    values = kline_df[column].to_numpy(dtype='float64')
+    wma = np.full(len(values), np.nan)
+    if len(values) >= window:
+        weights = np.arange(1, window + 1, dtype='float64')
+        wma[window - 1:] = sliding_window_view(values, window) @ weights / weights.sum()
+    return round_idx(pd.Series(wma), decimals)
+
+
+@register_idx('rsi')
+def calc_rsi(kline_df: pd.DataFrame, window: int = 14, decimals: int | None = None,
+             column: str = 'close') -> np.ndarray:
+    """
+    Wilder RSI (平均漲跌幅以 alpha = 1 / window 平滑)
+    """
+    diff = kline_df[column].astype('float64').diff()
+    avg_gain = diff.clip(lower=0).ewm(alpha=1 / window, adjust=False, min_periods=window).mean()
+    avg_loss = (-diff).clip(lower=0).ewm(alpha=1 / window, adjust=False, min_periods=window).mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi = 100 - 100 / (1 + avg_gain / avg_loss)
+    # 期間內沒有下跌時為 100
+    rsi = rsi.where(avg_loss != 0, 100.0).where(avg_gain.notna())
+    return round_idx(rsi, decimals)
+
+
+@register_idx('atr', ['high', 'low', 'close'])
+def calc_atr(kline_df: pd.DataFrame, window: int = 14, decimals: int | None = None) -> np.ndarray:
+    """
+    Wilder ATR，第一根K棒的 true range 為 high - low
+    """
+    high = kline_df['high'].astype('float64')
+    low = kline_df['low'].astype('float64')
+    prev_close = kline_df['close'].astype('float64').shift(1)
+    true_range = pd.concat([high - low, (high - prev_close).abs(), (low - prev_close).abs()], axis=1).max(axis=1)
+    return round_idx(true_range.ewm(alpha=1 / window, adjust=False, min_periods=window).mean(), decimals)
+
+
+@register_idx('std')
+def calc_rolling_std(kline_df: pd.DataFrame, window: int, ddof: int = 0, decimals: int | None = None,
+                     column: str = 'close') -> np.ndarray:
+    return round_idx(kline_df[column].astype('float64').rolling(window=window, min_periods=window).std(ddof=ddof),
+                     decimals)
+
+
+@register_idx('volatility')
+def calc_volatility(kline_df: pd.DataFrame, window: int, annualize_bars: int | None = None,
+                    column: str = 'close') -> np.ndarray:
+    """
+    對數報酬率的滾動標準差，annualize_bars 為一年的K棒數 (例 15m 為 35040)，有給時年化
+    """
+    log_return = np.log(kline_df[column].astype('float64')).diff()
+    volatility = log_return.rolling(window=window, min_periods=window).std(ddof=1)
+    if annualize_bars:
+        volatility = volatility * np.sqrt(annualize_bars)
+    return volatility.to_numpy(dtype='float64')
+
+
+@register_idx('bollinger')
+def calc_bollinger(kline_df: pd.DataFrame, window: int = 20, num_std: float = 2, decimals: int | None = None,
+                   column: str = 'close') -> tuple:
+    """
+    Returns: (中軌, 上軌, 下軌)，標準差為母體標準差
+    """
+    close = kline_df[column].astype('float64')
+    mid = close.rolling(window=window, min_periods=window).mean()
+    std = close.rolling(window=window, min_periods=window).std(ddof=0)
+    return round_idx(mid, decimals), round_idx(mid + num_std * std, decimals), round_idx(mid - num_std * std,
+                                                                                         decimals)
+
+
+@register_idx('rolling_high', ['high'])
+def calc_rolling_high(kline_df: pd.DataFrame, window: int, column: str = 'high') -> np.ndarray:
+    return kline_df[column].astype('float64').rolling(window=window, min_periods=window).max().to_numpy()
+
+
+@register_idx('rolling_low', ['low'])
+def calc_rolling_low(kline_df: pd.DataFrame, window: int, column: str = 'low') -> np.ndarray:
+    return kline_df[column].astype('float64').rolling(window=window, min_periods=window).min().to_numpy()
+
+
+def append_ma(kline_df: pd.DataFrame, interval: int, binance_product: BinanceProduct | None = None,
+              kline_interval: str | None = None):
+    kline_df['ma' + str(interval)] = get_idx(kline_df, 'sma', binance_product, kline_interval, window=interval,
+                                             decimals=2).copy()
+
+
+def calc_sign_streak(sign, is_zero_reset: bool = True) -> np.ndarray:
+    """
+    同號連續期數 (正為連續 > 0 的期數，負為連續 < 0 的期數)，以號變化處切群組後 cumsum 計算，不逐筆迴圈
+
+    Args:
+        sign: 1 / 0 / -1 / NaN
+        is_zero_reset: True 時同 MovingAverageStrategy 的 ma7_and_ma25_rel: 0 重置為 0，NaN 輸出 0 但不中斷連續期數
+                       False 時同 ma_dca_strategy.calc_ma7_and_ma25_rel: 0 / NaN 沿用前一期的值且不中斷連續期數
+    """
+    sign = np.asarray(sign, dtype='float64')
+    streak = np.zeros(len(sign), dtype='int64')
+    is_counted = ~np.isnan(sign) if is_zero_reset else (~np.isnan(sign) & (sign != 0))
+    counted_sign = sign[is_counted]
+    if len(counted_sign) == 0:
+        return streak
+    is_run_start = np.r_[True, counted_sign[1:] != counted_sign[:-1]]
+    run_start_idx = np.flatnonzero(is_run_start)
+    run_len = np.arange(len(counted_sign)) - run_start_idx[np.cumsum(is_run_start) - 1] + 1
+    streak[is_counted] = run_len * counted_sign.astype('int64')
+    if not is_zero_reset:
+        last_counted_idx = np.maximum.accumulate(np.where(is_counted, np.arange(len(sign)), -1))
+        streak = np.where(last_counted_idx >= 0, streak[last_counted_idx], 0)
+    return streak
 
 
-def append_ma(kline_df: pd.DataFrame, interval: int):
-    kline_df['ma' + str(interval)] = kline_df['close'].rolling(window=interval, min_periods=interval).mean().round(
-        2)
+def calc_cross(fast, slow) -> np.ndarray:
+    """
+    交叉事件: fast 由下往上穿越 slow 的那一期為 1，由上往下為 -1，其他為 0
+    相等或 NaN 的期數不算穿越，前後比較的是最近一次不相等的大小關係
+    """
+    sign = np.sign(np.asarray(fast, dtype='float64') - np.asarray(slow, dtype='float64'))
+    cross = np.zeros(len(sign), dtype='int64')
+    sign_idx = np.flatnonzero(~np.isnan(sign) & (sign != 0))
+    is_cross = sign[sign_idx][1:] != sign[sign_idx][:-1]
+    cross[sign_idx[1:][is_cross]] = sign[sign_idx[1:][is_cross]]
+    return cross
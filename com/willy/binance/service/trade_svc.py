@@ -1,43 +1,65 @@
 from datetime import datetime
 from decimal import Decimal, ROUND_FLOOR, ROUND_CEILING
+from typing import Tuple
 
 import numpy as np
 import pandas as pd
 
-from com.willy.binance.config.config_util import config_util
+from com.willy.binance.config.fee_schedule import FeeSchedule, load_fee_schedule
 from com.willy.binance.config.const import DECIMAL_PLACE_2
 from com.willy.binance.dto.binance_kline import BinanceKline
 from com.willy.binance.dto.trade_detail import TradeDetail
 from com.willy.binance.dto.trade_record import TradeRecord
 from com.willy.binance.dto.txn_detail import TxnDetail
+from com.willy.binance.dto.txn_ledger import TxnLedger
 from com.willy.binance.enums.handle_fee_type import HandleFeeType
-from com.willy.binance.enums.trade_reason import TradeReason
+from com.willy.binance.enums.trade_reason import TradeReason, TradeReasonType
 from com.willy.binance.enums.trade_type import TradeType
+from com.willy.binance.service import kline_store_svc
+from com.willy.binance.util import type_util
+from com.willy.binance.util.bar_clock import BarClock
+
+
+def get_fee_schedule(fee_schedule: FeeSchedule | None = None) -> FeeSchedule:
+    """
+    沒有指定手續費表時使用設定檔的預設費率 (只讀一次)
+    """
+    return fee_schedule if fee_schedule else load_fee_schedule()
+
+
+def get_handle_fee_ratio(handle_fee_type: HandleFeeType) -> Decimal:
+    """
+    預設手續費表不分方向的費率
+    """
+    return get_fee_schedule().get_fee_rate(handle_fee_type).rate
 
 
 def calc_max_loss(highest_price: Decimal, lowest_price: Decimal, total_handle_amt: Decimal, total_handle_fee,
                   units: Decimal,
-                  handle_fee_type=HandleFeeType.TAKER):
+                  handle_fee_type=HandleFeeType.TAKER, fee_schedule: FeeSchedule = None):
     if units > 0:
-        return min(calc_profit(highest_price, total_handle_amt, total_handle_fee, units, handle_fee_type),
-                   calc_profit(lowest_price, total_handle_amt, total_handle_fee, units, handle_fee_type))
+        return min(calc_profit(highest_price, total_handle_amt, total_handle_fee, units, handle_fee_type,
+                               fee_schedule),
+                   calc_profit(lowest_price, total_handle_amt, total_handle_fee, units, handle_fee_type,
+                               fee_schedule))
     else:
         return Decimal(0)
 
 
 def calc_profit(current_price: Decimal, total_handle_amt: Decimal, total_handle_fee, units: Decimal,
-                handle_fee_type=HandleFeeType.TAKER):
+                handle_fee_type=HandleFeeType.TAKER, fee_schedule: FeeSchedule = None):
     current_price = Decimal(current_price)
-    fee_rate = Decimal(config_util("binance.trade.handle.fee").get(handle_fee_type.name))
     if units > 0:
         # 平倉多倉
         # (賣金 - 賣手續) - 買金 - 買手續
-        profit = current_price * units * (1 - fee_rate) - total_handle_amt - total_handle_fee
+        fee_rate = get_fee_schedule(fee_schedule).get_fee_rate(handle_fee_type, TradeType.SELL)
+        profit = current_price * units * fee_rate.sell_factor - total_handle_amt - total_handle_fee
         # profit + total_handling_amt + total_handling_fee  / units / (1 - fee_rate)
     elif units < 0:
         # 平倉空倉
         # 賣金 - 賣手續 - (買價 + 買手續)
-        profit = (total_handle_amt - total_handle_fee) - current_price * -1 * units * (1 + fee_rate)
+        fee_rate = get_fee_schedule(fee_schedule).get_fee_rate(handle_fee_type, TradeType.BUY)
+        profit = (total_handle_amt - total_handle_fee) - current_price * -1 * units * fee_rate.buy_factor
         # (total_handling_amt - total_handling_fee)- profit / -1 / units / (1 + fee_rate)
     else:
         return None
@@ -45,7 +67,8 @@ def calc_profit(current_price: Decimal, total_handle_amt: Decimal, total_handle_
 
 
 def calc_force_close_offset_price(profit: Decimal, total_handle_amt: Decimal, total_handle_fee: Decimal, units: Decimal,
-                                  handle_fee_type: HandleFeeType = HandleFeeType.TAKER):
+                                  handle_fee_type: HandleFeeType = HandleFeeType.TAKER,
+                                  fee_schedule: FeeSchedule = None):
     """
     Args:
         profit: 預期獲利
@@ -53,21 +76,49 @@ def calc_force_close_offset_price(profit: Decimal, total_handle_amt: Decimal, to
         total_handle_fee: 總手續費
         units: 持倉單位數
         handle_fee_type: 手續費類別
+        fee_schedule: 手續費表，None 時使用預設
 
     Returns:
 
     """
-    handle_fee_ratio = Decimal(config_util("binance.trade.handle.fee").get(handle_fee_type.name))
     if units > 0:
-        force_close_offset_price = (profit + total_handle_amt + total_handle_fee) / units / (1 - handle_fee_ratio)
+        fee_rate = get_fee_schedule(fee_schedule).get_fee_rate(handle_fee_type, TradeType.SELL)
+        force_close_offset_price = (profit + total_handle_amt + total_handle_fee) / units / fee_rate.sell_factor
     elif units < 0:
+        fee_rate = get_fee_schedule(fee_schedule).get_fee_rate(handle_fee_type, TradeType.BUY)
         force_close_offset_price = ((total_handle_amt - total_handle_fee) - profit) / -1 / units / (
-                1 + handle_fee_ratio)
+            fee_rate.buy_factor)
     else:
         return None
     return force_close_offset_price.quantize(Decimal("1"), rounding=ROUND_CEILING)
 
 
+def calc_cross_force_close_offset_price(profit: Decimal, long_handle_amt: Decimal, long_handle_fee: Decimal,
+                                        long_units: Decimal, short_handle_amt: Decimal, short_handle_fee: Decimal,
+                                        short_units: Decimal, handle_fee_type: HandleFeeType = HandleFeeType.TAKER,
+                                        fee_schedule: FeeSchedule = None) -> Tuple[Decimal, bool] | None:
+    """
+    全倉 (多空共用保證金) 時兩邊合併平倉損益等於 profit 的價格，捨入同 calc_force_close_offset_price
+    合併損益對價格為線性: 淨多時價格跌破才爆倉，淨空時漲破才爆倉
+
+    Args:
+        short_units: 空倉單位數 (<= 0)
+    Returns: (強平價, 是否為跌破)，淨部位為 0 或強平價 <= 0 時回傳 None
+    """
+    fee_schedule = get_fee_schedule(fee_schedule)
+    sell_factor = fee_schedule.get_fee_rate(handle_fee_type, TradeType.SELL).sell_factor
+    buy_factor = fee_schedule.get_fee_rate(handle_fee_type, TradeType.BUY).buy_factor
+    # 合併損益 = price * slope + const
+    slope = long_units * sell_factor + short_units * buy_factor
+    const = short_handle_amt - short_handle_fee - long_handle_amt - long_handle_fee
+    if slope == 0:
+        return None
+    force_close_offset_price = ((profit - const) / slope).quantize(Decimal("1"), rounding=ROUND_CEILING)
+    if force_close_offset_price <= 0:
+        return None
+    return force_close_offset_price, slope > 0
+
+
 def calc_buyable_units(invest_amt: Decimal, price: Decimal) -> Decimal:
     """
 
@@ -84,9 +135,9 @@ def calc_buyable_units(invest_amt: Decimal, price: Decimal) -> Decimal:
     return (invest_amt / price).quantize(Decimal("0.001"), rounding=ROUND_FLOOR)
 
 
-def calc_handle_fee(price: Decimal, units: Decimal, handle_fee_type: HandleFeeType = HandleFeeType.TAKER
-                    ) -> Decimal:
-    handle_fee_ratio = Decimal(config_util("binance.trade.handle.fee").get(handle_fee_type.name))
+def calc_handle_fee(price: Decimal, units: Decimal, handle_fee_type: HandleFeeType = HandleFeeType.TAKER,
+                    fee_schedule: FeeSchedule = None, trade_type: TradeType = None) -> Decimal:
+    handle_fee_ratio = get_fee_schedule(fee_schedule).get_fee_rate(handle_fee_type, trade_type).rate
     units = Decimal(units)
     price = Decimal(price)
     return (price * units * handle_fee_ratio).quantize(DECIMAL_PLACE_2, rounding=ROUND_CEILING)
@@ -96,6 +147,103 @@ def calc_trade_amt(price: Decimal, units: Decimal) -> Decimal:
     return Decimal(price) * Decimal(units)
 
 
+def round_floor_batch(value, exp: int) -> np.ndarray:
+    """
+    同 Decimal quantize(10 ** -exp, ROUND_FLOOR)，先 round 去掉 float 誤差再捨入
+    """
+    scale = 10 ** exp
+    return np.floor(np.round(np.asarray(value, dtype='float64') * scale, 6)) / scale
+
+
+def round_ceiling_batch(value, exp: int) -> np.ndarray:
+    """
+    同 Decimal quantize(10 ** -exp, ROUND_CEILING)
+    """
+    scale = 10 ** exp
+    return np.ceil(np.round(np.asarray(value, dtype='float64') * scale, 6)) / scale
+
+
+def get_close_factor_batch(handle_fee_type: HandleFeeType, fee_rate, fee_schedule: FeeSchedule | None):
+    """
+    回傳平倉係數 (多倉賣出 1 - fee, 空倉買入 1 + fee)，fee_rate 有值時取代手續費表 (可為各元素不同的費率陣列)
+    """
+    if fee_rate is None:
+        fee_schedule = get_fee_schedule(fee_schedule)
+        return (fee_schedule.get_fee_rate(handle_fee_type, TradeType.SELL).sell_factor_float,
+                fee_schedule.get_fee_rate(handle_fee_type, TradeType.BUY).buy_factor_float)
+    return 1 - fee_rate, 1 + fee_rate
+
+
+def calc_profit_batch(current_price, total_handle_amt, total_handle_fee, units,
+                      handle_fee_type: HandleFeeType = HandleFeeType.TAKER, fee_rate=None,
+                      fee_schedule: FeeSchedule = None) -> np.ndarray:
+    """
+    calc_profit 的陣列版本 (參數可為 ndarray 或純量，依 numpy broadcast)，空倉為 NaN
+    fee_rate 有值時取代手續費表的費率 (可為各元素不同的費率陣列)
+    """
+    sell_factor, buy_factor = get_close_factor_batch(handle_fee_type, fee_rate, fee_schedule)
+    current_price, total_handle_amt, total_handle_fee, units = [
+        np.asarray(value, dtype='float64') for value in (current_price, total_handle_amt, total_handle_fee, units)]
+    with np.errstate(invalid='ignore'):
+        profit = np.where(units > 0, current_price * units * sell_factor - total_handle_amt - total_handle_fee,
+                          np.where(units < 0,
+                                   (total_handle_amt - total_handle_fee) - current_price * -units * buy_factor,
+                                   np.nan))
+    return round_floor_batch(profit, 2)
+
+
+def calc_max_loss_batch(highest_price, lowest_price, total_handle_amt, total_handle_fee, units,
+                        handle_fee_type: HandleFeeType = HandleFeeType.TAKER, fee_rate=None,
+                        fee_schedule: FeeSchedule = None) -> np.ndarray:
+    """
+    calc_max_loss 的陣列版本
+    """
+    units = np.asarray(units, dtype='float64')
+    return np.where(units > 0,
+                    np.minimum(calc_profit_batch(highest_price, total_handle_amt, total_handle_fee, units,
+                                                 handle_fee_type, fee_rate, fee_schedule),
+                               calc_profit_batch(lowest_price, total_handle_amt, total_handle_fee, units,
+                                                 handle_fee_type, fee_rate, fee_schedule)),
+                    0.0)
+
+
+def calc_force_close_offset_price_batch(profit, total_handle_amt, total_handle_fee, units,
+                                        handle_fee_type: HandleFeeType = HandleFeeType.TAKER,
+                                        fee_rate=None, fee_schedule: FeeSchedule = None) -> np.ndarray:
+    """
+    calc_force_close_offset_price 的陣列版本，空倉為 NaN
+    """
+    sell_factor, buy_factor = get_close_factor_batch(handle_fee_type, fee_rate, fee_schedule)
+    profit, total_handle_amt, total_handle_fee, units = [
+        np.asarray(value, dtype='float64') for value in (profit, total_handle_amt, total_handle_fee, units)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        price = np.where(units > 0, (profit + total_handle_amt + total_handle_fee) / units / sell_factor,
+                         np.where(units < 0,
+                                  ((total_handle_amt - total_handle_fee) - profit) / -units / buy_factor,
+                                  np.nan))
+    return round_ceiling_batch(price, 0)
+
+
+def calc_buyable_units_batch(invest_amt, price) -> np.ndarray:
+    """
+    calc_buyable_units 的陣列版本
+    """
+    invest_amt = np.asarray(invest_amt, dtype='float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        units = round_floor_batch(invest_amt / np.asarray(price, dtype='float64'), 3)
+    return np.where(invest_amt > 0, units, 0.0)
+
+
+def calc_handle_fee_batch(price, units, handle_fee_type: HandleFeeType = HandleFeeType.TAKER,
+                          fee_rate=None, fee_schedule: FeeSchedule = None, trade_type: TradeType = None) -> np.ndarray:
+    """
+    calc_handle_fee 的陣列版本
+    """
+    if fee_rate is None:
+        fee_rate = get_fee_schedule(fee_schedule).get_fee_rate(handle_fee_type, trade_type).rate_float
+    return round_ceiling_batch(np.asarray(price, dtype='float64') * np.asarray(units, dtype='float64') * fee_rate, 2)
+
+
 def create_trade_record(date: datetime, trade_type: TradeType, price: Decimal, amt: Decimal = None,
                         unit: Decimal = None,
                         handle_fee_type: HandleFeeType = HandleFeeType.TAKER,
@@ -126,7 +274,8 @@ def create_close_trade_record(date: datetime, price: Decimal, txn_detail: TxnDet
 
 def build_txn_detail_list_df(row, invest_amt, guarantee_amt,
                              leverage_ratio,
-                             trade_record: TradeRecord | None, trade_detail: TradeDetail):
+                             trade_record: TradeRecord | None, trade_detail: TradeDetail,
+                             fee_schedule: FeeSchedule = None):
     if trade_record is None:
         return
     return build_txn_detail_list(
@@ -134,12 +283,13 @@ def build_txn_detail_list_df(row, invest_amt, guarantee_amt,
                      Decimal(row.vol), row.end_time,
                      int(row.number_of_trade)), Decimal(invest_amt), Decimal(guarantee_amt), Decimal(leverage_ratio),
         trade_record,
-        trade_detail)
+        trade_detail, fee_schedule)
 
 
 def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guarantee_amt: Decimal,
                           leverage_ratio: Decimal,
-                          trade_record: TradeRecord | None, trade_detail: TradeDetail):
+                          trade_record: TradeRecord | None, trade_detail: TradeDetail,
+                          fee_schedule: FeeSchedule = None):
     """
 
     :param binanceKline:
@@ -147,8 +297,10 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
     leverage_ratio: 槓桿倍數
     trade_record: 新的一筆交易
     :param trade_detail:
+    fee_schedule: 手續費表，None 時使用預設
     :return:
     """
+    fee_schedule = get_fee_schedule(fee_schedule)
     current_price = binanceKline.close
     current_date = binanceKline.start_time
     last_handle_units = Decimal(0)
@@ -179,7 +331,8 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
             if last_handle_units >= 0:
                 total_handle_amt = last_handle_amt + trade_amt
                 total_handle_fee = last_handle_fee + calc_handle_fee(trade_record.price, trade_record.unit,
-                                                                     trade_record.handle_fee_type)
+                                                                     trade_record.handle_fee_type, fee_schedule,
+                                                                     trade_record.type)
                 profit = Decimal(0)
                 profit_ratio = Decimal(0)
             else:
@@ -188,9 +341,10 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
                     # 買入單位>之前持有的空倉單位
                     remain_unit = (trade_record.unit + last_handle_units)
                     total_handle_amt = calc_trade_amt(trade_record.price, remain_unit)
-                    total_handle_fee = calc_handle_fee(trade_record.price, remain_unit, trade_record.handle_fee_type)
+                    total_handle_fee = calc_handle_fee(trade_record.price, remain_unit, trade_record.handle_fee_type,
+                                                       fee_schedule, trade_record.type)
                     profit = calc_profit(trade_record.price, last_handle_amt, last_handle_fee, last_handle_units,
-                                         trade_record.handle_fee_type)
+                                         trade_record.handle_fee_type, fee_schedule)
                     profit_ratio = profit / last_trade_detail_guarantee
                 else:
                     # 買入部分<放空艙位
@@ -199,7 +353,7 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
                     profit = calc_profit(trade_record.price,
                                          -1 * (last_handle_amt / last_handle_units * trade_record.unit),
                                          last_handle_fee - total_handle_fee, -1 * trade_record.unit,
-                                         trade_record.handle_fee_type)
+                                         trade_record.handle_fee_type, fee_schedule)
                     profit_ratio = profit / ((last_handle_amt - total_handle_amt) / leverage_ratio).quantize(
                         DECIMAL_PLACE_2, rounding=ROUND_CEILING)
 
@@ -207,16 +361,16 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
             acct_balance = invest_amt + guarantee_amt - guarantee - total_handle_fee
             max_loss = calc_max_loss(binanceKline.high, binanceKline.low, total_handle_amt, total_handle_fee,
                                      total_handle_units,
-                                     HandleFeeType.TAKER)
+                                     HandleFeeType.TAKER, fee_schedule)
 
             force_close_offset_price = calc_force_close_offset_price(-1 * (invest_amt + guarantee_amt),
                                                                      total_handle_amt,
                                                                      total_handle_fee,
                                                                      total_handle_units,
-                                                                     HandleFeeType.TAKER)
+                                                                     HandleFeeType.TAKER, fee_schedule)
             break_even_point_price = calc_force_close_offset_price(Decimal(0),
                                                                    total_handle_amt, total_handle_fee,
-                                                                   total_handle_units)
+                                                                   total_handle_units, fee_schedule=fee_schedule)
 
             trade_detail.txn_detail_list.append(
                 TxnDetail(current_date, total_handle_units, total_handle_amt, total_handle_fee,
@@ -234,7 +388,8 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
             if last_handle_units <= 0:
                 total_handle_amt = last_handle_amt + trade_amt
                 total_handle_fee = last_handle_fee + calc_handle_fee(trade_record.price, trade_record.unit,
-                                                                     trade_record.handle_fee_type)
+                                                                     trade_record.handle_fee_type, fee_schedule,
+                                                                     trade_record.type)
                 profit = Decimal(0)
                 profit_ratio = Decimal(0)
             else:
@@ -244,9 +399,10 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
                     remain_unit = (trade_record.unit * -1 + last_handle_units)
                     total_handle_amt = abs(calc_trade_amt(trade_record.price, remain_unit))
                     total_handle_fee = abs(
-                        calc_handle_fee(trade_record.price, remain_unit, trade_record.handle_fee_type))
+                        calc_handle_fee(trade_record.price, remain_unit, trade_record.handle_fee_type,
+                                        fee_schedule, trade_record.type))
                     profit = calc_profit(trade_record.price, last_handle_amt, last_handle_fee, last_handle_units,
-                                         trade_record.handle_fee_type)
+                                         trade_record.handle_fee_type, fee_schedule)
                     profit_ratio = profit / last_trade_detail_guarantee
                 else:
                     # 買入單位<之前持有的空倉單位
@@ -254,8 +410,9 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
                     total_handle_fee = last_handle_fee / last_handle_units * total_handle_units
                     profit = calc_profit(trade_record.price, last_handle_amt / last_handle_units * trade_record.unit,
                                          calc_handle_fee(last_handle_amt / last_handle_units, trade_record.unit,
-                                                         trade_record.handle_fee_type), trade_record.unit,
-                                         trade_record.handle_fee_type)
+                                                         trade_record.handle_fee_type, fee_schedule,
+                                                         TradeType.BUY), trade_record.unit,
+                                         trade_record.handle_fee_type, fee_schedule)
                     profit_ratio = profit / ((last_handle_amt - total_handle_amt) / leverage_ratio).quantize(
                         DECIMAL_PLACE_2, rounding=ROUND_CEILING)
 
@@ -263,15 +420,15 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
             acct_balance = invest_amt + guarantee_amt - guarantee - total_handle_fee
             max_loss = calc_max_loss(binanceKline.high, binanceKline.low, total_handle_amt, total_handle_fee,
                                      total_handle_units,
-                                     HandleFeeType.TAKER)
+                                     HandleFeeType.TAKER, fee_schedule)
             force_close_offset_price = calc_force_close_offset_price(-1 * (invest_amt + guarantee_amt),
                                                                      total_handle_amt,
                                                                      total_handle_fee,
                                                                      total_handle_units,
-                                                                     HandleFeeType.TAKER)
+                                                                     HandleFeeType.TAKER, fee_schedule)
             break_even_point_price = calc_force_close_offset_price(Decimal(0),
                                                                    total_handle_amt, total_handle_fee,
-                                                                   total_handle_units)
+                                                                   total_handle_units, fee_schedule=fee_schedule)
             trade_detail.txn_detail_list.append(
                 TxnDetail(current_date, total_handle_units, total_handle_amt, total_handle_fee,
                           guarantee,
@@ -281,9 +438,9 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
                           max_loss,
                           acct_balance,
                           trade_record))
-    else:
+    elif not trade_detail.is_sparse:
         profit = calc_profit(current_price, last_handle_amt, last_handle_fee, last_handle_units,
-                             HandleFeeType.TAKER)
+                             HandleFeeType.TAKER, fee_schedule)
 
         profit_ratio = None
         if profit and last_trade_detail_guarantee:
@@ -298,9 +455,156 @@ def build_txn_detail_list(binanceKline: BinanceKline, invest_amt: Decimal, guara
                       trade_record))
 
 
+def set_txn_idx_column(df: pd.DataFrame, trade_detail: TradeDetail, bar_clock: BarClock):
+    """
+    以K棒序號將 txn_detail 在 ledger 的位置放到對應的 df 列 (同一根K棒有多筆時取最後一筆)，沒有交易的K棒為 -1
+    """
+    start_time_array = kline_store_svc.to_timestamp_ms_array(df['start_time'])
+    txn_idx_array = np.full(len(df), -1, dtype='int64')
+    txn_detail_list = trade_detail.txn_detail_list
+    if isinstance(txn_detail_list, TxnLedger):
+        event_time_array = txn_detail_list.date_ms
+    else:
+        event_time_array = np.array([type_util.datetime_to_timestamp_ms(td.date) for td in txn_detail_list],
+                                    dtype='int64')
+    if len(event_time_array) > 0 and len(df) > 0:
+        event_bar_idx_array = bar_clock.to_bar_idx(event_time_array)
+        row_idx_array = np.searchsorted(start_time_array, bar_clock.to_timestamp_ms(event_bar_idx_array),
+                                        side='left')
+        is_matched = row_idx_array < len(df)
+        is_matched[is_matched] = bar_clock.to_bar_idx(
+            start_time_array[row_idx_array[is_matched]]) == event_bar_idx_array[is_matched]
+        # txn_detail 依時間排序，同一根K棒有多筆時只取最後一筆
+        matched_txn_idx_array = np.flatnonzero(is_matched)
+        matched_row_idx_array = row_idx_array[matched_txn_idx_array]
+        is_last = np.r_[matched_row_idx_array[1:] != matched_row_idx_array[:-1], True]
+        txn_idx_array[matched_row_idx_array[is_last]] = matched_txn_idx_array[is_last]
+    df['txn_idx'] = txn_idx_array
+
+
+def derive_bar_profit_df(start_time_array: np.ndarray, close_array: np.ndarray, trade_detail: TradeDetail,
+                         handle_fee_type: HandleFeeType = HandleFeeType.TAKER,
+                         fee_schedule: FeeSchedule = None) -> pd.DataFrame:
+    """
+    由 txn_detail (只需有交易的紀錄) 向量化推算每根K棒的持倉及損益，計算方式同 build_txn_detail_list 沒有交易時
+    持倉在兩筆交易之間不變，未實現損益 = 以收盤價平倉的損益；有交易的K棒取該K棒最後一筆 txn_detail 的損益
+    sparse ledger 中 txn_detail.total_profit 只累加有交易的紀錄，每根K棒的 total_profit 以此處結果為準
+    以 float 計算，供績效分析/畫圖使用
+
+    Args:
+        start_time_array: K棒開始時間 (epoch ms 或 datetime)
+        close_array: 收盤價
+    Returns: DataFrame[start_time, units, profit, total_profit]
+    """
+    start_time_array = kline_store_svc.to_timestamp_ms_array(pd.Series(start_time_array))
+    close_array = np.asarray(close_array, dtype='float64')
+    txn_detail_list = trade_detail.txn_detail_list
+    if isinstance(txn_detail_list, TxnLedger):
+        # columnar ledger 直接取欄位
+        event_time_array = txn_detail_list.date_ms
+        event_units_array, event_amt_array, event_fee_array, event_profit_array, event_total_profit_array = [
+            np.r_[txn_detail_list.get_values(field), sentinel] for field, sentinel in
+            (('units', 0.0), ('handle_amt', 0.0), ('handling_fee', 0.0), ('profit', np.nan), ('total_profit', 0.0))]
+    else:
+        event_time_array = np.array([type_util.datetime_to_timestamp_ms(td.date) for td in txn_detail_list],
+                                    dtype='int64')
+        event_units_array = np.array([float(td.units) for td in txn_detail_list] + [0.0])
+        event_amt_array = np.array([float(td.handle_amt) for td in txn_detail_list] + [0.0])
+        event_fee_array = np.array([float(td.handling_fee) for td in txn_detail_list] + [0.0])
+        event_profit_array = np.array([np.nan if td.profit is None else float(td.profit) for td in txn_detail_list]
+                                      + [np.nan])
+        event_total_profit_array = np.array([float(td.total_profit) for td in txn_detail_list] + [0.0])
+
+    # 每根K棒對應的最後一筆交易，-1 (尚未交易) 對應到最後補上的空持倉
+    event_idx_array = np.searchsorted(event_time_array, start_time_array, side='right') - 1
+    units = event_units_array[event_idx_array]
+    handle_amt = event_amt_array[event_idx_array]
+    handle_fee = event_fee_array[event_idx_array]
+    unrealized_profit = calc_profit_batch(close_array, handle_amt, handle_fee, units, handle_fee_type,
+                                          fee_schedule=fee_schedule)
+
+    # 同一根K棒前已有的最後一筆交易，與 event_idx_array 不同表示該K棒有交易
+    prev_event_idx_array = np.searchsorted(event_time_array, start_time_array, side='left') - 1
+    is_event_bar = event_idx_array != prev_event_idx_array
+    profit = np.where(is_event_bar, event_profit_array[event_idx_array], unrealized_profit)
+
+    # 同 build_txn_detail_list，total_profit 為逐筆 profit 累加 (有交易的K棒累加該K棒所有交易的 profit)
+    event_profit_cumsum = np.r_[0.0, np.cumsum(np.nan_to_num(event_profit_array[:-1]))]
+    bar_profit = np.where(is_event_bar,
+                          event_profit_cumsum[event_idx_array + 1] - event_profit_cumsum[prev_event_idx_array + 1],
+                          np.nan_to_num(unrealized_profit))
+    base_total_profit = event_total_profit_array[prev_event_idx_array[0]] if len(start_time_array) > 0 else 0.0
+    total_profit = base_total_profit + np.cumsum(bar_profit)
+    return pd.DataFrame({'start_time': start_time_array, 'units': units, 'profit': profit,
+                         'total_profit': total_profit})
+
+
+def find_first_passage_idx(price_array: np.ndarray, price: float, is_below: bool, start_idx: int = 0,
+                           block_size: int = 1024) -> int | None:
+    """
+    找出 start_idx 起第一根越過 price 的K棒 (is_below: price_array < price，否則 price_array > price)
+    以區塊由近到遠搜尋，成本與到觸發點的距離成正比
+
+    Returns: K棒位置，沒有觸發時回傳 None
+    """
+    block_start_idx = start_idx
+    while block_start_idx < len(price_array):
+        block = price_array[block_start_idx:block_start_idx + block_size]
+        # 區塊內的 running min/max 第一次越過 price 的位置
+        if is_below:
+            is_passed = np.minimum.accumulate(block) < price
+        else:
+            is_passed = np.maximum.accumulate(block) > price
+        if is_passed[-1]:
+            return block_start_idx + int(np.argmax(is_passed))
+        block_start_idx += len(block)
+        block_size *= 2
+    return None
+
+
+def find_first_touch_idx(low_array: np.ndarray, high_array: np.ndarray, price_array: np.ndarray, start_idx: int = 0,
+                         block_size: int = 1024) -> int | None:
+    """
+    找出 start_idx 起第一根 low <= price <= high (price_array 任一價格) 的K棒，以區塊由近到遠搜尋
+
+    Returns: K棒位置，沒有觸及時回傳 None
+    """
+    if len(price_array) == 0:
+        return None
+    price_array = np.sort(price_array)
+    block_start_idx = start_idx
+    while block_start_idx < len(low_array):
+        block_end_idx = block_start_idx + block_size
+        # [low, high] 內有價格: 第一個 >= low 的價格位置 < 第一個 > high 的價格位置
+        is_touched = (np.searchsorted(price_array, low_array[block_start_idx:block_end_idx], side='left')
+                      < np.searchsorted(price_array, high_array[block_start_idx:block_end_idx], side='right'))
+        if is_touched.any():
+            return block_start_idx + int(np.argmax(is_touched))
+        block_start_idx = block_end_idx
+        block_size *= 2
+    return None
+
+
+def find_force_close_idx(low_array: np.ndarray, high_array: np.ndarray, units: Decimal,
+                         force_close_offset_price: Decimal | None, start_idx: int = 0) -> int | None:
+    """
+    持倉不變時強平價固定，向量化找出 start_idx 起第一根爆倉的K棒 (多倉 low < 強平價，空倉 high > 強平價)
+
+    Returns: K棒位置，持倉期間不會爆倉時回傳 None
+    """
+    if not units or force_close_offset_price is None:
+        return None
+    if units > 0:
+        return find_first_passage_idx(low_array, float(force_close_offset_price), True, start_idx)
+    return find_first_passage_idx(high_array, float(force_close_offset_price), False, start_idx)
+
+
 def check_is_force_close_offset(kline: BinanceKline, invest_amt: Decimal, guarantee_amt: Decimal,
                                 leverage_ratio: Decimal, trade_detail: TradeDetail):
     # 確認是否爆倉
+    if len(trade_detail.txn_detail_list) == 0:
+        # sparse ledger 尚未交易
+        return False
     latest_txn_detail = trade_detail.txn_detail_list[len(trade_detail.txn_detail_list) - 1]
     # 是否做多
     is_long_trade = latest_txn_detail.units > 0
@@ -314,11 +618,11 @@ def check_is_force_close_offset(kline: BinanceKline, invest_amt: Decimal, guaran
                       Decimal(0),
                       latest_txn_detail.force_close_offset_price, -1 * (invest_amt + guarantee_amt),
                       Decimal(-100 * leverage_ratio), Decimal(0),
-                      Decimal(0), -1 * (invest_amt + guarantee_amt), Decimal(0),
+                      Decimal(0), Decimal(0), -1 * (invest_amt + guarantee_amt), Decimal(0),
                       TradeRecord(kline.end_time, TradeType.SELL if is_long_trade else TradeType.BUY,
                                   latest_txn_detail.force_close_offset_price,
                                   -1 * latest_txn_detail.units,
-                                  HandleFeeType.TAKER)))
+                                  HandleFeeType.TAKER, TradeReason(TradeReasonType.PASSIVE, "爆倉"))))
         return True
 
 
@@ -1,20 +1,29 @@
 import logging
 import math
 from decimal import Decimal, ROUND_FLOOR
-from typing import List
+from typing import List, Tuple
 
+import numpy as np
 from binance import Client
 
 from com.willy.binance.config.const import DECIMAL_PLACE_2
+from com.willy.binance.config.fee_schedule import FeeSchedule, load_fee_schedule
 from com.willy.binance.dto.binance_kline import BinanceKline
 from com.willy.binance.dto.fixed_price_invest_amt_dto import FixedPriceInvestAmtDto
 from com.willy.binance.dto.hedge_grid_backtest_req import HedgeGridBacktestReq
 from com.willy.binance.dto.hedge_grid_backtest_res import HedgeGridBacktestRes
 from com.willy.binance.dto.trade_detail import TradeDetail
+from com.willy.binance.dto.trade_record import TradeRecord
+from com.willy.binance.dto.txn_detail import TxnDetail
+from com.willy.binance.dto.txn_ledger import TxnLedger
 from com.willy.binance.enums.handle_fee_type import HandleFeeType
+from com.willy.binance.enums.trade_reason import TradeReason, TradeReasonType
 from com.willy.binance.enums.trade_type import TradeType
 from com.willy.binance.service import trade_svc
 from com.willy.binance.service.binance_svc import BinanceSvc
+from com.willy.binance.service.fixed_point_trade_svc import FixedPointTradeSvc
+from com.willy.binance.service.hedge_risk_svc import HedgeRiskSvc
+from com.willy.binance.service.kline_loader_svc import KlineLoaderSvc
 from com.willy.binance.util import type_util
 
 
@@ -31,8 +40,18 @@ class HedgeStrategy:
     enable_trade_detail_log = False
     enable_hedge_trade_plan_log = False
     enable_trade_summary_log = True
+    # 只記錄有交易的 txn_detail，每根K棒損益改由 trade_svc.derive_bar_profit_df 推算
+    enable_sparse_ledger = False
+    # 每次交易後以多空庫存計算各價位損益 (HedgeGridBacktestRes.risk_snapshot_list)
+    enable_risk_snapshot = False
+
+    def __init__(self, kline_loader_svc: KlineLoaderSvc = None):
+        # 多個回測共用同一個 loader，重疊區間只撈一次
+        self.kline_loader_svc = kline_loader_svc if kline_loader_svc else KlineLoaderSvc(BinanceSvc())
 
     def backtest_hedge_grid_list(self, hedge_grid_backtest_req_list: List[HedgeGridBacktestReq]):
+        self.kline_loader_svc.prefetch([(req.binance_product, Client.KLINE_INTERVAL_5MINUTE, req.start_time,
+                                         req.end_time) for req in hedge_grid_backtest_req_list])
         hedge_grid_backtest_res_list = []
         for hedge_grid_backtest_req in hedge_grid_backtest_req_list:
             hedge_grid_backtest_res_list.append(self.backtest_hedge_grid(hedge_grid_backtest_req))
@@ -48,7 +67,6 @@ class HedgeStrategy:
         Returns:
 
         """
-        binance_svc = BinanceSvc()
         # print出回測資訊
         if self.enable_trade_summary_log:
             logging.info(
@@ -108,26 +126,18 @@ class HedgeStrategy:
                     f"{hedge_buy_list[hedge_trade_idx].price}\t{hedge_buy_list[hedge_trade_idx].amt}\t{hedge_sell_list[hedge_trade_idx].amt}")
 
         # 回測交易紀錄
-        daily_kline_list = binance_svc.get_historical_klines(hedge_grid_backtest_req.binance_product,
-                                                             Client.KLINE_INTERVAL_5MINUTE,
-                                                             start_date=hedge_grid_backtest_req.start_time,
-                                                             end_date=hedge_grid_backtest_req.end_time)
+        daily_kline_list = self.kline_loader_svc.load_kline_list(hedge_grid_backtest_req.binance_product,
+                                                                 Client.KLINE_INTERVAL_5MINUTE,
+                                                                 hedge_grid_backtest_req.start_time,
+                                                                 hedge_grid_backtest_req.end_time)
         single_side_invest_amt = (hedge_grid_backtest_req.invest_amt / 2).quantize(DECIMAL_PLACE_2, ROUND_FLOOR)
         single_side_guarantee_amt = (hedge_grid_backtest_req.guarantee_amt / 2).quantize(DECIMAL_PLACE_2, ROUND_FLOOR)
+        fee_schedule = load_fee_schedule(hedge_grid_backtest_req.binance_product)
 
-        # 回測買做多帳戶
-        hedge_buy_trade_detail = self.get_trade_detail_list(TradeType.BUY,
-                                                            single_side_invest_amt,
-                                                            single_side_guarantee_amt,
-                                                            hedge_grid_backtest_req.leverage_ratio,
-                                                            daily_kline_list, hedge_buy_list)
-
-        # 回測買做空帳戶
-        hedge_sell_trade_detail = self.get_trade_detail_list(TradeType.SELL,
-                                                             single_side_invest_amt,
-                                                             single_side_guarantee_amt,
-                                                             hedge_grid_backtest_req.leverage_ratio,
-                                                             daily_kline_list, hedge_sell_list)
+        # 同時回測買做多/做空帳戶
+        hedge_buy_trade_detail, hedge_sell_trade_detail = self.get_hedge_trade_detail_pair(
+            single_side_invest_amt, single_side_guarantee_amt, hedge_grid_backtest_req.leverage_ratio,
+            daily_kline_list, hedge_buy_list, hedge_sell_list, fee_schedule, hedge_grid_backtest_req.is_cross_margin)
 
         self.log_out_hedge_trade_detail(hedge_buy_trade_detail.txn_detail_list, hedge_buy_trade_detail.txn_detail_list)
         #
@@ -141,7 +151,15 @@ class HedgeStrategy:
         #                 f"sell_profit[{hedge_sell_trade_detail_list[i].profit}]"
         #                 f"total_profit[{hedge_buy_trade_detail.profit + hedge_sell_trade_detail_list[i].profit}]")
 
-        return HedgeGridBacktestRes(hedge_grid_backtest_req.name, hedge_buy_trade_detail, hedge_sell_trade_detail)
+        risk_snapshot_list = None
+        if self.enable_risk_snapshot:
+            risk_snapshot_list = HedgeRiskSvc(hedge_grid_backtest_req.lower_bound, hedge_grid_backtest_req.upper_bound,
+                                              single_side_invest_amt + single_side_guarantee_amt,
+                                              fee_schedule=fee_schedule).build_snapshot_list(hedge_buy_trade_detail,
+                                                                                             hedge_sell_trade_detail)
+
+        return HedgeGridBacktestRes(hedge_grid_backtest_req.name, hedge_buy_trade_detail, hedge_sell_trade_detail,
+                                    risk_snapshot_list)
 
     def log_out_hedge_trade_detail(self, hedge_buy_trade_detail_list, hedge_sell_trade_detail_list):
         if self.enable_trade_detail_log:
@@ -212,80 +230,240 @@ class HedgeStrategy:
         #                                           sell_acct_trade_record,
         #                                           daily_kline_list[len(daily_kline_list) - 1].end_time))
 
-    def get_trade_detail_list(self,
-                              trade_type: TradeType,
-                              invest_amt: Decimal,
-                              guarantee_amt: Decimal,
-                              leverage_ratio: Decimal,
-                              kline_list: List[BinanceKline] = None,
-                              trade_plan_list=None) -> TradeDetail:
-        if trade_plan_list is None:
-            trade_plan_list = []
+    def get_triggered_trade_record_list(self, trade_type: TradeType, kline: BinanceKline, trade_plan_list,
+                                        max_trade_plan_price: Decimal, min_trade_plan_price: Decimal,
+                                        trade_detail: TradeDetail) -> List[TradeRecord]:
+        trade_record_list = []
+        # 逐日確定是否觸發交易
+        for trade_plan in trade_plan_list:
+            if isinstance(trade_plan, FixedPriceInvestAmtDto):
+                # 確認網格是否被突破
+                if kline.high > max_trade_plan_price or kline.low < min_trade_plan_price:
+                    trade_detail.is_grid_break = True
+                # 逐個價位檢查是否被觸發
+                if not trade_plan.is_traded and kline.high > trade_plan.price > kline.low:
+                    # five_minutes_kline_list = self.get_historical_klines(binance_product, Client.KLINE_INTERVAL_5MINUTE, start_date=kline.start_time, end_date=kline.end_time)
+                    trade_plan.is_traded = True
+
+                    # 觸發交易時紀錄交易紀錄
+                    trade_record = trade_svc.create_trade_record(kline.start_time, trade_type,
+                                                                 trade_plan.price,
+                                                                 amt=trade_plan.amt,
+                                                                 handle_fee_type=HandleFeeType.MAKER)
+                    if trade_record:
+                        trade_record_list.append(trade_record)
+
+        # 如果一個K棒觸發>2個交易區間 => 觸發融斷，結束交易，等到市場穩定
+        # if len(trade_record_list) > 2:
+        #     trade_detail.is_circuit_breaker = True
+        #     # 將手上庫存都賣出
+        #     total_handle_amt = Decimal(0)
+        #     for trade_record in trade_record_list:
+        #         total_handle_amt += trade_record.handle_amt
+        #     total_handle_amt += trade_detail.txn_detail_list[len(trade_detail.txn_detail_list) - 1].handle_amt
+        #     circuit_breaker_trade_type = TradeType.SELL if TradeType.BUY == trade_type else TradeType.BUY
+        #     trade_record_list.append(trade_svc.create_trade_record(kline.end_time, circuit_breaker_trade_type,
+        #                                                            kline.low,
+        #                                                            total_handle_amt,
+        #                                                            HandleFeeType.TAKER))
+        return trade_record_list
+
+    def get_hedge_trade_detail_pair(self,
+                                    invest_amt: Decimal,
+                                    guarantee_amt: Decimal,
+                                    leverage_ratio: Decimal,
+                                    kline_list: List[BinanceKline],
+                                    hedge_buy_list: List[FixedPriceInvestAmtDto],
+                                    hedge_sell_list: List[FixedPriceInvestAmtDto],
+                                    fee_schedule: FeeSchedule = None,
+                                    is_cross_margin: bool = False) -> Tuple[TradeDetail, TradeDetail]:
+        """
+        K棒只走一次，同時計算做多/做空兩邊，逐倉時兩邊各自計算損益及爆倉
 
-        if kline_list is None:
-            # kline_list = self.get_historical_klines(binance_product, start_date=start_time, end_date=end_time)
-            raise ValueError(f"kline_list is None")
+        Args:
+            invest_amt: 單邊投資金額
+            guarantee_amt: 單邊保證金
+            is_cross_margin: 全倉，兩邊共用 (invest_amt + guarantee_amt) * 2，以合併損益判斷爆倉並同時平倉
+        Returns: (做多 TradeDetail, 做空 TradeDetail)
+        """
+        leg_list = [HedgeLeg(TradeType.BUY, hedge_buy_list,
+                             FixedPointTradeSvc(invest_amt, guarantee_amt, leverage_ratio, fee_schedule),
+                             self.enable_sparse_ledger),
+                    HedgeLeg(TradeType.SELL, hedge_sell_list,
+                             FixedPointTradeSvc(invest_amt, guarantee_amt, leverage_ratio, fee_schedule),
+                             self.enable_sparse_ledger)]
+        long_leg, short_leg = leg_list
+        low_array = np.array([float(kline.low) for kline in kline_list])
+        high_array = np.array([float(kline.high) for kline in kline_list])
+        # 全倉的爆倉損益 (已實現損益會加到帳戶餘額)
+        cross_capital = (invest_amt + guarantee_amt) * 2
+        cross_force_close_key = None
+        cross_force_close = None
+        cross_force_close_idx = None
+        # [kline_idx, hold_end_idx) 已批次寫入
+        hold_end_idx = 0
+        for kline_idx, kline in enumerate(kline_list):
+            if kline_idx < hold_end_idx:
+                continue
+            # 下一根可能觸發交易或爆倉的K棒之前持倉不變，批次寫入
+            hold_end_idx = self.get_next_event_idx(leg_list, low_array, high_array, kline_idx,
+                                                   cross_force_close_idx if is_cross_margin else None)
+            if hold_end_idx > kline_idx:
+                for leg in leg_list:
+                    if not leg.is_closed:
+                        leg.build_hold_txn_detail_list(kline_list, low_array, high_array, kline_idx, hold_end_idx)
+                continue
+            for leg in leg_list:
+                if leg.is_closed:
+                    continue
+                trade_record_list = self.get_triggered_trade_record_list(leg.trade_type, kline, leg.trade_plan_list,
+                                                                         leg.max_trade_plan_price,
+                                                                         leg.min_trade_plan_price, leg.trade_detail)
+                if len(trade_record_list) > 0:
+                    for trade_record in trade_record_list:
+                        leg.fixed_point_trade_svc.build_txn_detail_list(kline, trade_record, leg.trade_detail)
+                        leg.realized_profit += leg.trade_detail.txn_detail_list[-1].profit
+                    if leg.trade_detail.is_circuit_breaker:
+                        return long_leg.trade_detail, short_leg.trade_detail
+                else:
+                    leg.fixed_point_trade_svc.build_txn_detail_list(kline, None, leg.trade_detail)
 
-        trade_plan_price_list = [tp.price for tp in trade_plan_list]
-        max_trade_plan_price = max(trade_plan_price_list)
-        min_trade_plan_price = min(trade_plan_price_list)
-
-        trade_detail = TradeDetail(False, False, [])
-        for kline in kline_list:
-            trade_record_list = []
-            # 逐日確定是否觸發交易
-            for trade_plan in trade_plan_list:
-                if isinstance(trade_plan, FixedPriceInvestAmtDto):
-                    # 確認網格是否被突破
-                    if kline.high > max_trade_plan_price or kline.low < min_trade_plan_price:
-                        trade_detail.is_grid_break = True
-                    # 逐個價位檢查是否被觸發
-                    if not trade_plan.is_traded and kline.high > trade_plan.price > kline.low:
-                        # five_minutes_kline_list = self.get_historical_klines(binance_product, Client.KLINE_INTERVAL_5MINUTE, start_date=kline.start_time, end_date=kline.end_time)
-                        trade_plan.is_traded = True
-
-                        # 觸發交易時紀錄交易紀錄
-                        trade_record = trade_svc.create_trade_record(kline.start_time, trade_type,
-                                                                     trade_plan.price,
-                                                                     amt=trade_plan.amt,
-                                                                     handle_fee_type=HandleFeeType.MAKER)
-                        if trade_record:
-                            trade_record_list.append(trade_record)
-
-            # 如果一個K棒觸發>2個交易區間 => 觸發融斷，結束交易，等到市場穩定
-            # if len(trade_record_list) > 2:
-            #     trade_detail.is_circuit_breaker = True
-            #     # 將手上庫存都賣出
-            #     total_handle_amt = Decimal(0)
-            #     for trade_record in trade_record_list:
-            #         total_handle_amt += trade_record.handle_amt
-            #     total_handle_amt += trade_detail.txn_detail_list[len(trade_detail.txn_detail_list) - 1].handle_amt
-            #     circuit_breaker_trade_type = TradeType.SELL if TradeType.BUY == trade_type else TradeType.BUY
-            #     trade_record_list.append(trade_svc.create_trade_record(kline.end_time, circuit_breaker_trade_type,
-            #                                                            kline.low,
-            #                                                            total_handle_amt,
-            #                                                            HandleFeeType.TAKER))
-
-            if len(trade_record_list) > 0:
-                for trade_record in trade_record_list:
-                    trade_svc.build_txn_detail_list(kline,
-                                                    invest_amt,
-                                                    guarantee_amt,
-                                                    leverage_ratio,
-                                                    trade_record,
-                                                    trade_detail)
-                # 如果一個K棒觸發>2個交易區間 => 觸發融斷，結束交易，等到市場穩定
-                if trade_detail.is_circuit_breaker:
-                    return trade_detail
-            else:
-                trade_svc.build_txn_detail_list(kline,
-                                                invest_amt,
-                                                guarantee_amt,
-                                                leverage_ratio,
-                                                None,
-                                                trade_detail)
             # 確認是否爆倉
-            if trade_svc.check_is_force_close_offset(kline, invest_amt, guarantee_amt, leverage_ratio, trade_detail):
-                break
+            if is_cross_margin:
+                long_td = long_leg.get_last_txn_detail()
+                short_td = short_leg.get_last_txn_detail()
+                if long_td is None and short_td is None:
+                    continue
+                key = (long_td and (long_td.units, long_td.handle_amt, long_td.handling_fee),
+                       short_td and (short_td.units, short_td.handle_amt, short_td.handling_fee))
+                if key != cross_force_close_key:
+                    cross_force_close_key = key
+                    cross_force_close = trade_svc.calc_cross_force_close_offset_price(
+                        -(cross_capital + long_leg.realized_profit + short_leg.realized_profit),
+                        long_td.handle_amt if long_td else Decimal(0),
+                        long_td.handling_fee if long_td else Decimal(0),
+                        long_td.units if long_td else Decimal(0),
+                        short_td.handle_amt if short_td else Decimal(0),
+                        short_td.handling_fee if short_td else Decimal(0),
+                        short_td.units if short_td else Decimal(0),
+                        fee_schedule=fee_schedule)
+                    cross_force_close_idx = None
+                    if cross_force_close:
+                        force_close_offset_price, is_below = cross_force_close
+                        cross_force_close_idx = trade_svc.find_first_passage_idx(
+                            low_array if is_below else high_array, float(force_close_offset_price), is_below,
+                            kline_idx)
+                if cross_force_close_idx == kline_idx:
+                    for leg in leg_list:
+                        leg.build_cross_force_close_txn_detail(kline, cross_force_close[0], fee_schedule)
+                    break
+            else:
+                for leg in leg_list:
+                    if not leg.is_closed and leg.check_is_force_close_offset(kline, kline_idx, low_array, high_array,
+                                                                             invest_amt, guarantee_amt,
+                                                                             leverage_ratio):
+                        leg.is_closed = True
+                if long_leg.is_closed and short_leg.is_closed:
+                    break
+
+        return long_leg.trade_detail, short_leg.trade_detail
+
+    def get_next_event_idx(self, leg_list: List["HedgeLeg"], low_array: np.ndarray, high_array: np.ndarray,
+                           start_idx: int, cross_force_close_idx: int | None) -> int:
+        """
+        start_idx 起第一根可能觸發交易或爆倉的K棒，沒有時回傳K棒數
+        """
+        event_idx_list = [len(low_array), cross_force_close_idx]
+        for leg in leg_list:
+            if not leg.is_closed:
+                event_idx_list.append(leg.get_next_trigger_idx(low_array, high_array, start_idx))
+                event_idx_list.append(leg.force_close_idx)
+        # 之前已確認未爆倉的 force_close_idx 不再是事件
+        return min(event_idx for event_idx in event_idx_list if event_idx is not None and event_idx >= start_idx)
+
+
+class HedgeLeg:
+    """
+    對沖網格單邊 (做多/做空) 的回測狀態
+    """
+
+    def __init__(self, trade_type: TradeType, trade_plan_list: List[FixedPriceInvestAmtDto],
+                 fixed_point_trade_svc: FixedPointTradeSvc, is_sparse: bool):
+        self.trade_type = trade_type
+        self.trade_plan_list = trade_plan_list
+        trade_plan_price_list = [tp.price for tp in trade_plan_list]
+        self.max_trade_plan_price = max(trade_plan_price_list)
+        self.min_trade_plan_price = min(trade_plan_price_list)
+        self.fixed_point_trade_svc = fixed_point_trade_svc
+        self.trade_detail = TradeDetail(False, False, TxnLedger(), is_sparse)
+        # 已實現損益 (交易紀錄 profit 合計)
+        self.realized_profit = Decimal(0)
+        self.is_closed = False
+        # 持倉或強平價改變時才重新搜尋下一個爆倉K棒
+        self.force_close_key = None
+        self.force_close_idx = None
+
+    def get_next_trigger_idx(self, low_array: np.ndarray, high_array: np.ndarray, start_idx: int) -> int | None:
+        """
+        start_idx 起第一根可能觸發未成交價位的K棒 (float 比較 low <= price <= high)
+        實際是否觸發仍由 get_triggered_trade_record_list 以 Decimal 判斷
+        """
+        price_array = np.array([float(tp.price) for tp in self.trade_plan_list
+                                if isinstance(tp, FixedPriceInvestAmtDto) and not tp.is_traded])
+        return trade_svc.find_first_touch_idx(low_array, high_array, price_array, start_idx)
 
-        return trade_detail
+    def build_hold_txn_detail_list(self, kline_list: List[BinanceKline], low_array: np.ndarray,
+                                   high_array: np.ndarray, start_idx: int, end_idx: int):
+        """
+        [start_idx, end_idx) 的K棒不會觸發交易及爆倉: 同 get_triggered_trade_record_list 確認網格是否被突破，
+        並批次寫入持倉不變的 txn_detail
+        """
+        if not self.trade_detail.is_grid_break:
+            # float 先篩出可能突破的K棒，再以 Decimal 確認
+            candidate_idx_array = np.flatnonzero((high_array[start_idx:end_idx] >= float(self.max_trade_plan_price))
+                                                 | (low_array[start_idx:end_idx] <= float(self.min_trade_plan_price)))
+            for kline_idx in candidate_idx_array + start_idx:
+                kline = kline_list[kline_idx]
+                if kline.high > self.max_trade_plan_price or kline.low < self.min_trade_plan_price:
+                    self.trade_detail.is_grid_break = True
+                    break
+        self.fixed_point_trade_svc.build_hold_txn_detail_list(kline_list[start_idx:end_idx], self.trade_detail)
+
+    def get_last_txn_detail(self) -> TxnDetail | None:
+        txn_detail_list = self.trade_detail.txn_detail_list
+        return txn_detail_list[len(txn_detail_list) - 1] if len(txn_detail_list) > 0 else None
+
+    def check_is_force_close_offset(self, kline: BinanceKline, kline_idx: int, low_array: np.ndarray,
+                                    high_array: np.ndarray, invest_amt: Decimal, guarantee_amt: Decimal,
+                                    leverage_ratio: Decimal) -> bool:
+        """
+        逐倉爆倉: 該邊持倉觸及強平價時平倉
+        """
+        last_td = self.get_last_txn_detail()
+        if last_td and (last_td.units, last_td.force_close_offset_price) != self.force_close_key:
+            self.force_close_key = (last_td.units, last_td.force_close_offset_price)
+            self.force_close_idx = trade_svc.find_force_close_idx(low_array, high_array, last_td.units,
+                                                                  last_td.force_close_offset_price, kline_idx)
+        return bool(self.force_close_idx == kline_idx and trade_svc.check_is_force_close_offset(
+            kline, invest_amt, guarantee_amt, leverage_ratio, self.trade_detail))
+
+    def build_cross_force_close_txn_detail(self, kline: BinanceKline, force_close_offset_price: Decimal,
+                                           fee_schedule: FeeSchedule = None):
+        """
+        全倉爆倉，以合併強平價平倉，損益為本邊實際平倉損益
+        """
+        self.is_closed = True
+        last_td = self.get_last_txn_detail()
+        if last_td is None or last_td.units == 0:
+            return
+        profit = trade_svc.calc_profit(force_close_offset_price, last_td.handle_amt, last_td.handling_fee,
+                                       last_td.units, HandleFeeType.TAKER, fee_schedule)
+        profit_ratio = profit / last_td.guarantee_fee if last_td.guarantee_fee else Decimal(0)
+        self.realized_profit += profit
+        self.trade_detail.txn_detail_list.append(
+            TxnDetail(kline.end_time, Decimal(0), Decimal(0), Decimal(0), Decimal(0),
+                      force_close_offset_price, profit, profit_ratio, last_td.total_profit + profit,
+                      Decimal(0), Decimal(0), profit, Decimal(0),
+                      TradeRecord(kline.end_time, TradeType.SELL if last_td.units > 0 else TradeType.BUY,
+                                  force_close_offset_price, abs(last_td.units), HandleFeeType.TAKER,
+                                  TradeReason(TradeReasonType.PASSIVE, "爆倉"))))
@@ -1,18 +1,20 @@
 from dataclasses import dataclass
 from decimal import Decimal
 
-import pandas as pd
+import numpy as np
 from binance import Client
 
 from com.willy.binance.dto.ma_dca_backtest_req import MaDcaBacktestReq
 from com.willy.binance.dto.trade_detail import TradeDetail
+from com.willy.binance.dto.txn_ledger import TxnLedger
 from com.willy.binance.enums.binance_product import BinanceProduct
 from com.willy.binance.enums.handle_fee_type import HandleFeeType
 from com.willy.binance.enums.trade_reason import TradeReasonType, TradeReason
 from com.willy.binance.enums.trade_type import TradeType
-from com.willy.binance.service import trade_svc, chart_service, tech_idx_svc
+from com.willy.binance.service import trade_svc, chart_service, tech_idx_svc, kline_memmap_svc
 from com.willy.binance.service.binance_svc import BinanceSvc
 from com.willy.binance.util import type_util
+from com.willy.binance.util.bar_clock import BarClock
 
 
 @dataclass
@@ -245,7 +247,7 @@ def stop_loss(last_td, row, leverage_ratio, trade_detail, trade_level_list):
                 return True
 
 
-def fake_break(trade_detail, row, date_idx_map, trade_level_list, leverage_ratio):
+def fake_break(trade_detail, row, bar_clock, trade_level_list, leverage_ratio):
     if len(trade_detail.txn_detail_list) > 1:
         non_stop_loss_td_list = [td for td in trade_detail.txn_detail_list if
                                  td.trade_record.reason.trade_reason_type != TradeReasonType.PASSIVE]
@@ -259,9 +261,9 @@ def fake_break(trade_detail, row, date_idx_map, trade_level_list, leverage_ratio
         # 買>賣>馬上突破 > 買
         if last_1_td.trade_record.type != last_2_td.trade_record.type \
                 and ((last_1_td.trade_record.type == TradeType.BUY and row.ma7 < row.ma25 and (
-                date_idx_map[row.start_time] - date_idx_map[last_1_td.trade_record.date]) < 10) \
+                bar_clock.bars_between(last_1_td.trade_record.date, row.start_time)) < 10) \
                      or (last_1_td.trade_record.type == TradeType.SELL and row.ma7 > row.ma25 and (
-                        date_idx_map[row.start_time] - date_idx_map[last_1_td.trade_record.date]) < 10)):
+                        bar_clock.bars_between(last_1_td.trade_record.date, row.start_time)) < 10)):
             # set trade amt
             set_trade_level_by_amt(last_2_td.handle_amt, trade_level_list)
             # build trade record
@@ -311,45 +313,54 @@ def backtest_ma_dca(ma_dca_backtest_req: MaDcaBacktestReq):
     # 撈出股價/MA7/ma25
     binance_svc = BinanceSvc()
 
-    df = pd.read_csv('/data/BTCUSDT_15m.csv', parse_dates=["start_time", "end_time"])
-    if df.iloc[0]['start_time'] <= ma_dca_backtest_req.start_time and df.iloc[-1][
-        'start_time'] >= ma_dca_backtest_req.end_time:
-        # df = df.apply(parse_datetime_row, axis=1)
-        mask = (df["start_time"] >= ma_dca_backtest_req.start_time) & (df["start_time"] <= ma_dca_backtest_req.end_time)
-        df = df.loc[mask]
+    records = binance_svc.get_historical_kline_records(ma_dca_backtest_req.binance_product,
+                                                       Client.KLINE_INTERVAL_15MINUTE,
+                                                       ma_dca_backtest_req.start_time, ma_dca_backtest_req.end_time)
+    df = kline_memmap_svc.records_to_kline_frame(records, Client.KLINE_INTERVAL_15MINUTE)
+    df.attrs[tech_idx_svc.DATA_VERSION_ATTR] = binance_svc.get_kline_data_version(
+        ma_dca_backtest_req.binance_product, Client.KLINE_INTERVAL_15MINUTE, ma_dca_backtest_req.start_time,
+        ma_dca_backtest_req.end_time)
+
+    if ma_dca_backtest_req.use_idx_store:
+        idx_records = binance_svc.get_historical_kline_idx(ma_dca_backtest_req.binance_product,
+                                                           Client.KLINE_INTERVAL_15MINUTE,
+                                                           ma_dca_backtest_req.start_time, ma_dca_backtest_req.end_time)
+        if not np.array_equal(idx_records['start_time'], records['start_time']):
+            raise ValueError(f"kline idx not aligned with records, product[{ma_dca_backtest_req.binance_product}]")
+        for column in ['ma7', 'ma6', 'ma25', 'ma99', 'ma25_diff', 'past20_ma25_growth', 'past20_ma25_fall']:
+            df[column] = idx_records[column]
     else:
-        df = binance_svc.get_historical_klines_df(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_15MINUTE,
-                                                  ma_dca_backtest_req.start_time, ma_dca_backtest_req.end_time)
+        tech_idx_svc.append_ma(df, 7, ma_dca_backtest_req.binance_product, Client.KLINE_INTERVAL_15MINUTE)
+        tech_idx_svc.append_ma(df, 6, ma_dca_backtest_req.binance_product, Client.KLINE_INTERVAL_15MINUTE)
+        tech_idx_svc.append_ma(df, 25, ma_dca_backtest_req.binance_product, Client.KLINE_INTERVAL_15MINUTE)
+        tech_idx_svc.append_ma(df, 99, ma_dca_backtest_req.binance_product, Client.KLINE_INTERVAL_15MINUTE)
 
-    tech_idx_svc.append_ma(df, 7)
-    tech_idx_svc.append_ma(df, 6)
-    tech_idx_svc.append_ma(df, 25)
-    tech_idx_svc.append_ma(df, 99)
+        # MA過去20天是否都上漲/下跌
+        df['ma25_diff'] = df['ma25'].diff()
 
-    # MA過去20天是否都上漲/下跌
-    df['ma25_diff'] = df['ma25'].diff()
+        diff_int = df['ma25_diff'] > 0
+        diff_int = diff_int.astype(int)
+        past20_growth = diff_int.rolling(window=20, min_periods=20).min()
+        df['past20_ma25_growth'] = past20_growth.astype(bool)
 
-    diff_int = df['ma25_diff'] > 0
-    diff_int = diff_int.astype(int)
-    past20_growth = diff_int.rolling(window=20, min_periods=20).min()
-    df['past20_ma25_growth'] = past20_growth.astype(bool)
-
-    diff_ma25_diff = df['ma25_diff'] < 0
-    diff_int = diff_ma25_diff.astype(int)
-    past20_ma25_fall = diff_int.rolling(window=20, min_periods=20).min()
-    df['past20_ma25_fall'] = past20_ma25_fall.astype(bool)
+        diff_ma25_diff = df['ma25_diff'] < 0
+        diff_int = diff_ma25_diff.astype(int)
+        past20_ma25_fall = diff_int.rolling(window=20, min_periods=20).min()
+        df['past20_ma25_fall'] = past20_ma25_fall.astype(bool)
 
     df = df.dropna(axis=0, how="any")
 
     # 逐筆確認買進或賣出
     ma7_and_ma25_rel = 0
-    trade_detail = TradeDetail(False, False, [])
-    idx = 0
-    date_idx_map = {}
+    trade_detail = TradeDetail(False, False, TxnLedger())
+    bar_clock = BarClock(Client.KLINE_INTERVAL_15MINUTE)
+    low_array = df['low'].to_numpy()
+    high_array = df['high'].to_numpy()
+    # 持倉或強平價改變時才重新搜尋下一個爆倉K棒
+    force_close_key = None
+    force_close_idx = None
     for i, r in enumerate(df.itertuples(index=True, name='Row')):
         row = df.iloc[i]
-        date_idx_map[row.start_time] = idx
-        idx += 1
         last_td = trade_detail.txn_detail_list[len(trade_detail.txn_detail_list) - 1] if len(
             trade_detail.txn_detail_list) > 0 else None
 
@@ -362,8 +373,11 @@ def backtest_ma_dca(ma_dca_backtest_req: MaDcaBacktestReq):
             continue
 
         # 確認有沒有爆倉
-        if last_td and ((last_td.units > 0 and Decimal(row.low) < last_td.force_close_offset_price) or (
-                last_td.units < 0 and Decimal(row.high) > last_td.force_close_offset_price)):
+        if last_td and (last_td.units, last_td.force_close_offset_price) != force_close_key:
+            force_close_key = (last_td.units, last_td.force_close_offset_price)
+            force_close_idx = trade_svc.find_force_close_idx(low_array, high_array, last_td.units,
+                                                             last_td.force_close_offset_price, i)
+        if last_td and force_close_idx == i:
             trade_svc.build_txn_detail_list_df(row,
                                                invest_amt,
                                                guarantee_amt,
@@ -382,13 +396,12 @@ def backtest_ma_dca(ma_dca_backtest_req: MaDcaBacktestReq):
             continue
 
         # 如果是假突破或假跌破(5K內又跌/漲回去)，把買/賣的賣/買回來
-        if fake_break(trade_detail, row, date_idx_map, trade_level_list, ma_dca_backtest_req.leverage_ratio):
+        if fake_break(trade_detail, row, bar_clock, trade_level_list, ma_dca_backtest_req.leverage_ratio):
             continue
 
-    for txn_detail in trade_detail.txn_detail_list:
-        df.loc[df['start_time'] == txn_detail.date, 'txn_detail'] = txn_detail
+    trade_svc.set_txn_idx_column(df, trade_detail, bar_clock)
 
-    chart_service.export_trade_point_chart("ma_dca_now1", df, ma_dca_backtest_req)
+    chart_service.export_trade_point_chart("ma_dca_now1", df, ma_dca_backtest_req, trade_detail.txn_detail_list)
 
     # print("date\tunit\thandle_amt\thandle_fee\tprice\tprofit\ttotal_profit\ttr.type\ttr.unit")
     print("date\tunit\tprofit\ttotal_profit\ttr.type\ttr.unit\ttr.reason")
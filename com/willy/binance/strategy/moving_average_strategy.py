@@ -1,19 +1,26 @@
 from datetime import timedelta, datetime
 from decimal import Decimal
+from typing import List
 
 import numpy as np
 import pandas as pd
-from binance import Client
 
 from com.willy.binance.dto.trade_detail import TradeDetail
 from com.willy.binance.dto.trade_record import TradeRecord
+from com.willy.binance.enums.binance_product import BinanceProduct
 from com.willy.binance.enums.handle_fee_type import HandleFeeType
 from com.willy.binance.enums.trade_reason import TradeReason, TradeReasonType
 from com.willy.binance.enums.trade_type import TradeType
-from com.willy.binance.service import tech_idx_svc, trade_svc
+from com.willy.binance.service import tech_idx_svc, trade_svc, kline_store_svc
+from com.willy.binance.service.tech_idx_stream_svc import MaCrossIdxStream
 from com.willy.binance.strategy.ma_dca_strategy import TradeLevel
 from com.willy.binance.strategy.trade_strategy import TradingStrategy
 
+# 停損候選以 float 比較，放寬門檻避免 Decimal 換算誤差漏掉邊界K棒
+STOP_LOSS_PRICE_TOLERANCE = 1e-6
+# 均線 round 到小數 2 位，四捨五入邊界容許差 0.01
+MA_ROUND_TOLERANCE = 0.01 + 1e-9
+
 
 def calc_first_layer_invest_amt(total_invest_amt: Decimal, level_gap: Decimal, levels: Decimal):
     if levels <= 0:
@@ -75,7 +82,20 @@ def trade_if_not_trade_twice(row,
 class MovingAverageStrategy(TradingStrategy):
     invest_amt = 0
     guarantee_amt = 0
-    trade_level_list = []
+
+    def __init__(self, test_name, start_time: datetime, end_time: datetime, initial_capital: int,
+                 product: BinanceProduct, leverage: int, other_args: dict):
+        super().__init__(test_name, start_time, end_time, initial_capital, product, leverage, other_args)
+        # 用投資金額算出投資層數及金額 (只建立一次，prepare_data 每次實盤呼叫都會執行)
+        first_layer_invest_amt = calc_first_layer_invest_amt(
+            Decimal(self.invest_amt * self.leverage),
+            self.other_args["level_amt_change"],
+            self.other_args["dca_levels"])
+        self.trade_level_list = [
+            TradeLevel(False, first_layer_invest_amt * pow(self.other_args["level_amt_change"], i))
+            for i in range(int(self.other_args["dca_levels"]))]
+        # 實盤指標，第一次 get_live_row 時 seed
+        self.idx_stream = None
 
     def get_trade_record(self, row: pd.Series, trade_detail: TradeDetail) -> TradeRecord:
         last_td = self.trade_detail.txn_detail_list[len(self.trade_detail.txn_detail_list) - 1] if len(
@@ -96,78 +116,148 @@ class MovingAverageStrategy(TradingStrategy):
             return trade_record
 
     def get_trade_record_by_date(self, dt: datetime) -> TradeRecord:
-        data_fetch_start = dt - self.lookback_tickets
-
-        # 2. 獲取並準備數據
-        df = self.binance_svc.get_klines(self.product, Client.KLINE_INTERVAL_15MINUTE, data_fetch_start, dt)
-
-        self.prepare_data(self.initial_capital, df, self.other_args)
-
-        # 再篩選一次df，避免拿到多的資料
+        return self.get_trade_record(self.get_live_row(dt), self.trade_detail)
+
+    def get_live_row(self, dt: datetime) -> pd.Series:
+        """
+        實盤: 第一次撈 lookback_tickets 的K棒 seed 指標，之後只撈上次 update 之後的K棒逐根更新
+        dt 那根K棒可能尚未收盤，只試算不放入指標狀態 (下次呼叫時才 update)
+        """
+        if self.idx_stream is None:
+            self.idx_stream = MaCrossIdxStream()
+            fetch_start_time = dt - self.lookback_tickets
+        else:
+            fetch_start_time = self.bar_clock.to_datetime(
+                self.bar_clock.datetime_to_bar_idx(self.idx_stream.last_start_time) + 1)
+        df = self.binance_svc.get_klines(self.product, self.kline_interval, fetch_start_time, dt)
         df = df[(df["start_time"] <= dt)]
-
-        return self.get_trade_record(df.iloc[-1], self.trade_detail)
+        if self.idx_stream.last_start_time is not None:
+            # 重撈的K棒與已放入的重疊時略過
+            df = df[df["start_time"] > self.idx_stream.last_start_time]
+        self.idx_stream.seed(df.iloc[:-1])
+        return self.idx_stream.peek(df.iloc[-1])
+
+    def check_idx_stream(self, df: pd.DataFrame, is_raise: bool = True) -> List[str]:
+        """
+        以 MaCrossIdxStream 逐根重算 df 的指標，和 prepare_data (append_ma / pandas rolling) 比較
+        均線剛好落在四捨五入邊界時 (例 ma6 的 x.xx5)，兩邊浮點誤差不同可能差 1 個最小位數，均線欄位容許此差異
+
+        Args:
+            is_raise: True 時不一致就拋出 ValueError，否則回傳每個不一致欄位的訊息
+        """
+        kline_df = df[[column for column in kline_store_svc.KLINE_COLUMNS if column in df.columns]].copy()
+        self.prepare_data(self.initial_capital, kline_df, self.other_args)
+        idx_stream = MaCrossIdxStream()
+        stream_df = pd.DataFrame([idx_stream.calc(close, True) for close in kline_df['close'].to_numpy()],
+                                 index=kline_df.index)
+        mismatch_list = []
+        for column in stream_df.columns:
+            atol = MA_ROUND_TOLERANCE if column in ('ma7', 'ma6', 'ma25') else 0
+            is_same = np.isclose(stream_df[column].to_numpy(dtype='float64'),
+                                 kline_df[column].to_numpy(dtype='float64'), rtol=1e-9, atol=atol, equal_nan=True)
+            if not np.all(is_same):
+                mismatch_idx = np.flatnonzero(~is_same)[0]
+                message = (f"idx stream mismatch column[{column}]"
+                           f"start_time[{kline_df['start_time'].iloc[mismatch_idx]}]"
+                           f"stream[{stream_df[column].iloc[mismatch_idx]}]"
+                           f"pandas[{kline_df[column].iloc[mismatch_idx]}]")
+                if is_raise:
+                    raise ValueError(message)
+                mismatch_list.append(message)
+        return mismatch_list
+
+    def check_live_signal(self, df: pd.DataFrame, backtest_df: pd.DataFrame, sample_count: int = 200,
+                          max_candidate_count: int = 200, is_raise: bool = True) -> List[str]:
+        mismatch_list = super().check_live_signal(df, backtest_df, sample_count, max_candidate_count, is_raise)
+        # 實盤 get_live_row 改用逐根更新的指標，一併檢查
+        idx_mismatch_list = self.check_idx_stream(df, is_raise)
+        print(f"-> 逐根更新指標與 prepare_data 比較 {len(df)} 根K棒，不一致欄位 {len(idx_mismatch_list)} 個")
+        return mismatch_list + idx_mismatch_list
 
     @property
     def invest_and_guarantee_ratio(self) -> float:
         return 0.5
 
-    def prepare_data(self, initial_capital: int, df: pd.DataFrame, other_args: dict):
-        tech_idx_svc.append_ma(df, 7)
-        tech_idx_svc.append_ma(df, 6)
-        tech_idx_svc.append_ma(df, 25)
-
-        # MA過去20天是否都上漲/下跌
-        df['ma25_diff'] = df['ma25'].diff()
-
-        # ma25 過去20天是否連續上漲
-        diff_int = df['ma25_diff'] > 0
-        diff_int = diff_int.astype(int)
-        past20_growth = diff_int.rolling(window=20, min_periods=20).min()
-        df['past20_ma25_growth'] = past20_growth.astype(bool)
-
-        # ma25 過去20天是否連續下跌
-        diff_ma25_diff = df['ma25_diff'] < 0
-        diff_int = diff_ma25_diff.astype(int)
-        past20_ma25_fall = diff_int.rolling(window=20, min_periods=20).min()
-        df['past20_ma25_fall'] = past20_ma25_fall.astype(bool)
-
-        # 用投資金額算出投資層數及金額
-        first_layer_invest_amt = calc_first_layer_invest_amt(
-            Decimal(self.invest_amt * self.leverage),
-            self.other_args["level_amt_change"],
-            self.other_args["dca_levels"])
+    @property
+    def idx_store_columns(self) -> List[str]:
+        return ['ma7', 'ma6', 'ma25', 'ma25_diff', 'past20_ma25_growth', 'past20_ma25_fall']
 
-        for i in range(int(self.other_args["dca_levels"])):
-            self.trade_level_list.append(
-                TradeLevel(False, first_layer_invest_amt * pow(self.other_args["level_amt_change"], i)))
+    def prepare_data(self, initial_capital: int, df: pd.DataFrame, other_args: dict):
+        # use_idx_store 時已由 load_backtest_df 讀入
+        if not set(self.idx_store_columns).issubset(df.columns):
+            tech_idx_svc.append_ma(df, 7, self.product, self.kline_interval)
+            tech_idx_svc.append_ma(df, 6, self.product, self.kline_interval)
+            tech_idx_svc.append_ma(df, 25, self.product, self.kline_interval)
+
+            # MA過去20天是否都上漲/下跌
+            df['ma25_diff'] = df['ma25'].diff()
+
+            # ma25 過去20天是否連續上漲
+            diff_int = df['ma25_diff'] > 0
+            diff_int = diff_int.astype(int)
+            past20_growth = diff_int.rolling(window=20, min_periods=20).min()
+            df['past20_ma25_growth'] = past20_growth.astype(bool)
+
+            # ma25 過去20天是否連續下跌
+            diff_ma25_diff = df['ma25_diff'] < 0
+            diff_int = diff_ma25_diff.astype(int)
+            past20_ma25_fall = diff_int.rolling(window=20, min_periods=20).min()
+            df['past20_ma25_fall'] = past20_ma25_fall.astype(bool)
 
         # ma7_and_ma25_rel
         diff_sign = np.sign(df['ma7'] - df['ma25'])  # 1, 0, -1
 
-        ma_rel = []
-        current_len = 0
-        current_sign = 0
-        for s in diff_sign:
-            if s == 0:
-                # 無方向性，重置
-                current_len = 0
-                current_sign = 0
-                ma_rel.append(0)
-            elif np.isnan(s):
-                ma_rel.append(0)
-            else:
-                if s == current_sign:
-                    current_len += 1
-                else:
-                    current_len = 1
-                    current_sign = s
-                # 將日數轉成輸出值，前提是你要的輸出就是日數本身
-                ma_rel.append(current_len * int(np.sign(current_sign)))
-
-        df['ma7_and_ma25_rel'] = ma_rel
+        df['ma7_and_ma25_rel'] = tech_idx_svc.calc_sign_streak(diff_sign)
         df['last_ma7_and_ma25_rel'] = df['ma7_and_ma25_rel'].shift(1)
 
+    def get_signal_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        # 實盤只有 lookback_tickets 內的K棒，ma7_and_ma25_rel 會被截短，只比較是否達到 20 期的門檻
+        last_rel = df['last_ma7_and_ma25_rel'].astype('float64')
+        return pd.DataFrame({'cross_ma7_and_ma25_rel': np.sign(last_rel) * (last_rel.abs() >= 20),
+                             'ma7_and_ma25_sign': np.sign(df['ma7'].astype('float64') - df['ma25'].astype('float64')),
+                             'past20_ma25_growth': df['past20_ma25_growth'].astype('float64'),
+                             'past20_ma25_fall': df['past20_ma25_fall'].astype('float64')}, index=df.index)
+
+    def get_candidate_mask(self, df: pd.DataFrame) -> np.ndarray:
+        # 同 trade_if_cross_ma 的進場條件
+        last_rel = df['last_ma7_and_ma25_rel'].to_numpy()
+        ma7 = df['ma7'].to_numpy()
+        ma25 = df['ma25'].to_numpy()
+        return (np.abs(last_rel) >= 20) & (
+                ((last_rel > 0) & (ma7 < ma25) & ~df['past20_ma25_growth'].to_numpy(dtype=bool))
+                | ((last_rel < 0) & (ma7 > ma25) & ~df['past20_ma25_fall'].to_numpy(dtype=bool)))
+
+    def get_position_event_idx(self, df: pd.DataFrame, start_time_array: np.ndarray, start_idx: int) -> int | None:
+        txn_detail_list = self.trade_detail.txn_detail_list
+        last_td = txn_detail_list[len(txn_detail_list) - 1]
+        event_idx_list = []
+
+        # 停損: 價格越過均價±1000點 (是否虧損由 get_stop_loss_trade_record 判斷)
+        if last_td.units != 0:
+            avg_price = abs(last_td.handle_amt / last_td.units)
+            if last_td.units > 0:
+                stop_loss_idx = trade_svc.find_first_passage_idx(
+                    df['low'].to_numpy(), float(avg_price - 1000) + STOP_LOSS_PRICE_TOLERANCE, True, start_idx)
+            else:
+                stop_loss_idx = trade_svc.find_first_passage_idx(
+                    df['high'].to_numpy(), float(avg_price + 1000) - STOP_LOSS_PRICE_TOLERANCE, False, start_idx)
+            if stop_loss_idx is not None:
+                event_idx_list.append(stop_loss_idx)
+
+        # 假突破: 最後一筆主動交易後10根K棒內都要檢查
+        if len(txn_detail_list) > 1:
+            non_stop_loss_td_list = [td for td in txn_detail_list if
+                                     td.trade_record.reason.trade_reason_type != TradeReasonType.PASSIVE]
+            if len(non_stop_loss_td_list) > 0:
+                last_trade_bar_idx = self.bar_clock.datetime_to_bar_idx(non_stop_loss_td_list[-1].trade_record.date)
+                fake_break_end_idx = np.searchsorted(start_time_array,
+                                                     self.bar_clock.to_timestamp_ms(last_trade_bar_idx + 10),
+                                                     side='left')
+                if start_idx < fake_break_end_idx:
+                    event_idx_list.append(start_idx)
+
+        return min(event_idx_list) if len(event_idx_list) > 0 else None
+
     @property
     def lookback_tickets(self) -> timedelta:
         return timedelta(minutes=15 * 100)
@@ -254,7 +344,8 @@ class MovingAverageStrategy(TradingStrategy):
 
     def get_stop_loss_trade_record(self, last_td, row, leverage_ratio, trade_detail, trade_level_list):
         if last_td:
-            unrealize_profit = trade_svc.calc_profit(row.close, last_td.handle_amt, last_td.handling_fee, last_td.units)
+            unrealize_profit = trade_svc.calc_profit(row.close, last_td.handle_amt, last_td.handling_fee, last_td.units,
+                                                     fee_schedule=self.fee_schedule)
             if unrealize_profit and unrealize_profit > 0:
                 is_need_close = False
                 # if abs(df.iloc[i - 2].ma7 - df.iloc[i - 2].ma25) > abs(df.iloc[i - 1].ma7 - df.iloc[i - 1].ma25) > abs(
@@ -301,9 +392,9 @@ class MovingAverageStrategy(TradingStrategy):
             # 買>賣>馬上突破 > 買
             if last_1_td.trade_record.type != last_2_td.trade_record.type \
                     and ((last_1_td.trade_record.type == TradeType.BUY and row.ma7 < row.ma25 and (
-                    self.date_idx_map[row.start_time] - self.date_idx_map[last_1_td.trade_record.date]) < 10) \
+                    self.bar_clock.bars_between(last_1_td.trade_record.date, row.start_time)) < 10) \
                          or (last_1_td.trade_record.type == TradeType.SELL and row.ma7 > row.ma25 and (
-                            self.date_idx_map[row.start_time] - self.date_idx_map[last_1_td.trade_record.date]) < 10)):
+                            self.bar_clock.bars_between(last_1_td.trade_record.date, row.start_time)) < 10)):
                 # set trade amt
                 set_trade_level_by_amt(last_2_td.handle_amt, self.trade_level_list)
                 # build trade record
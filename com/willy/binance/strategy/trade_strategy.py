@@ -1,19 +1,31 @@
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
 from decimal import Decimal
+from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
 from binance import Client
 
+from com.willy.binance.config.fee_schedule import load_fee_schedule
+from com.willy.binance.dto.backtest_scenario import BacktestScenario
+from com.willy.binance.dto.scenario_backtest_res import ScenarioBacktestRes
 from com.willy.binance.dto.trade_detail import TradeDetail
 from com.willy.binance.dto.trade_record import TradeRecord
+from com.willy.binance.dto.txn_ledger import TxnLedger
 from com.willy.binance.enums.binance_product import BinanceProduct
 from com.willy.binance.enums.trade_reason import TradeReason, TradeReasonType
-from com.willy.binance.service import trade_svc, chart_service
+from com.willy.binance.service import trade_svc, chart_service, kline_memmap_svc, kline_store_svc, tech_idx_svc
 from com.willy.binance.service.binance_svc import BinanceSvc
+from com.willy.binance.service.scenario_trade_svc import ScenarioTradeSvc
+from com.willy.binance.util import type_util
+from com.willy.binance.util.bar_clock import BarClock
 
 
 class TradingStrategy(ABC):
+    # 回測時 idx_store_columns 改由 kline_idx_store_svc 預先算好的欄位讀取，prepare_data 不再重算
+    use_idx_store = False
+
     def __init__(self, test_name, start_time: datetime,
                  end_time: datetime,
                  initial_capital: int,
@@ -29,8 +41,11 @@ class TradingStrategy(ABC):
         self.invest_amt = round(float(self.invest_and_guarantee_ratio * initial_capital), 2)
         self.guarantee_amt = initial_capital - self.invest_amt
         self.binance_svc = BinanceSvc()
-        self.trade_detail = TradeDetail(False, False, [])
-        self.date_idx_map = {}
+        self.trade_detail = TradeDetail(False, False, TxnLedger())
+        self.kline_interval = Client.KLINE_INTERVAL_15MINUTE
+        self.bar_clock = BarClock(self.kline_interval)
+        # 手續費表只在建立時讀一次設定檔
+        self.fee_schedule = load_fee_schedule(product)
 
     @property
     @abstractmethod
@@ -42,6 +57,13 @@ class TradingStrategy(ABC):
     def invest_and_guarantee_ratio(self) -> float:
         pass
 
+    @property
+    def idx_store_columns(self) -> List[str]:
+        """
+        prepare_data 會用到且可由 kline_idx_store_svc 讀取的欄位
+        """
+        return []
+
     @abstractmethod
     def prepare_data(self, initial_capital: int, df: pd.DataFrame, other_args: dict) -> pd.DataFrame:
         """
@@ -71,64 +93,281 @@ class TradingStrategy(ABC):
         """
         pass
 
-    def run_backtest(self):
-        # print(f"===== 啟動回測引擎: {product} =====")
+    def get_live_row(self, dt: datetime) -> pd.Series:
+        """
+        實盤: 撈 dt 前 lookback_tickets 的K棒重新 prepare_data，回傳 dt 那根K棒 (含指標)
+        """
+        df = self.binance_svc.get_klines(self.product, self.kline_interval, dt - self.lookback_tickets, dt)
+        return self.prepare_live_window(df, dt)
+
+    def prepare_live_window(self, df: pd.DataFrame, dt: datetime) -> pd.Series:
+        self.prepare_data(self.initial_capital, df, self.other_args)
+        # 再篩選一次df，避免拿到多的資料
+        df = df[(df["start_time"] <= dt)]
+        return df.iloc[-1]
+
+    def get_signal_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        決定交易訊號的欄位，check_live_signal 比較實盤/離線指標時使用，預設為 prepare_data 新增的欄位
+        """
+        return df.drop(columns=[column for column in kline_store_svc.KLINE_COLUMNS if column in df.columns])
+
+    def check_live_signal(self, df: pd.DataFrame, backtest_df: pd.DataFrame, sample_count: int = 200,
+                          max_candidate_count: int = 200, is_raise: bool = True) -> List[str]:
+        """
+        離線回測的指標由整段K棒 prepare_data 一次算出，實盤只用 lookback_tickets 內的K棒計算
+        抽樣回測K棒 (均勻抽樣 + 最多 max_candidate_count 根 get_candidate_mask 候選K棒)，以實盤方式重算並比較 get_signal_frame
+
+        Args:
+            is_raise: True 時第一個不一致就拋出 ValueError，否則檢查完回傳所有不一致的訊息
+
+        Returns: 不一致的訊息
+        """
+        if len(backtest_df) == 0:
+            return []
+        candidate_pos_array = np.array([], dtype=int)
+        candidate_mask = self.get_candidate_mask(backtest_df)
+        if candidate_mask is not None:
+            candidate_pos_array = np.flatnonzero(candidate_mask)
+            if len(candidate_pos_array) > max_candidate_count:
+                # 候選K棒過多時均勻取 max_candidate_count 根
+                candidate_pos_array = candidate_pos_array[
+                    np.linspace(0, len(candidate_pos_array) - 1, max_candidate_count).astype(int)]
+        sample_pos_array = np.unique(np.r_[
+            np.linspace(0, len(backtest_df) - 1, min(sample_count, len(backtest_df))).astype(int),
+            candidate_pos_array])
+        start_time_array = kline_store_svc.to_timestamp_ms_array(df['start_time'])
+        lookback_ms = int(self.lookback_tickets.total_seconds() * 1000)
+        offline_signal_df = self.get_signal_frame(backtest_df)
+        kline_df = df[[column for column in kline_store_svc.KLINE_COLUMNS if column in df.columns]]
+        mismatch_list = []
+        for sample_pos in sample_pos_array:
+            row = backtest_df.iloc[sample_pos]
+            row_ms = type_util.datetime_to_timestamp_ms(row.start_time)
+            # 同 get_live_row 撈 [dt - lookback_tickets, dt] 的K棒
+            window_start_idx = np.searchsorted(start_time_array, row_ms - lookback_ms, side='left')
+            window_end_idx = np.searchsorted(start_time_array, row_ms, side='right')
+            live_row = self.prepare_live_window(kline_df.iloc[window_start_idx:window_end_idx].copy(),
+                                                row.start_time)
+            live_signal = self.get_signal_frame(live_row.to_frame().T).iloc[0]
+            offline_signal = offline_signal_df.iloc[sample_pos]
+            is_same = np.isclose(live_signal.to_numpy(dtype='float64'), offline_signal.to_numpy(dtype='float64'),
+                                 rtol=1e-9, atol=0, equal_nan=True)
+            if not np.all(is_same):
+                message = (f"live/offline signal mismatch start_time[{row.start_time}]"
+                           f"columns[{list(offline_signal.index[~is_same])}]"
+                           f"live[{live_signal[~is_same].tolist()}]offline[{offline_signal[~is_same].tolist()}]")
+                if is_raise:
+                    raise ValueError(message)
+                mismatch_list.append(message)
+        print(f"-> 實盤/離線訊號檢查 {len(sample_pos_array)} 根K棒，不一致 {len(mismatch_list)} 根")
+        return mismatch_list
+
+    def get_candidate_mask(self, df: pd.DataFrame) -> np.ndarray | None:
+        """
+        [事件驅動回測] 只用 prepare_data 的欄位，向量化標出可能產生進場訊號的K棒
+        須為實際會交易K棒的超集，None 表示每根K棒都要執行 get_trade_record
+        """
+        return None
+
+    def get_position_event_idx(self, df: pd.DataFrame, start_time_array: np.ndarray, start_idx: int) -> int | None:
+        """
+        [事件驅動回測] 依目前持倉及交易紀錄 (self.trade_detail) 回傳 start_idx 起第一根可能觸發交易 (停損/停利等) 的K棒
+        有交易紀錄後才會呼叫，爆倉由回測引擎處理，預設每根K棒都要檢查
 
+        Args:
+            start_time_array: df start_time 的 epoch ms
+        Returns: K棒位置，持倉不變期間不會觸發時回傳 None
+        """
+        return start_idx
+
+    def load_backtest_df(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Returns: (含 lookback 的 df, 回測期間且指標齊全的 backtest_df)
+        """
         # 1. 計算數據撈取範圍
         data_fetch_start = self.start_time - self.lookback_tickets
 
         # 2. 獲取並準備數據
-        df = self.binance_svc.get_historical_klines_df(self.product, Client.KLINE_INTERVAL_15MINUTE, data_fetch_start,
-                                                       self.end_time)
-        df.set_index('start_time')
+        records = self.binance_svc.get_historical_kline_records(self.product, self.kline_interval,
+                                                                data_fetch_start, self.end_time)
+        df = kline_memmap_svc.records_to_kline_frame(records, self.kline_interval)
+        # 指標快取以 store 的 partition 版本當作 data version，不需每次 hash 整段K棒
+        df.attrs[tech_idx_svc.DATA_VERSION_ATTR] = self.binance_svc.get_kline_data_version(
+            self.product, self.kline_interval, data_fetch_start, self.end_time)
+        if self.use_idx_store and len(self.idx_store_columns) > 0:
+            idx_records = self.binance_svc.get_historical_kline_idx(self.product, self.kline_interval,
+                                                                    data_fetch_start, self.end_time)
+            if not np.array_equal(idx_records['start_time'], records['start_time']):
+                raise ValueError(f"kline idx not aligned with records, product[{self.product}]")
+            for column in self.idx_store_columns:
+                df[column] = idx_records[column]
         self.prepare_data(self.initial_capital, df, self.other_args)
 
         # 3. 過濾出回測期間的數據
-        backtest_df = df.loc[df["start_time"] >= self.start_time]
+        start_idx = self.bar_clock.locate(records['start_time'], type_util.datetime_to_timestamp_ms(self.start_time),
+                                          is_ceil=True)
+        backtest_df = df.iloc[start_idx:]
         backtest_df = backtest_df.dropna(axis=0, how="any")
+        return df, backtest_df
+
+    def build_force_close_txn_detail(self, row, last_td):
+        trade_svc.build_txn_detail_list_df(row,
+                                           self.invest_amt,
+                                           self.guarantee_amt,
+                                           self.leverage,
+                                           trade_svc.create_close_trade_record(row.start_time,
+                                                                               last_td.force_close_offset_price,
+                                                                               last_td,
+                                                                               reason=TradeReason(
+                                                                                   TradeReasonType.PASSIVE,
+                                                                                   "爆倉")),
+                                           self.trade_detail, self.fee_schedule)
+
+    def export_chart(self, df: pd.DataFrame):
+        chart_service.export_trade_point_chart(self.test_name, df, {
+            "start_time": self.start_time
+            , "end_time": self.end_time
+            , "initial_capital": self.initial_capital
+            , "product": self.product
+            , "leverage": self.leverage
+            , "other_args": self.other_args}, self.trade_detail.txn_detail_list)
+
+    def run_backtest(self, is_live_signal: bool = False, check_signal_sample_count: int = 20,
+                     is_check_live_signal: bool = True):
+        """
+        Args:
+            is_live_signal: True 時每根K棒以 get_trade_record_by_date (實盤方式重撈K棒計算指標) 取得交易，
+                            否則以 prepare_data 一次算好的列呼叫 get_trade_record
+            check_signal_sample_count: 離線模式先以 check_live_signal 抽樣檢查實盤/離線訊號的K棒數 (均勻及候選K棒各取)
+            is_check_live_signal: False 時不檢查，實盤/離線訊號不一致時拋出 ValueError 中斷回測
+        """
+        # print(f"===== 啟動回測引擎: {product} =====")
+        df, backtest_df = self.load_backtest_df()
+        if not is_live_signal and is_check_live_signal and check_signal_sample_count > 0:
+            self.check_live_signal(df, backtest_df, check_signal_sample_count, check_signal_sample_count)
 
         # 5. 核心日期迴圈
         print(f"-> 策略將在 {len(backtest_df)} 個交易日中運行...")
         row_idx = 0
+        low_array = backtest_df['low'].to_numpy()
+        high_array = backtest_df['high'].to_numpy()
+        # 持倉或強平價改變時才重新搜尋下一個爆倉K棒
+        force_close_key = None
+        force_close_idx = None
         for index, row in backtest_df.iterrows():
-            self.date_idx_map[row.start_time] = row_idx
             row_idx += 1
 
             if row_idx % 1000 == 0:
                 print(f"finish {row_idx} / {backtest_df.shape[0]}")
             # --- I. 獲取策略決策 ---
-            # trade_record = self.get_trade_record(row, self.trade_detail)
-            trade_record = self.get_trade_record_by_date(row.start_time)
+            if is_live_signal:
+                trade_record = self.get_trade_record_by_date(row.start_time)
+            else:
+                trade_record = self.get_trade_record(row, self.trade_detail)
 
             trade_svc.build_txn_detail_list_df(row, self.invest_amt, self.guarantee_amt, self.leverage, trade_record,
-                                               self.trade_detail)
+                                               self.trade_detail, self.fee_schedule)
 
             # --- II. 模擬交易計算 ---
             # 確認有沒有爆倉
             last_td = self.trade_detail.txn_detail_list[len(self.trade_detail.txn_detail_list) - 1] if len(
                 self.trade_detail.txn_detail_list) > 0 else None
-            if last_td and ((last_td.units > 0 and Decimal(row.low) < last_td.force_close_offset_price) or (
-                    last_td.units < 0 and Decimal(row.high) > last_td.force_close_offset_price)):
-                trade_svc.build_txn_detail_list_df(row,
-                                                   self.invest_amt,
-                                                   self.guarantee_amt,
-                                                   self.leverage,
-                                                   trade_svc.create_close_trade_record(row.start_time,
-                                                                                       last_td.force_close_offset_price,
-                                                                                       last_td,
-                                                                                       reason=TradeReason(
-                                                                                           TradeReasonType.PASSIVE,
-                                                                                           "爆倉")),
-                                                   self.trade_detail)
+            if last_td and (last_td.units, last_td.force_close_offset_price) != force_close_key:
+                force_close_key = (last_td.units, last_td.force_close_offset_price)
+                force_close_idx = trade_svc.find_force_close_idx(low_array, high_array, last_td.units,
+                                                                 last_td.force_close_offset_price, row_idx - 1)
+            if last_td and force_close_idx == row_idx - 1:
+                self.build_force_close_txn_detail(row, last_td)
                 continue
 
-        for txn_detail in self.trade_detail.txn_detail_list:
-            df.loc[df['start_time'] == txn_detail.date, 'txn_detail'] = txn_detail
+        trade_svc.set_txn_idx_column(df, self.trade_detail, self.bar_clock)
 
-        chart_service.export_trade_point_chart(self.test_name, df, {
-            "start_time": self.start_time
-            , "end_time": self.end_time
-            , "initial_capital": self.initial_capital
-            , "product": self.product
-            , "leverage": self.leverage
-            , "other_args": self.other_args})
+        self.export_chart(df)
+
+    def run_event_kernel(self, backtest_df: pd.DataFrame):
+        """
+        事件驅動回測核心: 只在事件K棒 (get_candidate_mask 候選、get_position_event_idx 持倉事件、爆倉)
+        執行 get_trade_record，其他K棒持倉不變直接跳過，txn_detail 只記錄交易 (sparse ledger)
+        """
+        self.trade_detail = TradeDetail(False, False, TxnLedger(), True)
+        txn_detail_list = self.trade_detail.txn_detail_list
+
+        bar_count = len(backtest_df)
+        start_time_array = kline_store_svc.to_timestamp_ms_array(backtest_df['start_time'])
+        low_array = backtest_df['low'].to_numpy()
+        high_array = backtest_df['high'].to_numpy()
+        candidate_mask = self.get_candidate_mask(backtest_df)
+        candidate_idx_array = np.arange(bar_count) if candidate_mask is None else np.flatnonzero(candidate_mask)
+
+        force_close_key = None
+        force_close_idx = None
+        event_count = 0
+        bar_idx = 0
+        while bar_idx < bar_count:
+            last_td = txn_detail_list[len(txn_detail_list) - 1] if len(txn_detail_list) > 0 else None
+            # 下一個事件K棒: 候選訊號、持倉事件、爆倉取最早者
+            next_idx_list = []
+            candidate_pos = np.searchsorted(candidate_idx_array, bar_idx, side='left')
+            if candidate_pos < len(candidate_idx_array):
+                next_idx_list.append(int(candidate_idx_array[candidate_pos]))
+            if last_td:
+                if (last_td.units, last_td.force_close_offset_price) != force_close_key:
+                    force_close_key = (last_td.units, last_td.force_close_offset_price)
+                    force_close_idx = trade_svc.find_force_close_idx(low_array, high_array, last_td.units,
+                                                                     last_td.force_close_offset_price, bar_idx)
+                if force_close_idx is not None:
+                    next_idx_list.append(force_close_idx)
+                position_event_idx = self.get_position_event_idx(backtest_df, start_time_array, bar_idx)
+                if position_event_idx is not None:
+                    next_idx_list.append(position_event_idx)
+            if len(next_idx_list) == 0:
+                break
+            bar_idx = min(next_idx_list)
+            event_count += 1
+
+            row = backtest_df.iloc[bar_idx]
+            trade_record = self.get_trade_record(row, self.trade_detail)
+            trade_svc.build_txn_detail_list_df(row, self.invest_amt, self.guarantee_amt, self.leverage, trade_record,
+                                               self.trade_detail, self.fee_schedule)
+
+            # 確認有沒有爆倉 (交易後強平價改變時由本K棒重新搜尋)
+            last_td = txn_detail_list[len(txn_detail_list) - 1] if len(txn_detail_list) > 0 else None
+            if last_td and (last_td.units, last_td.force_close_offset_price) != force_close_key:
+                force_close_key = (last_td.units, last_td.force_close_offset_price)
+                force_close_idx = trade_svc.find_force_close_idx(low_array, high_array, last_td.units,
+                                                                 last_td.force_close_offset_price, bar_idx)
+            if last_td and force_close_idx == bar_idx:
+                self.build_force_close_txn_detail(row, last_td)
+            bar_idx += 1
+        print(f"-> 策略在 {bar_count} 根K棒中執行 {event_count} 根事件K棒")
+
+    def run_event_backtest(self):
+        """
+        事件驅動回測: prepare_data 只算一次，每根K棒的損益由 trade_svc.derive_bar_profit_df 向量化補上
+        """
+        df, backtest_df = self.load_backtest_df()
+        self.run_event_kernel(backtest_df)
+
+        # 事件之間持倉不變，每根K棒的損益向量化補上
+        start_time_array = kline_store_svc.to_timestamp_ms_array(backtest_df['start_time'])
+        bar_profit_df = trade_svc.derive_bar_profit_df(start_time_array, backtest_df['close'].to_numpy(),
+                                                       self.trade_detail, fee_schedule=self.fee_schedule)
+        df['total_profit'] = 0.0
+        df.loc[backtest_df.index, 'total_profit'] = bar_profit_df['total_profit'].to_numpy()
+        trade_svc.set_txn_idx_column(df, self.trade_detail, self.bar_clock)
+
+        self.export_chart(df)
+
+    def run_scenario_backtest(self, scenario_list: List[BacktestScenario]) -> List[ScenarioBacktestRes]:
+        """
+        交易訊號與本金/槓桿/手續費類別無關，K棒及 prepare_data 只算一次，
+        以本身設定跑一次事件驅動回測後，由 ScenarioTradeSvc 一次算出各設定的 ledger 及績效
+        """
+        df, backtest_df = self.load_backtest_df()
+        self.run_event_kernel(backtest_df)
+        scenario_trade_svc = ScenarioTradeSvc(scenario_list, self.invest_and_guarantee_ratio, self.fee_schedule)
+        return scenario_trade_svc.backtest(kline_store_svc.to_timestamp_ms_array(backtest_df['start_time']),
+                                           backtest_df['low'].to_numpy(), backtest_df['high'].to_numpy(),
+                                           backtest_df['close'].to_numpy(), self.trade_detail,
+                                           self.invest_amt * self.leverage)
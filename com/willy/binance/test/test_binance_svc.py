@@ -0,0 +1,42 @@
+import unittest
+
+from binance import Client
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.binance_svc import BinanceSvc
+from com.willy.binance.util import type_util
+
+
+class FakeClient:
+    def __init__(self):
+        self.call_list = []
+
+    def get_historical_klines(self, symbol, interval, start_ms, end_ms):
+        self.call_list.append((symbol, interval, start_ms, end_ms))
+        open_time_list = [type_util.str_date_to_timestamp("20250101"), type_util.str_date_to_timestamp("20250201")]
+        return [[open_time, "100.0", "110.0", "90.0", "105.0", "1.5", next_open_time - 1, "150.0", 10, "0.7",
+                 "70.0", "0"] for open_time, next_open_time in
+                zip(open_time_list, open_time_list[1:] + [type_util.str_date_to_timestamp("20250301")])]
+
+
+class FailSyncSvc:
+    def sync(self, *args):
+        raise AssertionError("monthly klines should not be synced into the kline store")
+
+
+class BinanceSvcTest(unittest.TestCase):
+
+    def test_monthly_klines_df_from_rest(self):
+        # 不經過 __init__ (需要 api key 設定)
+        binance_svc = BinanceSvc.__new__(BinanceSvc)
+        binance_svc.client = FakeClient()
+        binance_svc.kline_sync_svc = FailSyncSvc()
+        df = binance_svc.get_historical_klines_df(BinanceProduct.BTCUSDT, Client.KLINE_INTERVAL_1MONTH,
+                                                  type_util.str_to_date("20250101"), type_util.str_to_date("20250228"))
+        self.assertEqual(len(df), 2)
+        self.assertEqual(binance_svc.client.call_list[0][1], "1M")
+        self.assertEqual(df['close'].tolist(), [105.0, 105.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import random
+import unittest
+from dataclasses import fields
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from com.willy.binance.config.fee_schedule import FeeSchedule, DEFAULT_FEE_RATE_MAP
+from com.willy.binance.dto.binance_kline import BinanceKline
+from com.willy.binance.dto.trade_detail import TradeDetail
+from com.willy.binance.dto.trade_record import TradeRecord
+from com.willy.binance.dto.txn_detail import TxnDetail
+from com.willy.binance.dto.txn_ledger import TxnLedger
+from com.willy.binance.enums.handle_fee_type import HandleFeeType
+from com.willy.binance.enums.trade_type import TradeType
+from com.willy.binance.service import trade_svc
+from com.willy.binance.service.fixed_point_trade_svc import FixedPointTradeSvc
+
+
+class FixedPointTradeSvcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fee_schedule = FeeSchedule(DEFAULT_FEE_RATE_MAP, {(HandleFeeType.TAKER, TradeType.BUY): Decimal("0.0004")})
+        self.invest_amt = Decimal(1000)
+        self.guarantee_amt = Decimal(3000)
+
+    def build_kline_trade_list(self, seed: int, is_partial_close: bool, bar_count: int = 60):
+        """
+        隨機價格及交易 [(kline, trade_record | None)]
+        is_partial_close=False 時反向交易的單位數一定大於持倉 (直接反手)，不會部分平倉
+        反向交易單位數不會剛好等於持倉 (全部平倉後無交易的K棒兩個版本都無法計算損益)
+        """
+        rng = random.Random(seed)
+        price = Decimal("90000.00")
+        start_time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        units = Decimal(0)
+        kline_trade_list = []
+        for i in range(bar_count):
+            price = (price * Decimal(1 + rng.uniform(-0.01, 0.01))).quantize(Decimal("0.01"))
+            kline = BinanceKline(start_time, price, price + Decimal("50.12"), price - Decimal("43.27"), price,
+                                 Decimal(1), start_time, 1)
+            trade_record = None
+            if i == 0 or rng.random() < 0.3:
+                trade_type = rng.choice([TradeType.BUY, TradeType.SELL])
+                trade_units = Decimal(rng.randint(1, 50)) / 1000
+                is_reduce = units != 0 and (units > 0) == (trade_type == TradeType.SELL)
+                if is_reduce and is_partial_close:
+                    trade_units = min(trade_units, abs(units) - Decimal("0.001"))
+                elif is_reduce:
+                    trade_units = abs(units) + trade_units
+                if trade_units > 0:
+                    units += trade_units if trade_type == TradeType.BUY else -trade_units
+                    trade_record = TradeRecord(start_time, trade_type, price, trade_units,
+                                               rng.choice([HandleFeeType.MAKER, HandleFeeType.TAKER]), "")
+            kline_trade_list.append((kline, trade_record))
+            start_time += timedelta(minutes=15)
+        return kline_trade_list
+
+    def build_decimal_trade_detail(self, kline_trade_list, leverage_ratio: Decimal, txn_detail_list) -> TradeDetail:
+        trade_detail = TradeDetail(False, False, txn_detail_list)
+        for kline, trade_record in kline_trade_list:
+            trade_svc.build_txn_detail_list(kline, self.invest_amt, self.guarantee_amt, leverage_ratio, trade_record,
+                                            trade_detail, self.fee_schedule)
+        return trade_detail
+
+    def build_fixed_point_trade_detail(self, kline_trade_list, leverage_ratio: Decimal, txn_detail_list,
+                                       is_batch_hold: bool = False) -> TradeDetail:
+        """
+        is_batch_hold: 連續沒有交易的K棒以 build_hold_txn_detail_list 一次寫入
+        """
+        trade_detail = TradeDetail(False, False, txn_detail_list)
+        fixed_point_trade_svc = FixedPointTradeSvc(self.invest_amt, self.guarantee_amt, leverage_ratio,
+                                                   self.fee_schedule)
+        hold_kline_list = []
+        for kline, trade_record in kline_trade_list:
+            if is_batch_hold and trade_record is None:
+                hold_kline_list.append(kline)
+                continue
+            fixed_point_trade_svc.build_hold_txn_detail_list(hold_kline_list, trade_detail)
+            hold_kline_list = []
+            fixed_point_trade_svc.build_txn_detail_list(kline, trade_record, trade_detail)
+        fixed_point_trade_svc.build_hold_txn_detail_list(hold_kline_list, trade_detail)
+        return trade_detail
+
+    def assert_same_txn_detail_list(self, decimal_list, fixed_point_list, seed: int):
+        self.assertEqual(len(decimal_list), len(fixed_point_list))
+        for decimal_txn_detail, fixed_point_txn_detail in zip(decimal_list, fixed_point_list):
+            for field in fields(TxnDetail):
+                self.assertEqual(getattr(decimal_txn_detail, field.name), getattr(fixed_point_txn_detail, field.name),
+                                 f"seed[{seed}]date[{decimal_txn_detail.date}]field[{field.name}]")
+
+    def test_same_as_decimal_without_partial_close(self):
+        for seed in range(100):
+            leverage_ratio = Decimal(random.Random(seed).choice([10, 20, 100, "12.5"]))
+            kline_trade_list = self.build_kline_trade_list(seed, False)
+            self.assert_same_txn_detail_list(
+                self.build_decimal_trade_detail(kline_trade_list, leverage_ratio, []).txn_detail_list,
+                self.build_fixed_point_trade_detail(kline_trade_list, leverage_ratio, []).txn_detail_list, seed)
+
+    def test_partial_close(self):
+        partial_close_count = 0
+        for seed in range(100):
+            leverage_ratio = Decimal(random.Random(seed).choice([10, 20, 100, "12.5"]))
+            kline_trade_list = self.build_kline_trade_list(seed, True)
+            decimal_list = self.build_decimal_trade_detail(kline_trade_list, leverage_ratio, []).txn_detail_list
+            self.assert_same_txn_detail_list(
+                decimal_list,
+                self.build_fixed_point_trade_detail(kline_trade_list, leverage_ratio, []).txn_detail_list, seed)
+            partial_close_count += sum(txn_detail.trade_record is not None and txn_detail.profit != 0
+                                       for txn_detail in decimal_list)
+        self.assertGreater(partial_close_count, 0)
+
+    def test_build_hold_txn_detail_list(self):
+        for seed in range(50):
+            leverage_ratio = Decimal(random.Random(seed).choice([10, 20, 100, "12.5"]))
+            kline_trade_list = self.build_kline_trade_list(seed, seed % 2 == 0, 200)
+            decimal_ledger = self.build_decimal_trade_detail(kline_trade_list, leverage_ratio,
+                                                             TxnLedger()).txn_detail_list
+            self.assert_same_txn_detail_list(
+                decimal_ledger,
+                self.build_fixed_point_trade_detail(kline_trade_list, leverage_ratio, [], True).txn_detail_list,
+                seed)
+            fixed_point_ledger = self.build_fixed_point_trade_detail(kline_trade_list, leverage_ratio, TxnLedger(),
+                                                                     True).txn_detail_list
+            self.assert_same_txn_detail_list(decimal_ledger, fixed_point_ledger, seed)
+            self.assertTrue(decimal_ledger.to_frame().equals(fixed_point_ledger.to_frame()), f"seed[{seed}]")
+
+    def test_build_hold_txn_detail_list_sparse(self):
+        kline_trade_list = self.build_kline_trade_list(0, False)
+        trade_detail = TradeDetail(False, False, TxnLedger(), True)
+        fixed_point_trade_svc = FixedPointTradeSvc(self.invest_amt, self.guarantee_amt, Decimal(10),
+                                                   self.fee_schedule)
+        fixed_point_trade_svc.build_txn_detail_list(*kline_trade_list[0], trade_detail)
+        fixed_point_trade_svc.build_hold_txn_detail_list([kline for kline, _ in kline_trade_list[1:]], trade_detail)
+        self.assertEqual(len(trade_detail.txn_detail_list), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
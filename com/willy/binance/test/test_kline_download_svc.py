@@ -0,0 +1,211 @@
+import json
+import random
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service import kline_download_svc
+from com.willy.binance.service.kline_download_svc import KlineDownloadSvc, KlineDownloadError, KlineThrottledError
+from com.willy.binance.service.kline_download_svc import RequestWeightBudget, USED_WEIGHT_HEADER
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc
+from com.willy.binance.util import type_util
+
+
+class FakeClock:
+    """
+    取代 kline_download_svc 的 time，sleep 直接推進時間，不需真的等到下一分鐘
+    """
+
+    def __init__(self, now: float):
+        self.now = now
+        self.lock = threading.Lock()
+
+    def time(self) -> float:
+        with self.lock:
+            return self.now
+
+    def sleep(self, sec: float):
+        with self.lock:
+            self.now += sec
+
+
+class MockKlineHandler(BaseHTTPRequestHandler):
+    """
+    本地的 /api/v3/klines，回傳合成K棒及已使用 weight header
+    clock 有設定時依 clock 的分鐘計算 weight，並記錄每個 request 的 (分鐘, startTime)
+    """
+    clock = None
+    request_weight = 2
+    # 其他 client 在同一分鐘已使用的 weight
+    other_weight = 0
+    max_delay_sec = 0.0
+    # 前幾個 request 回 429
+    reject_count = 0
+    retry_after_sec = 30
+    # 一律回 429 / 500 的 shard startTime
+    reject_start_ms_set = set()
+    error_start_ms_set = set()
+
+    @classmethod
+    def reset(cls):
+        cls.lock = threading.Lock()
+        cls.request_list = []
+        cls.minute_weight_map = {}
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        interval_ms = type_util.kline_interval_to_ms(query["interval"][0])
+        start_ms = int(query["startTime"][0])
+        end_ms = int(query["endTime"][0])
+        limit = int(query["limit"][0])
+        with self.lock:
+            minute = int(self.clock.time() // 60) if self.clock else 0
+            self.request_list.append((minute, start_ms))
+            if start_ms in self.error_start_ms_set:
+                self.send_response(500)
+                self.end_headers()
+                return
+            if self.reject_count > 0 or start_ms in self.reject_start_ms_set:
+                type(self).reject_count = max(self.reject_count - 1, 0)
+                self.send_response(429)
+                self.send_header("Retry-After", str(self.retry_after_sec))
+                self.end_headers()
+                return
+            self.minute_weight_map[minute] = self.minute_weight_map.get(minute, 0) + self.request_weight
+            used_weight = self.minute_weight_map[minute] + self.other_weight
+        if self.max_delay_sec > 0:
+            # 讓 shard 不依送出順序完成
+            time.sleep(random.uniform(0, self.max_delay_sec))
+        klines = []
+        for open_time in range(start_ms, end_ms + 1, interval_ms)[:limit]:
+            price = 10000 + open_time // interval_ms % 100
+            klines.append([open_time, f"{price}.00", f"{price + 5}.00", f"{price - 5}.00", f"{price + 1}.00",
+                           "1.5", open_time + interval_ms - 1, "15000.0", 10, "0.7", "7000.0", "0"])
+        body = json.dumps(klines).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header(USED_WEIGHT_HEADER, str(used_weight))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class KlineDownloadSvcTest(unittest.TestCase):
+
+    def setUp(self):
+        # 每個 test 用各自的 handler 類別，設定及記錄不互相影響
+        self.handler = type("TestKlineHandler", (MockKlineHandler,), {})
+        self.handler.reset()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/api"
+        self.start_ms = type_util.str_date_to_timestamp("20240101")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_download_yield_shards_in_order(self):
+        self.handler.max_delay_sec = 0.02
+        svc = KlineDownloadSvc(base_url=self.base_url, max_workers=8, bars_per_request=100,
+                               weight_budget=RequestWeightBudget(weight_limit=100000))
+        end_ms = self.start_ms + 60 * 1000 * 5000 - 1
+        shard_list = []
+        for shard_start_ms, shard_end_ms, klines in svc.download(BinanceProduct.BTCUSDT, "1m", self.start_ms,
+                                                                 end_ms):
+            shard_list.append((shard_start_ms, shard_end_ms))
+            self.assertEqual(len(klines), 100)
+            self.assertEqual(klines[0][0], shard_start_ms)
+            self.assertEqual(klines[-1][0], shard_end_ms)
+        self.assertEqual(shard_list, svc.split_shards(self.start_ms, end_ms, "1m"))
+        # 並行下載時 server 收到的順序不一定依時間，但 yield 的順序要依時間
+        self.assertEqual(sorted(start_ms for _, start_ms in self.handler.request_list),
+                         [shard_start_ms for shard_start_ms, _ in shard_list])
+
+    def test_download_to_store(self):
+        svc = KlineDownloadSvc(base_url=self.base_url, max_workers=4, bars_per_request=1000,
+                               weight_budget=RequestWeightBudget(weight_limit=100000))
+        kline_store_svc = KlineStoreSvc(tempfile.mkdtemp())
+        end_ms = type_util.str_date_to_timestamp("20240301")
+        download_count = svc.download_to_store(kline_store_svc, BinanceProduct.BTCUSDT, "1m", self.start_ms,
+                                               end_ms, flush_rows=20000)
+        bar_count = (end_ms - self.start_ms) // 60000 + 1
+        self.assertEqual(download_count, bar_count)
+        self.assertEqual(kline_store_svc.read_manifest(BinanceProduct.BTCUSDT, "1m")["ranges"],
+                         [[self.start_ms, end_ms]])
+        store_df = kline_store_svc.read(BinanceProduct.BTCUSDT, "1m", self.start_ms, end_ms)
+        self.assertEqual(store_df['start_time'].tolist(), list(range(self.start_ms, end_ms + 1, 60000)))
+
+    def test_weight_budget_throttle(self):
+        clock = FakeClock(self.start_ms / 1000)
+        self.handler.clock = clock
+        # 每分鐘額度 10，每個 request weight 2，其他 client 已用 4: 依 header 校正後每分鐘只能送 3 個
+        self.handler.other_weight = 4
+        svc = KlineDownloadSvc(base_url=self.base_url, max_workers=1, request_weight=2, bars_per_request=100,
+                               weight_budget=RequestWeightBudget(weight_limit=10, safety_ratio=1.0))
+        end_ms = self.start_ms + 60 * 1000 * 1200 - 1
+        with mock.patch.object(kline_download_svc, "time", clock):
+            shard_list = list(svc.download(BinanceProduct.BTCUSDT, "1m", self.start_ms, end_ms))
+        self.assertEqual(len(shard_list), 12)
+        minute_count_map = {}
+        for minute, _ in self.handler.request_list:
+            minute_count_map[minute] = minute_count_map.get(minute, 0) + 1
+        self.assertEqual(sorted(minute_count_map.values()), [3, 3, 3, 3])
+
+    def test_retry_after_429(self):
+        clock = FakeClock(self.start_ms / 1000)
+        self.handler.clock = clock
+        self.handler.reject_count = 1
+        svc = KlineDownloadSvc(base_url=self.base_url, max_workers=1, bars_per_request=100,
+                               weight_budget=RequestWeightBudget(weight_limit=100000))
+        end_ms = self.start_ms + 60 * 1000 * 300 - 1
+        with mock.patch.object(kline_download_svc, "time", clock):
+            shard_list = list(svc.download(BinanceProduct.BTCUSDT, "1m", self.start_ms, end_ms))
+        self.assertEqual([shard_start_ms for shard_start_ms, _, _ in shard_list],
+                         [self.start_ms + i * 6000000 for i in range(3)])
+        # 第一個 shard 被拒後等 Retry-After 再重送
+        self.assertEqual(len(self.handler.request_list), 4)
+        self.assertGreaterEqual(clock.time() - self.start_ms / 1000, self.handler.retry_after_sec)
+
+    def test_throttled_flush_downloaded_shards(self):
+        clock = FakeClock(self.start_ms / 1000)
+        self.handler.clock = clock
+        # 第 3 個 shard 一直被限流
+        self.handler.reject_start_ms_set = {self.start_ms + 2 * 6000000}
+        svc = KlineDownloadSvc(base_url=self.base_url, max_workers=1, bars_per_request=100, max_retries=2,
+                               weight_budget=RequestWeightBudget(weight_limit=100000))
+        kline_store_svc = KlineStoreSvc(tempfile.mkdtemp())
+        end_ms = self.start_ms + 60 * 1000 * 500 - 1
+        with mock.patch.object(kline_download_svc, "time", clock):
+            with self.assertRaises(KlineThrottledError) as context:
+                svc.download_to_store(kline_store_svc, BinanceProduct.BTCUSDT, "1m", self.start_ms, end_ms)
+        self.assertEqual(context.exception.start_ms, self.start_ms + 2 * 6000000)
+        # 前 2 個 shard 已寫入，之後只需補下載剩下的區間
+        self.assertEqual(kline_store_svc.read_manifest(BinanceProduct.BTCUSDT, "1m")["ranges"],
+                         [[self.start_ms, self.start_ms + 2 * 6000000 - 60000]])
+        self.assertEqual(svc.session_list, [])
+
+    def test_http_error(self):
+        self.handler.error_start_ms_set = {self.start_ms + 6000000}
+        svc = KlineDownloadSvc(base_url=self.base_url, max_workers=4, bars_per_request=100,
+                               weight_budget=RequestWeightBudget(weight_limit=100000))
+        kline_store_svc = KlineStoreSvc(tempfile.mkdtemp())
+        end_ms = self.start_ms + 60 * 1000 * 500 - 1
+        with self.assertRaises(KlineDownloadError) as context:
+            svc.download_to_store(kline_store_svc, BinanceProduct.BTCUSDT, "1m", self.start_ms, end_ms)
+        self.assertNotIsInstance(context.exception, KlineThrottledError)
+        self.assertIsInstance(context.exception.__cause__, requests.HTTPError)
+        self.assertEqual(svc.session_list, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
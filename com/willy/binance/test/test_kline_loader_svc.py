@@ -0,0 +1,61 @@
+import unittest
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_loader_svc import KlineLoaderSvc
+from com.willy.binance.service.kline_memmap_svc import KLINE_RECORD_DTYPE
+from com.willy.binance.util import type_util
+
+INTERVAL_MS = 15 * 60 * 1000
+
+
+class FakeBinanceSvc:
+    """
+    同 BinanceSvc.get_historical_kline_records: 只回傳到 now_ms 為止已收盤的K棒
+    """
+
+    def __init__(self, start_ms: int):
+        self.start_ms = start_ms
+        self.now_ms = start_ms
+        self.fetch_count = 0
+
+    def get_historical_kline_records(self, binance_product, kline_interval, start_time, end_time) -> np.ndarray:
+        self.fetch_count += 1
+        end_ms = min(type_util.datetime_to_timestamp_ms(end_time),
+                     type_util.last_closed_kline_start_ms(kline_interval, self.now_ms))
+        start_time_array = np.arange(max(type_util.datetime_to_timestamp_ms(start_time), self.start_ms), end_ms + 1,
+                                     INTERVAL_MS)
+        records = np.zeros(len(start_time_array), dtype=KLINE_RECORD_DTYPE)
+        records['start_time'] = start_time_array
+        records['close'] = start_time_array // INTERVAL_MS
+        return records
+
+
+class KlineLoaderSvcTest(unittest.TestCase):
+
+    def test_load_bars_closed_after_cached(self):
+        start_time = type_util.str_to_datetime("2025-01-01T00:00:00Z")
+        binance_svc = FakeBinanceSvc(type_util.datetime_to_timestamp_ms(start_time))
+        kline_loader_svc = KlineLoaderSvc(binance_svc)
+        clock = SimpleNamespace(time=lambda: binance_svc.now_ms / 1000)
+        end_time = start_time + timedelta(days=1)
+        with mock.patch.object(type_util, "time", clock):
+            binance_svc.now_ms += 10 * INTERVAL_MS
+            self.assertEqual(len(kline_loader_svc.load(BinanceProduct.BTCUSDT, "15m", start_time, end_time)), 10)
+            # 沒有新收盤的K棒時直接用快取
+            self.assertEqual(len(kline_loader_svc.load(BinanceProduct.BTCUSDT, "15m", start_time, end_time)), 10)
+            self.assertEqual(binance_svc.fetch_count, 1)
+            # 之後收盤的K棒要再撈，不可回傳快取中截斷的資料
+            binance_svc.now_ms += 5 * INTERVAL_MS
+            records = kline_loader_svc.load(BinanceProduct.BTCUSDT, "15m", start_time, end_time)
+            self.assertEqual(len(records), 15)
+            self.assertTrue(np.array_equal(np.diff(records['start_time']), np.full(14, INTERVAL_MS)))
+            self.assertEqual(binance_svc.fetch_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
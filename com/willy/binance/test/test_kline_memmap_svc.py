@@ -0,0 +1,68 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_memmap_svc import KlineMemmapSvc
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc
+from com.willy.binance.util import type_util
+
+INTERVAL_MS = 60 * 60 * 1000
+
+
+def build_kline_frame(start_ms: int, count: int) -> pd.DataFrame:
+    start_time_array = start_ms + np.arange(count) * INTERVAL_MS
+    close = (start_time_array // INTERVAL_MS % 1000).astype('float64')
+    return pd.DataFrame({'start_time': pd.to_datetime(start_time_array, unit='ms', utc=True), 'open': close,
+                         'high': close + 1, 'low': close - 1, 'close': close, 'vol': 1.0,
+                         'end_time': pd.to_datetime(start_time_array + INTERVAL_MS - 1, unit='ms', utc=True),
+                         'number_of_trade': 1})
+
+
+class KlineMemmapSvcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kline_store_svc = KlineStoreSvc(tempfile.mkdtemp())
+        self.kline_memmap_svc = KlineMemmapSvc(self.kline_store_svc)
+        self.start_ms = type_util.str_date_to_timestamp("20240101")
+
+    def test_stale_by_store_version(self):
+        self.kline_store_svc.write(BinanceProduct.BTCUSDT, "1h", build_kline_frame(self.start_ms, 24 * 40))
+        self.assertEqual(len(self.kline_memmap_svc.open(BinanceProduct.BTCUSDT, "1h")), 24 * 40)
+        self.assertFalse(self.kline_memmap_svc.is_stale(BinanceProduct.BTCUSDT, "1h"))
+        self.kline_store_svc.write(BinanceProduct.BTCUSDT, "1h",
+                                   build_kline_frame(self.start_ms + 24 * 40 * INTERVAL_MS, 24))
+        # .npy 的 mtime 比 manifest 新 (例如 build 讀到舊資料但較晚完成) 仍需判斷為過期
+        records_path = self.kline_memmap_svc.get_records_path(BinanceProduct.BTCUSDT, "1h")
+        os.utime(records_path, (time.time() + 60, time.time() + 60))
+        self.assertTrue(self.kline_memmap_svc.is_stale(BinanceProduct.BTCUSDT, "1h"))
+        self.assertEqual(len(self.kline_memmap_svc.open(BinanceProduct.BTCUSDT, "1h")), 24 * 41)
+
+    def test_build_during_write(self):
+        self.kline_store_svc.write(BinanceProduct.BTCUSDT, "1h", build_kline_frame(self.start_ms, 24 * 60))
+        is_done = threading.Event()
+
+        def write_loop():
+            for day in range(60, 120):
+                self.kline_store_svc.write(BinanceProduct.BTCUSDT, "1h",
+                                           build_kline_frame(self.start_ms + day * 24 * INTERVAL_MS, 24))
+            is_done.set()
+
+        thread = threading.Thread(target=write_loop)
+        thread.start()
+        while not is_done.is_set():
+            records = self.kline_memmap_svc.open(BinanceProduct.BTCUSDT, "1h")
+            # 每次 build 的內容都是某個完整的 store 版本: 連續且沒有補 0 的K棒
+            self.assertTrue(np.array_equal(records['start_time'],
+                                           self.start_ms + np.arange(len(records)) * INTERVAL_MS))
+        thread.join()
+        self.assertEqual(len(self.kline_memmap_svc.open(BinanceProduct.BTCUSDT, "1h")), 24 * 120)
+
+
+if __name__ == '__main__':
+    unittest.main()
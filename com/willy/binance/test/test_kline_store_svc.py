@@ -0,0 +1,63 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service.kline_store_svc import KlineStoreSvc, read_lock_info
+
+
+class ManifestLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kline_store_svc = KlineStoreSvc(tempfile.mkdtemp(), lock_timeout=1)
+        self.lock_path = self.kline_store_svc.get_manifest_lock_path(BinanceProduct.BTCUSDT, "1m")
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write_lock(self, pid: int, token: str, age_sec: float = 0):
+        with open(self.lock_path, "w", encoding="utf-8") as f:
+            json.dump({"host": socket.gethostname(), "pid": pid, "token": token}, f)
+        lock_mtime = time.time() - age_sec
+        os.utime(self.lock_path, (lock_mtime, lock_mtime))
+
+    def test_break_lock_of_dead_pid(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        self.write_lock(process.pid, "dead")
+        with self.kline_store_svc.manifest_lock(BinanceProduct.BTCUSDT, "1m"):
+            self.assertEqual(read_lock_info(self.lock_path)["pid"], os.getpid())
+        self.assertFalse(self.lock_path.exists())
+
+    def test_keep_lock_of_alive_pid(self):
+        # 持有者仍在執行，即使 lock 檔超過 lock_timeout 也不可破除
+        process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+        try:
+            self.write_lock(process.pid, "alive", age_sec=120)
+            with self.assertRaises(TimeoutError):
+                with self.kline_store_svc.manifest_lock(BinanceProduct.BTCUSDT, "1m"):
+                    pass
+            self.assertEqual(read_lock_info(self.lock_path)["token"], "alive")
+        finally:
+            process.kill()
+            process.wait()
+
+    def test_not_unlink_lock_of_others(self):
+        with self.kline_store_svc.manifest_lock(BinanceProduct.BTCUSDT, "1m"):
+            # 模擬 lock 被別人取得
+            self.write_lock(os.getpid(), "other")
+        self.assertEqual(read_lock_info(self.lock_path)["token"], "other")
+
+    def test_break_empty_lock_after_timeout(self):
+        self.lock_path.touch()
+        os.utime(self.lock_path, (time.time() - 120, time.time() - 120))
+        with self.kline_store_svc.manifest_lock(BinanceProduct.BTCUSDT, "1m"):
+            pass
+        self.assertFalse(self.lock_path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
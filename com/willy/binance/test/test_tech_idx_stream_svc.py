@@ -0,0 +1,132 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from com.willy.binance.service import tech_idx_svc
+from com.willy.binance.service.tech_idx_stream_svc import RollingMean, RollingAllTrue, SignStreak, MaCrossIdxStream
+from com.willy.binance.strategy.moving_average_strategy import MovingAverageStrategy
+
+START_MS = 1704067200000
+INTERVAL_MS = 15 * 60 * 1000
+
+
+def build_close_array() -> np.ndarray:
+    """
+    收盤價皆為 1/8 的倍數，移動平均的總和沒有浮點誤差，逐根更新與 pandas rolling 的結果應完全相同
+    依序為: 持平 (ma7 == ma25、ma25_diff == 0)、均線剛好落在四捨五入邊界 (x.125 / x.625)、上漲、下跌、震盪
+    """
+    flat = np.full(40, 100.0)
+    # ma6 = 100 + 0.75 / 6 = 100.125、ma25 = 100 + 3.125 / 25 = 100.125
+    tie = np.r_[np.full(6, 100.0), 100.75, np.full(30, 100.0), 103.125, np.full(30, 100.0), 103.75,
+                np.full(10, 100.0)]
+    trend = np.r_[100 + np.arange(1, 41) * 0.5, 120 - np.arange(1, 41) * 0.375]
+    wave = np.round((105 + 6 * np.sin(np.arange(200) / 9)) * 8) / 8
+    return np.r_[flat, tie, trend, wave]
+
+
+def build_kline_frame(close_array: np.ndarray) -> pd.DataFrame:
+    start_time_array = START_MS + np.arange(len(close_array)) * INTERVAL_MS
+    return pd.DataFrame({'start_time': pd.to_datetime(start_time_array, unit='ms', utc=True), 'open': close_array,
+                         'high': close_array, 'low': close_array, 'close': close_array, 'vol': 1.0,
+                         'end_time': pd.to_datetime(start_time_array + INTERVAL_MS - 1, unit='ms', utc=True),
+                         'number_of_trade': 1})
+
+
+def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
+    # 不給 product / interval，append_ma 不經由指標快取
+    strategy = MovingAverageStrategy.__new__(MovingAverageStrategy)
+    strategy.product = None
+    strategy.kline_interval = None
+    df = df.copy()
+    strategy.prepare_data(0, df, {})
+    return df
+
+
+class TechIdxStreamSvcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kline_df = build_kline_frame(build_close_array())
+        self.expect_df = prepare_data(self.kline_df)
+
+    def assert_column_equal(self, stream_df: pd.DataFrame, expect_df: pd.DataFrame):
+        for column in stream_df.columns:
+            np.testing.assert_array_equal(stream_df[column].to_numpy(dtype='float64'),
+                                          expect_df[column].to_numpy(dtype='float64'), err_msg=column)
+
+    def test_expect_frame(self):
+        # 確認序列涵蓋暖機 NaN、均線相等、四捨五入邊界
+        self.assertTrue(self.expect_df['ma25'].iloc[:24].isna().all())
+        self.assertIn(0, self.expect_df['ma7_and_ma25_rel'].iloc[24:].to_numpy())
+        self.assertIn(0.0, self.expect_df['ma25_diff'].to_numpy())
+        self.assertIn(100.12, self.expect_df['ma6'].to_numpy())
+        self.assertIn(100.12, self.expect_df['ma25'].to_numpy())
+        self.assertIn(100.62, self.expect_df['ma6'].to_numpy())
+        self.assertTrue(self.expect_df['past20_ma25_growth'].iloc[24:].any())
+        self.assertTrue(self.expect_df['past20_ma25_fall'].iloc[24:].any())
+
+    def test_update(self):
+        idx_stream = MaCrossIdxStream()
+        stream_df = pd.DataFrame([idx_stream.update(kline) for _, kline in self.kline_df.iterrows()],
+                                 index=self.kline_df.index)
+        self.assert_column_equal(stream_df, self.expect_df)
+
+    def test_seed_and_peek(self):
+        seed_count = 60
+        idx_stream = MaCrossIdxStream()
+        idx_stream.seed(self.kline_df.iloc[:seed_count])
+        row_list = []
+        for _, kline in self.kline_df.iloc[seed_count:].iterrows():
+            # peek 不改變狀態，之後 update 的結果相同
+            peek_row = idx_stream.peek(kline)
+            self.assertTrue(peek_row.equals(idx_stream.peek(kline)))
+            row = idx_stream.update(kline)
+            self.assertTrue(peek_row.equals(row))
+            row_list.append(row)
+        self.assert_column_equal(pd.DataFrame(row_list, index=self.kline_df.index[seed_count:]),
+                                 self.expect_df.iloc[seed_count:])
+
+    def test_check_start_time(self):
+        idx_stream = MaCrossIdxStream()
+        idx_stream.seed(self.kline_df.iloc[:10])
+        with self.assertRaises(ValueError):
+            idx_stream.update(self.kline_df.iloc[9])
+        with self.assertRaises(ValueError):
+            idx_stream.seed(self.kline_df.iloc[5:12])
+
+    def test_rolling_mean(self):
+        close = self.kline_df['close']
+        for window in (6, 7, 25):
+            rolling_mean = RollingMean(window)
+            stream_array = []
+            for value in close.to_numpy():
+                stream_array.append(rolling_mean.peek(value))
+                rolling_mean.push(value)
+            np.testing.assert_array_equal(np.array(stream_array),
+                                          tech_idx_svc.calc_sma(self.kline_df, window, decimals=2))
+
+    def test_rolling_all_true(self):
+        flag_array = np.r_[np.ones(25, dtype=bool), False, np.ones(30, dtype=bool), np.zeros(3, dtype=bool),
+                           np.ones(20, dtype=bool)]
+        expect_array = pd.Series(flag_array).astype(int).rolling(window=20, min_periods=20).min().astype(bool)
+        rolling_all_true = RollingAllTrue(20)
+        stream_array = []
+        for flag in flag_array:
+            stream_array.append(rolling_all_true.peek(flag))
+            rolling_all_true.push(flag)
+        np.testing.assert_array_equal(np.array(stream_array), expect_array.to_numpy())
+
+    def test_sign_streak(self):
+        sign_array = np.array([np.nan, np.nan, 1, 1, np.nan, 1, 0, 0, 1, -1, -1, 0, -1, np.nan, -1, 1, 1, 1])
+        sign_streak = SignStreak()
+        stream_array = []
+        for sign in sign_array:
+            stream_array.append(sign_streak.peek(sign))
+            sign_streak.push(sign)
+        np.testing.assert_array_equal(np.array(stream_array), tech_idx_svc.calc_sign_streak(sign_array))
+        np.testing.assert_array_equal(np.array(stream_array),
+                                      [0, 0, 1, 2, 0, 3, 0, 0, 1, -1, -2, 0, -1, 0, -2, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
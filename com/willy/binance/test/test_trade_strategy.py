@@ -0,0 +1,111 @@
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from com.willy.binance.config.fee_schedule import FeeSchedule, DEFAULT_FEE_RATE_MAP
+from com.willy.binance.enums.binance_product import BinanceProduct
+from com.willy.binance.service import kline_memmap_svc, chart_service
+from com.willy.binance.strategy import trade_strategy
+from com.willy.binance.strategy.moving_average_strategy import MovingAverageStrategy
+from com.willy.binance.util import type_util
+
+INTERVAL_MS = 15 * 60 * 1000
+START_MS = type_util.str_date_to_timestamp("20240101")
+
+
+def build_kline_records(count: int) -> np.ndarray:
+    """
+    固定的K棒: 正弦波疊加緩慢趨勢，均線會多次交叉
+    """
+    records = np.zeros(count, dtype=kline_memmap_svc.KLINE_RECORD_DTYPE)
+    bar_idx = np.arange(count)
+    close = np.round(60000 + 1500 * np.sin(bar_idx / 40) + 2 * bar_idx, 2)
+    open_ = np.r_[close[0], close[:-1]]
+    records['start_time'] = START_MS + bar_idx * INTERVAL_MS
+    records['open'] = open_
+    records['close'] = close
+    records['high'] = np.maximum(open_, close) + 30
+    records['low'] = np.minimum(open_, close) - 30
+    records['vol'] = 1.0
+    records['number_of_trade'] = 1
+    return records
+
+
+class FakeBinanceSvc:
+
+    def __init__(self, records: np.ndarray):
+        self.records = records
+
+    def get_historical_kline_records(self, binance_product, kline_interval, start_time, end_time):
+        return self.records
+
+    def get_kline_data_version(self, binance_product, kline_interval, start_time, end_time):
+        return "test"
+
+
+class CumulativeStrategy(trade_strategy.TradingStrategy):
+    """
+    訊號依整段K棒累加，實盤只用 lookback 內的K棒時必定不一致
+    """
+
+    @property
+    def lookback_tickets(self) -> timedelta:
+        return timedelta(hours=10)
+
+    @property
+    def invest_and_guarantee_ratio(self) -> float:
+        return 0.5
+
+    def prepare_data(self, initial_capital: int, df: pd.DataFrame, other_args: dict):
+        df['close_sum'] = df['close'].cumsum()
+        return df
+
+    def get_trade_record_by_date(self, dt):
+        return None
+
+    def get_trade_record(self, row, trade_detail):
+        return None
+
+
+class TradingStrategyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = build_kline_records(3000)
+        patcher_list = [mock.patch.object(trade_strategy, "BinanceSvc", lambda: FakeBinanceSvc(self.records)),
+                        mock.patch.object(trade_strategy, "load_fee_schedule",
+                                          lambda product: FeeSchedule(DEFAULT_FEE_RATE_MAP)),
+                        mock.patch.object(chart_service, "export_trade_point_chart", lambda *args: None)]
+        for patcher in patcher_list:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def build_strategy(self, strategy_class):
+        return strategy_class("test", type_util.timestamp_to_datetime(START_MS / 1000 + 3 * 86400),
+                              type_util.timestamp_to_datetime(START_MS / 1000 + 365 * 86400), 50000,
+                              BinanceProduct.BTCUSDT, 20, {"level_amt_change": 1, "dca_levels": 5})
+
+    def test_check_live_signal(self):
+        strategy = self.build_strategy(MovingAverageStrategy)
+        df, backtest_df = strategy.load_backtest_df()
+        self.assertEqual(strategy.check_live_signal(df, backtest_df, 50, 50, is_raise=False), [])
+
+        # 竄改第一根 (必定抽樣) K棒的離線指標
+        backtest_df = backtest_df.copy()
+        column_idx = backtest_df.columns.get_loc('past20_ma25_fall')
+        backtest_df.iloc[0, column_idx] = not backtest_df.iloc[0, column_idx]
+        with self.assertRaises(ValueError):
+            strategy.check_live_signal(df, backtest_df, 50, 50)
+        self.assertEqual(len(strategy.check_live_signal(df, backtest_df, 50, 50, is_raise=False)), 1)
+
+    def test_run_backtest_check_live_signal(self):
+        with self.assertRaises(ValueError):
+            self.build_strategy(CumulativeStrategy).run_backtest()
+        self.build_strategy(CumulativeStrategy).run_backtest(is_check_live_signal=False)
+        self.build_strategy(MovingAverageStrategy).run_backtest()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+from dataclasses import FrozenInstanceError
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pandas as pd
+
+from com.willy.binance.config.fee_schedule import FeeSchedule, DEFAULT_FEE_RATE_MAP
+from com.willy.binance.dto.binance_kline import BinanceKline
+from com.willy.binance.dto.trade_detail import TradeDetail
+from com.willy.binance.dto.trade_record import TradeRecord
+from com.willy.binance.dto.txn_ledger import TxnLedger
+from com.willy.binance.enums.handle_fee_type import HandleFeeType
+from com.willy.binance.enums.trade_type import TradeType
+from com.willy.binance.service import trade_svc
+from com.willy.binance.util.bar_clock import BarClock
+
+
+class TxnLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        # 同一組K棒及交易分別寫入 list 及 TxnLedger，部分平倉讓金額/報酬率超過 float 精度
+        fee_schedule = FeeSchedule(DEFAULT_FEE_RATE_MAP)
+        self.list_trade_detail = TradeDetail(False, False, [])
+        self.ledger_trade_detail = TradeDetail(False, False, TxnLedger(capacity=2))
+        self.start_time = start_time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        trade_map = {0: (TradeType.BUY, Decimal("0.003")), 3: (TradeType.BUY, Decimal("0.004")),
+                     5: (TradeType.SELL, Decimal("0.003")), 8: (TradeType.SELL, Decimal("0.001"))}
+        for i in range(10):
+            price = Decimal("90000.13") + Decimal(i * 37) / 100
+            kline = BinanceKline(start_time, price, price + 50, price - 40, price, Decimal(1), start_time, 1)
+            trade_record = None
+            if i in trade_map:
+                trade_record = TradeRecord(start_time, trade_map[i][0], price, trade_map[i][1], HandleFeeType.TAKER,
+                                           "")
+            for trade_detail in (self.list_trade_detail, self.ledger_trade_detail):
+                trade_svc.build_txn_detail_list(kline, Decimal(1000), Decimal(3000), Decimal(3), trade_record,
+                                                trade_detail, fee_schedule)
+            start_time += timedelta(minutes=15)
+
+    def test_same_as_list(self):
+        txn_detail_list = self.list_trade_detail.txn_detail_list
+        ledger = self.ledger_trade_detail.txn_detail_list
+        self.assertEqual(len(ledger), len(txn_detail_list))
+        # 部分平倉後的金額超過 float64 的有效位數，仍需完全相同
+        self.assertTrue(any(len(txn_detail.handle_amt.as_tuple().digits) > 17 for txn_detail in txn_detail_list))
+        for idx, txn_detail in enumerate(txn_detail_list):
+            self.assertEqual(ledger[idx], txn_detail)
+        self.assertEqual(ledger[-3:], txn_detail_list[-3:])
+        self.assertEqual(ledger.get_values('units').tolist(), [float(td.units) for td in txn_detail_list])
+
+    def test_read_only(self):
+        ledger = self.ledger_trade_detail.txn_detail_list
+        for idx in (0, len(ledger) - 1):
+            with self.assertRaises(FrozenInstanceError):
+                ledger[idx].acct_balance = Decimal(0)
+        self.assertIs(ledger[-1], ledger[len(ledger) - 1])
+
+    def test_to_frame(self):
+        ledger = self.ledger_trade_detail.txn_detail_list
+        txn_df = ledger.to_frame()
+        self.assertEqual(txn_df['trade_type'].dropna().tolist(), ['BUY', 'BUY', 'SELL', 'SELL'])
+        self.assertEqual(txn_df['trade_date'].isna().tolist(), txn_df['trade_type'].isna().tolist())
+        for idx in ledger.get_trade_idx():
+            self.assertEqual(txn_df['trade_date'].iloc[idx], ledger[idx].trade_record.date)
+        self.assertEqual(txn_df['total_profit'].tolist(), [float(td.total_profit) for td in ledger])
+
+    def test_set_txn_idx_column(self):
+        ledger = self.ledger_trade_detail.txn_detail_list
+        # 同一根K棒 (最後一根) 有兩筆時取後面那筆
+        ledger.append(ledger[-1])
+        df = pd.DataFrame({'start_time': pd.date_range(self.start_time - timedelta(minutes=15), periods=13,
+                                                       freq='15min')})
+        trade_svc.set_txn_idx_column(df, self.ledger_trade_detail, BarClock('15m'))
+        self.assertEqual(df['txn_idx'].tolist(), [-1, 0, 1, 2, 3, 4, 5, 6, 7, 8, 10, -1, -1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+from com.willy.binance.util import type_util
+
+
+class BarClock:
+    """
+    將 epoch ms 對應到K棒序號: bar_idx = (timestamp_ms - offset_ms) // interval_ms
+    crypto 24/7 交易，K棒連續，序號差即為經過的K棒數
+    """
+
+    def __init__(self, kline_interval: str):
+        self.kline_interval = kline_interval
+        self.interval_ms = type_util.kline_interval_to_ms(kline_interval)
+        self.offset_ms = type_util.KLINE_INTERVAL_OFFSET_MS.get(kline_interval, 0)
+
+    def to_bar_idx(self, timestamp_ms):
+        """
+        timestamp_ms 可為 int 或 int64 ndarray
+        """
+        return (timestamp_ms - self.offset_ms) // self.interval_ms
+
+    def to_timestamp_ms(self, bar_idx):
+        return bar_idx * self.interval_ms + self.offset_ms
+
+    def to_datetime(self, bar_idx: int) -> datetime:
+        return datetime.fromtimestamp(self.to_timestamp_ms(int(bar_idx)) / 1000, tz=timezone.utc)
+
+    def datetime_to_bar_idx(self, dt: datetime) -> int:
+        return self.to_bar_idx(type_util.datetime_to_timestamp_ms(dt))
+
+    def bars_between(self, from_dt: datetime, to_dt: datetime) -> int:
+        return self.datetime_to_bar_idx(to_dt) - self.datetime_to_bar_idx(from_dt)
+
+    def locate(self, start_time_array: np.ndarray, timestamp_ms: int, is_ceil: bool = False) -> int:
+        """
+        回傳 timestamp_ms 所在K棒於 start_time_array 的位置(第一個 >= 該K棒者)
+        is_ceil 時改為第一個 start_time >= timestamp_ms 的K棒 (timestamp_ms 在K棒中間時不含該K棒)
+        K棒連續時直接以序號相減，有缺漏時改用 searchsorted
+        """
+        if len(start_time_array) == 0:
+            return 0
+        first_bar_idx = self.to_bar_idx(int(start_time_array[0]))
+        last_bar_idx = self.to_bar_idx(int(start_time_array[-1]))
+        bar_idx = self.to_bar_idx(timestamp_ms)
+        if is_ceil and self.to_timestamp_ms(bar_idx) < timestamp_ms:
+            bar_idx += 1
+        if last_bar_idx - first_bar_idx + 1 == len(start_time_array):
+            return int(min(max(bar_idx - first_bar_idx, 0), len(start_time_array)))
+        return int(np.searchsorted(start_time_array, self.to_timestamp_ms(bar_idx), side='left'))
@@ -1,4 +1,5 @@
 import logging
+import time
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
@@ -32,3 +33,58 @@ def str_to_date_min(str):
 
 def str_to_datetime(s: str = "2025-10-01T00:00:00Z"):
     return datetime.fromisoformat(s.replace("Z", "+00:00"))
+
+
+KLINE_INTERVAL_MS = {
+    "1s": 1000,
+    "1m": 60 * 1000,
+    "3m": 3 * 60 * 1000,
+    "5m": 5 * 60 * 1000,
+    "15m": 15 * 60 * 1000,
+    "30m": 30 * 60 * 1000,
+    "1h": 60 * 60 * 1000,
+    "2h": 2 * 60 * 60 * 1000,
+    "4h": 4 * 60 * 60 * 1000,
+    "6h": 6 * 60 * 60 * 1000,
+    "8h": 8 * 60 * 60 * 1000,
+    "12h": 12 * 60 * 60 * 1000,
+    "1d": 24 * 60 * 60 * 1000,
+    "3d": 3 * 24 * 60 * 60 * 1000,
+    "1w": 7 * 24 * 60 * 60 * 1000,
+}
+
+
+def is_fixed_kline_interval(kline_interval: str) -> bool:
+    """
+    月K ("1M") 長度不固定，無法以毫秒切分，不存入 kline store
+    """
+    return kline_interval in KLINE_INTERVAL_MS
+
+
+def kline_interval_to_ms(kline_interval: str) -> int:
+    if kline_interval not in KLINE_INTERVAL_MS:
+        raise ValueError(f"kline_interval[{kline_interval}] has no fixed length")
+    return KLINE_INTERVAL_MS[kline_interval]
+
+
+def datetime_to_timestamp_ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+
+# Binance 週K 從週一 00:00 UTC 開始，epoch(1970-01-01) 為週四
+KLINE_INTERVAL_OFFSET_MS = {"1w": 4 * 24 * 60 * 60 * 1000}
+
+
+def floor_to_kline_interval(timestamp_ms: int, kline_interval: str) -> int:
+    interval_ms = kline_interval_to_ms(kline_interval)
+    offset_ms = KLINE_INTERVAL_OFFSET_MS.get(kline_interval, 0)
+    return timestamp_ms - (timestamp_ms - offset_ms) % interval_ms
+
+
+def last_closed_kline_start_ms(kline_interval: str, now_ms: int | None = None) -> int:
+    """
+    最後一根已收盤K棒的開始時間
+    """
+    if now_ms is None:
+        now_ms = int(time.time() * 1000)
+    return floor_to_kline_interval(now_ms, kline_interval) - kline_interval_to_ms(kline_interval)